@@ -15,6 +15,8 @@ from rws_common import honeycomb
 from .settings import config
 
 from .models import init_app as init_models
+from .query_stats import init_app as init_query_stats
+from .replicas import init_app as init_replicas
 from .api import init_app as init_api
 from .dev_portal_api import init_app as init_dev_portal_api
 from .developer_portal_api import init_app as init_developer_portal_api
@@ -22,6 +24,7 @@ from .commands import init_app as init_commands
 from .utils import init_app as init_utils
 from .image import init_app as init_image
 from .sitemap import init_app as init_sitemap
+from .workers import init_app as init_workers
 from .locker import locker
 
 app = Flask(__name__)
@@ -35,6 +38,8 @@ honeycomb.debug_tokens['PyPxlyfo'] = True # joshua
 honeycomb.debug_tokens['fUDufdDQ'] = True # andrusca
 
 init_models(app)
+init_query_stats(app)
+init_replicas(app)
 init_utils(app)
 init_api(app)
 init_dev_portal_api(app)
@@ -42,6 +47,7 @@ init_developer_portal_api(app)
 init_commands(app)
 init_image(app)
 init_sitemap(app)
+init_workers(app)
 
 @app.route('/heartbeat')
 @app.route('/appstore-api/heartbeat')
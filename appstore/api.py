@@ -1,19 +1,21 @@
 import io
 import urllib.parse
 
+import beeline
+from botocore.exceptions import ClientError
 from flask import Blueprint, request, jsonify, abort, url_for, make_response
 from flask_cors import CORS
 from sqlalchemy import and_
 
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import PendingRollbackError
 
 from appstore.utils import jsonify_app, asset_fallback, generate_image_url, get_access_token, plat_dimensions, HARDWARE_SUPPORT
 from .models import App, Collection, HomeBanners, Category, db, Release
 from .settings import config
-from .image import generate_preview_image
+from .image import preview_variant_id, supported_preview_formats, PREVIEW_FORMATS, PREVIEW_WIDTHS
+from .preview_queue import derive_preview_variant, placeholder_png, render_preview_now
 
-from .s3 import upload_asset, download_asset
+from .s3 import download_asset
 
 parent_app = None
 api = Blueprint('api', __name__)
@@ -78,49 +80,67 @@ def apps_by_id(key):
     return generate_app_response(app)
 
 
+def negotiate_preview_variant():
+    supported = supported_preview_formats()
+
+    # An explicit ?format= wins; otherwise only hand out something other than
+    # PNG to clients that say by name that they take it, since the social
+    # card crawlers all send */* and some of them choke on anything but PNG.
+    fmt = request.args.get('format')
+    if fmt not in supported:
+        accepted = set(request.accept_mimetypes.values())
+        fmt = next((f for f in ('avif', 'webp') if f in supported and PREVIEW_FORMATS[f]['mime_type'] in accepted), 'png')
+
+    # Round up to the next size class, so nobody gets upscaled on their end.
+    width = request.args.get('width', type=int) or PREVIEW_WIDTHS[0]
+    width = min((w for w in PREVIEW_WIDTHS if w >= width), default=PREVIEW_WIDTHS[0])
+
+    return fmt, width
+
+def preview_response(body, fmt):
+    beeline.add_context_field("preview.format", fmt)
+    beeline.add_context_field("preview.bytes", len(body))
+    response = make_response(body)
+    response.headers.set('Content-Type', PREVIEW_FORMATS[fmt]['mime_type'])
+    response.headers.set('Vary', 'Accept')
+    return response
+
 @api.route('/apps/id/<key>/preview')
 def app_image_by_id(key):
     app = App.query.filter_by(id=key).one_or_none()
-    
+    if app is None:
+        abort(404)
+
+    fmt, width = negotiate_preview_variant()
     if not app.preview_image:
-        # Guess we will have to generate one.
-        screenshots = {}
-        for hw in ['aplite', 'basalt', 'chalk', 'diorite', 'emery', 'flint', 'gabbro']:
-            if hw in app.asset_collections:
-                screenshot = app.asset_collections[hw].screenshots[0]
-                if screenshot:
-                  screenshots[hw] = screenshot
-
-        icon = None
-        if app.type == 'watchapp':
-            icon = app.icon_large
-        png = generate_preview_image(title=app.title, developer=app.developer.name, icon=icon, screenshots=screenshots)
-        
-        buf = io.BytesIO()
-        buf.write(png)
-        buf.seek(0)
-        # HACK: upload_asset puts this in a print, which is only really valid for actual Files...
-        setattr(buf, 'name', "preview.png")
-        asset = upload_asset(buf, mime_type = 'image/png', path = config['S3_PREVIEW_PATH'])
-        
-        app.preview_image = asset
-        try:
-            db.session.commit()
-        except PendingRollbackError:
-            # if someone else gets to it at the same time, no big deal
-            pass
-        
-        response = make_response(png)
+        if config['QUEUE_WORKERS'] == 'inline':
+            beeline.add_context_field("preview.rendered", True)
+            return preview_response(render_preview_now(app, fmt, width), fmt)
+        # Queued when the app was submitted or last changed; the preview
+        # worker will get to it.  Don't let anyone cache this.
+        beeline.add_context_field("preview.pending", True)
+        response = make_response(placeholder_png(), 503)
         response.headers.set('Content-Type', 'image/png')
+        response.headers.set('Retry-After', str(config['PREVIEW_RETRY_AFTER']))
+        response.headers.set('Cache-Control', 'no-store')
         return response
-    
-    # looks like there's a cached version -- grab it!
+
+    variant = preview_variant_id(app.preview_image, fmt, width)
     buf = io.BytesIO()
-    download_asset(app.preview_image, buf, path = config['S3_PREVIEW_PATH'])
-    buf.seek(0)
-    response = make_response(buf.read())
-    response.headers.set('Content-Type', 'image/png')
-    return response
+    try:
+        download_asset(variant, buf, path = config['S3_PREVIEW_PATH'])
+    except ClientError:
+        if variant == app.preview_image:
+            raise
+        if config['QUEUE_WORKERS'] == 'inline':
+            return preview_response(derive_preview_variant(app, fmt, width), fmt)
+        # Rendered before we stored every variant: serve the PNG for now.
+        # `flask apps enqueue-previews --all` has the worker redo them.
+        fmt = 'png'
+        buf = io.BytesIO()
+        download_asset(app.preview_image, buf, path = config['S3_PREVIEW_PATH'])
+
+    return preview_response(buf.getvalue(), fmt)
 
 
 @api.route('/apps/dev/<dev>')
@@ -0,0 +1,609 @@
+import collections
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import zipfile
+import zlib
+from queue import Queue
+from threading import Thread, Lock
+
+from botocore.exceptions import ClientError
+
+from .models import App, AvailableArchive, Category, Collection, Developer
+from .s3 import download_asset, download_pbw, download_cache_stats
+from .settings import config
+
+
+class RefQueue(object):
+    """
+    The assets and PBWs an archive needs, spilled to an SQLite file rather
+    than held in memory, so that the export's memory use doesn't grow with
+    the store.  Each reference is only kept once, however many times it is
+    added, and they come back out in the order they first went in.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='export-refs-', suffix='.sqlite')
+            os.close(fd)
+            self.temporary = True
+        else:
+            self.temporary = False
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs (kind TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (kind, id))")
+        self.pending = []
+        # Iterating and checkpointing happen on different threads.
+        self.lock = Lock()
+
+    def add(self, kind, id):
+        if id == "" or id is None:
+            return
+        self.pending.append((kind, id))
+        if len(self.pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO refs (kind, id) VALUES (?, ?)", self.pending)
+        self.pending = []
+
+    def __len__(self):
+        self.flush()
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+    def __iter__(self):
+        self.flush()
+        # A page at a time, rather than one long-lived cursor, so that other
+        # threads can write to the same database in between.
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT rowid, kind, id FROM refs WHERE rowid > ? ORDER BY rowid LIMIT 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for rowid, kind, id in rows:
+                yield kind, id
+            last = rows[-1][0]
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            os.unlink(self.path)
+
+
+class ExportState(RefQueue):
+    """
+    A RefQueue kept next to the archive being written, along with every zip
+    entry that is safely on disk and where the zip ended after the last of
+    them, so that an export that dies part way through can be resumed.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS progress (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries (filename TEXT PRIMARY KEY, info TEXT NOT NULL)")
+
+    def _get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM progress WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO progress (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def metadata_done(self):
+        return self._get('metadata_done') is not None
+
+    def set_metadata_done(self):
+        with self.lock, self.db:
+            self._set('metadata_done', 1)
+
+    def end_offset(self):
+        return int(self._get('end_offset'))
+
+    def checkpoint(self, zinfos, end_offset):
+        rows = [(zinfo.filename, json.dumps({
+            'header_offset': zinfo.header_offset,
+            'date_time': zinfo.date_time,
+            'compress_type': zinfo.compress_type,
+            'flag_bits': zinfo.flag_bits,
+            'external_attr': zinfo.external_attr,
+            'CRC': zinfo.CRC,
+            'file_size': zinfo.file_size,
+            'compress_size': zinfo.compress_size,
+        })) for zinfo in zinfos]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO entries (filename, info) VALUES (?, ?)", rows)
+            self._set('end_offset', end_offset)
+
+    def entries(self):
+        with self.lock:
+            rows = [(filename, json.loads(info)) for filename, info in self.db.execute("SELECT filename, info FROM entries")]
+        rows.sort(key=lambda row: row[1]['header_offset'])
+        for filename, info in rows:
+            zinfo = zipfile.ZipInfo(filename, date_time=tuple(info.pop('date_time')))
+            for key, value in info.items():
+                setattr(zinfo, key, value)
+            yield zinfo
+
+
+def write_json_object(f, items):
+    """
+    Write `items`, an iterable of (key, value) pairs, to the text file `f` as
+    one JSON object, without ever holding more than one value.  The output is
+    the same as json.dump(dict(items), f).
+    """
+    f.write('{')
+    first = True
+    for key, value in items:
+        if not first:
+            f.write(', ')
+        first = False
+        f.write(json.dumps(key if isinstance(key, str) else str(key)))
+        f.write(': ')
+        json.dump(value, f)
+    f.write('}')
+
+
+def _mk_release(rel, refs):
+    refs.add('binary', rel.id)
+
+    return {
+        'has_pbw': rel.has_pbw,
+        'binaries': { plat: {
+            'sdk_major': b.sdk_major,
+            'sdk_minor': b.sdk_minor,
+            'process_info_flags': b.process_info_flags,
+            'icon_resource_id': b.icon_resource_id,
+        } for plat,b in rel.binaries.items() },
+        'capabilities': rel.capabilities,
+        'js_md5': rel.js_md5,
+        'published_date': rel.published_date.timestamp() if rel.published_date else None,
+        'release_notes': rel.release_notes,
+        'version': rel.version,
+        'compatibility': rel.compatibility,
+    }
+
+def _mk_asset_collection(ass, refs):
+    for img in ass.headers:
+        refs.add('asset', img)
+    refs.add('asset', ass.banner)
+
+    return {
+        'description': ass.description,
+        'screenshots': ass.screenshots,
+        'headers': ass.headers,
+        'banner': ass.banner,
+    }
+
+def _mk_app(app, refs):
+    refs.add('asset', app.icon_large)
+    refs.add('asset', app.icon_small)
+    return {
+        'uuid': app.app_uuid,
+        'asset_collections': { plat: _mk_asset_collection(ass, refs) for plat,ass in app.asset_collections.items() },
+        'category_id': app.category_id,
+        'companion_apps': { plat:
+            {
+                'icon': c.icon,
+                'url': c.url,
+                'name': c.name,
+                'pebblekit3': c.pebblekit3,
+            } for plat,c in app.companions.items() },
+        'collection_ids': [ c.id for c in app.collections ],
+        'created_at': app.created_at.timestamp() if app.created_at else None,
+        'developer_id': app.developer_id,
+        'hearts': app.hearts,
+        'releases': { rel.id: _mk_release(rel, refs) for rel in app.releases if rel.is_published },
+        'icon_large': app.icon_large,
+        'icon_small': app.icon_small,
+        'published_date': app.published_date.timestamp() if app.published_date else None,
+        'source': app.source,
+        'title': app.title,
+        'timeline_enabled': app.timeline_enabled,
+        'type': app.type,
+        'website': app.website,
+    }
+
+def _exported_apps(refs):
+    ntotal = App.query.filter(App.visible == True).count()
+    for n, app in enumerate(App.query.filter(App.visible == True).order_by(App.id).yield_per(1000)):
+        if n % 1000 == 0:
+            print(f"... {n} / {ntotal} ...")
+        yield app.id, _mk_app(app, refs)
+
+def _exported_categories():
+    for c in Category.query.filter(Category.is_visible == True):
+        yield c.id, {
+            'name': c.name,
+            'slug': c.slug,
+            'colour': c.colour,
+            'icon': c.icon,
+            'app_type': c.app_type,
+            'banner_apps': [ app.id for app in c.banner_apps],
+        }
+
+def _exported_collections():
+    for c in Collection.query:
+        yield c.id, {
+            'name': c.name,
+            'slug': c.slug,
+            'app_type': c.app_type,
+            'platforms': c.platforms,
+        }
+
+def _exported_developers():
+    # XXX: at some point it might be nice to also provide a Rebble
+    # user ID for a developer?  though I guess also developers who
+    # want to provide this to a user of the archive to verify
+    # themselves could just as well give a user oauth creds to
+    # verify their developer_id
+    for d in Developer.query.yield_per(1000):
+        yield d.id, d.name
+
+def _write_metadata(zf, name, items):
+    print(f"Exporting {name}...")
+    with zf.open(f"metadata/{name}", 'w') as member, io.TextIOWrapper(member, encoding='utf-8') as f:
+        write_json_object(f, items)
+
+def _zip_path(kind, id):
+    if kind == 'asset':
+        return f"assets/{id[0]}/{id[1]}/{id}"
+    return f"binaries/{id[0]}/{id[1]}/{id}.pbw"
+
+def _download_ref(kind, id, file):
+    if kind == 'asset':
+        download_asset(id, file)
+    else:
+        download_pbw(id, file)
+
+# Payloads that are already compressed, and that deflate would only burn
+# CPU on: PNG, JPEG, GIF, WebP, and zips (which is what a PBW is).
+_precompressed_magic = (b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'RIFF', b'PK\x03\x04')
+
+# Put on the packed queue by each packing thread as it exits.
+_finished = object()
+
+class _Stage(object):
+    """
+    Time and bytes spent in one stage of the packing pipeline, summed over
+    all the threads working on it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.entries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, nbytes, seconds):
+        with self.lock:
+            self.entries += 1
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def report(self, wall):
+        busy = self.bytes / 1e6 / max(self.seconds, 0.001)
+        overall = self.bytes / 1e6 / max(wall, 0.001)
+        print(f"{self.name}: {self.entries} entries, {self.bytes / 1e6:.1f} MB in {self.seconds:.1f}s "
+              f"({busy:.1f} MB/s while busy, {overall:.1f} MB/s overall)")
+
+def compress_entry(fname, data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Build the ZipInfo and member data for `data` without touching the zip,
+    so that it can run on any thread.  Deflates only when it helps.
+    """
+    zinfo = zipfile.ZipInfo(fname, date_time=time.localtime(time.time())[:6])
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    zinfo.compress_type = zipfile.ZIP_STORED
+    if not data.startswith(_precompressed_magic):
+        # zlib lets go of the GIL while it works, so this runs in parallel.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data) * 0.95:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            data = deflated
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+def append_compressed(zf, zinfo, data):
+    """
+    Append a member built by compress_entry() to `zf`.  zipfile has no public
+    way to write data that is already compressed, so this does what
+    ZipFile.writestr does past the point where it compresses.  Only one
+    thread may call this at a time.
+    """
+    zf._writecheck(zinfo)
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+def _is_transient(e):
+    if isinstance(e, ClientError):
+        # Missing or forbidden won't fix itself by asking again.
+        return e.response['Error']['Code'] not in ('404', 'NoSuchKey', '403', 'AccessDenied')
+    return True
+
+def _failure_type(e):
+    if isinstance(e, ClientError):
+        return f"ClientError {e.response['Error']['Code']}"
+    return type(e).__name__
+
+def _fetch_with_retries(fetch, kind, id, attempts):
+    for attempt in range(attempts):
+        buf = io.BytesIO()
+        try:
+            fetch(kind, id, buf)
+            return buf.getvalue()
+        except Exception as e:
+            if attempt + 1 == attempts or not _is_transient(e):
+                raise
+            # Exponential backoff with jitter, so that twenty threads that all
+            # hit the same blip don't all come back at once.
+            time.sleep(min(2 ** attempt, 60) * random.uniform(0.5, 1.0))
+
+def _restore_zip(f, state):
+    """
+    Reopen the partial zip in `f` for writing after the last entry that
+    `state` says made it to disk, dropping anything after that.
+    """
+    f.seek(state.end_offset())
+    f.truncate()
+    zf = zipfile.ZipFile(f, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+    for zinfo in state.entries():
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+    return zf
+
+def _checkpoint(zf, state, zinfos):
+    # The zip has to be on disk before the state says that it is.
+    zf.fp.flush()
+    os.fsync(zf.fp.fileno())
+    state.checkpoint(zinfos, zf.fp.tell())
+
+def export_archive_to_zip(fn, test_only=False, n_threads=20, previous=None, fetch=_download_ref, description=None,
+                          state_path=None, resume=False):
+    """
+    Write the store's metadata, and every asset and PBW it refers to, to the
+    zip `fn`.  Anything whose path is in `previous` is left out, for a delta
+    archive; `fetch` is where the rest come from.  Returns the paths of the
+    assets and PBWs that are in the archive.
+
+    With a `state_path`, progress is checkpointed there as the export goes,
+    and `resume` carries on from the last checkpoint rather than starting
+    again; `fn` then has to be a path.
+    """
+    # test-only: only output a few files, so you can run this without a fast
+    # connection to gcs
+    if state_path is None:
+        refs = RefQueue()
+    else:
+        if not resume and os.path.exists(state_path):
+            os.unlink(state_path)
+        refs = ExportState(state_path)
+    checkpointing = state_path is not None
+    previous = previous or {}
+    attempts = config['ARCHIVE_FETCH_ATTEMPTS']
+    restored = None
+    try:
+        if checkpointing and refs.metadata_done():
+            print(f"Resuming the export into {fn}...")
+            restored = open(fn, 'r+b')
+            zf = _restore_zip(restored, refs)
+        else:
+            zf = zipfile.ZipFile(fn, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+            print(f"Querying apps...")
+            _write_metadata(zf, "apps.json", _exported_apps(refs))
+            _write_metadata(zf, "categories.json", _exported_categories())
+            _write_metadata(zf, "collections.json", _exported_collections())
+            _write_metadata(zf, "developers.json", _exported_developers())
+            if description is not None:
+                with zf.open("metadata/archive.json", "w") as descf, io.TextIOWrapper(descf, encoding='utf-8') as f:
+                    json.dump(description, f)
+            if checkpointing:
+                refs.flush()
+                _checkpoint(zf, refs, zf.filelist)
+                refs.set_metadata_done()
+
+        with zf:
+            done = set(zf.NameToInfo)
+            if done:
+                print(f"{len(done)} entries are already in the archive")
+            def wanted(kind, id):
+                path = _zip_path(kind, id)
+                return path not in previous and path not in done
+
+            ntotal = sum(1 for kind, id in refs if wanted(kind, id))
+            if previous:
+                print(f"{sum(1 for kind, id in refs if _zip_path(kind, id) in previous)} assets and PBWs are already in earlier archives")
+            # Both bounded: the references stay on disk until a thread is
+            # ready for them, and finished entries can't pile up in memory if
+            # the writer falls behind.
+            zip_targets = Queue(maxsize=n_threads * 4)
+            packed = Queue(maxsize=n_threads * 2)
+            downloads_failed = {}
+            failure_types = collections.Counter()
+            stages = [_Stage("download"), _Stage("compress"), _Stage("write")]
+            download_stage, compress_stage, write_stage = stages
+
+            started = 0
+            started_lock = Lock()
+            def pack_thread():
+                nonlocal started
+                while True:
+                    target = zip_targets.get()
+                    if target is None:
+                        packed.put(_finished)
+                        return
+                    kind, id = target
+                    fname = _zip_path(kind, id)
+
+                    try:
+                        with started_lock:
+                            started += 1
+                            if test_only and started > 50:
+                                raise TimeoutError()
+                        t0 = time.time()
+                        data = _fetch_with_retries(fetch, kind, id, attempts)
+                        t1 = time.time()
+                        download_stage.add(len(data), t1 - t0)
+                        entry = compress_entry(fname, data)
+                        compress_stage.add(len(data), time.time() - t1)
+                    except Exception as e:
+                        downloads_failed[fname] = repr(e)
+                        with started_lock:
+                            failure_types[_failure_type(e)] += 1
+                        entry = None
+                    packed.put(entry)
+
+            wall_start = time.time()
+            # Daemons, so that ^C leaves straight away; --resume picks up the
+            # pieces.
+            threads = [Thread(target=pack_thread, daemon=True) for i in range(n_threads)]
+            for thread in threads:
+                thread.start()
+
+            def feed():
+                try:
+                    for kind, id in refs:
+                        if wanted(kind, id):
+                            zip_targets.put((kind, id))
+                finally:
+                    for thread in threads:
+                        zip_targets.put(None)
+            feeder = Thread(target=feed, daemon=True)
+            feeder.start()
+
+            # This thread is the only one that touches the zip from here on.
+            n = 0
+            running = n_threads
+            unrecorded = []
+            last_checkpoint = time.time()
+            while running:
+                entry = packed.get()
+                if entry is _finished:
+                    running -= 1
+                    continue
+                if entry is not None:
+                    zinfo, data = entry
+                    t0 = time.time()
+                    append_compressed(zf, zinfo, data)
+                    write_stage.add(zinfo.compress_size, time.time() - t0)
+                    unrecorded.append(zinfo)
+                    if checkpointing and (len(unrecorded) >= 500 or time.time() - last_checkpoint > 30):
+                        _checkpoint(zf, refs, unrecorded)
+                        unrecorded = []
+                        last_checkpoint = time.time()
+                if (n % 100) == 0:
+                    print(f"... {n} done, {ntotal - n} to go ...")
+                n += 1
+
+            feeder.join()
+            for thread in threads:
+                thread.join()
+            if checkpointing and unrecorded:
+                _checkpoint(zf, refs, unrecorded)
+
+            wall = time.time() - wall_start
+            for stage in stages:
+                stage.report(wall)
+            nstored = sum(1 for zinfo in zf.filelist if zinfo.compress_type == zipfile.ZIP_STORED)
+            print(f"packed {write_stage.entries} entries, {write_stage.bytes / 1e6:.1f} MB, in {wall:.1f}s "
+                  f"({write_stage.entries / max(wall, 0.001):.1f} entries/s; {nstored} stored uncompressed)")
+            if failure_types:
+                print(f"{len(downloads_failed)} failed: " +
+                      ", ".join(f"{count} {kind}" for kind, count in failure_types.most_common()))
+
+            cache_stats = download_cache_stats()
+            if cache_stats:
+                print(f"download cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                      f"{cache_stats['bytes_served']} bytes served locally, {cache_stats['evictions']} evictions")
+
+            with zf.open("metadata/failed_downloads.json", "w") as failedf, io.TextIOWrapper(failedf, encoding='utf-8') as f:
+                json.dump(downloads_failed, f)
+
+            with open(f"{os.path.dirname(__file__)}/ARCHIVE_LICENSE", "rb") as rf, zf.open("LICENSE.txt", "w") as wf:
+                wf.write(rf.read())
+
+            packed_paths = [name for name in zf.NameToInfo if name.startswith(('assets/', 'binaries/'))]
+    finally:
+        if restored is not None:
+            restored.close()
+        refs.close()
+    return packed_paths
+
+
+def archive_manifest(filename, packed_paths, previous_manifest=None):
+    """
+    The manifest kept next to an archive.  It maps every asset and PBW path
+    to the archive in the chain that holds it, as of this archive, so that
+    the next delta only needs to look at the latest manifest.
+    """
+    if previous_manifest is None:
+        base, archives, contents = filename, [], {}
+    else:
+        base, archives, contents = previous_manifest['base'], previous_manifest['archives'], dict(previous_manifest['contents'])
+    contents.update((path, filename) for path in packed_paths)
+    return {
+        'filename': filename,
+        'base': base,
+        'archives': archives + [filename],
+        'contents': contents,
+    }
+
+def latest_archive_chain():
+    """
+    The newest full archive and the deltas built on it, oldest first.
+    """
+    base = (AvailableArchive.query
+            .filter(AvailableArchive.base_id == None)
+            .order_by(AvailableArchive.created_at.desc())
+            .first())
+    if base is None:
+        return []
+    deltas = (AvailableArchive.query
+              .filter(AvailableArchive.base_id == base.id)
+              .order_by(AvailableArchive.created_at)
+              .all())
+    return [base] + deltas
+
+def consolidate_archive_to_zip(fn, manifest, local_archives, n_threads=20):
+    """
+    Write a full archive to `fn`, taking each asset and PBW from whichever of
+    `local_archives` (filename to local path, covering manifest['archives'])
+    the manifest says holds it, and only downloading what none of them do.
+    The metadata is exported afresh.
+    """
+    sources = {filename: zipfile.ZipFile(path) for filename, path in local_archives.items()}
+    contents = manifest['contents']
+
+    def fetch(kind, id, file):
+        path = _zip_path(kind, id)
+        source = sources.get(contents.get(path))
+        if source is None:
+            _download_ref(kind, id, file)
+        else:
+            # ZipFile reads are safe from several threads at once.
+            file.write(source.read(path))
+
+    try:
+        return export_archive_to_zip(fn, n_threads=n_threads, fetch=fetch,
+                                     description={'kind': 'full', 'consolidated_from': manifest['archives']})
+    finally:
+        for source in sources.values():
+            source.close()
@@ -0,0 +1,271 @@
+import contextlib
+import datetime
+import json
+import platform
+import random
+import time
+import tracemalloc
+import uuid
+
+from flask import current_app
+
+from . import locker as locker_views
+from .explain import capture_statements
+from .models import db, App, AssetCollection, Binary, Category, Collection, Developer, HomeBanners, LockerEntry, Release, UserLike, category_banner_apps, collection_apps
+from .utils import valid_platforms
+
+# Support for `flask apps bench-seed` and `flask apps bench-api`: fill a
+# scratch database with a made-up but realistically shaped appstore, then
+# time the public API against it through Flask's test client.  Everything
+# is generated from a seed, so two runs against the same seed are measuring
+# the same data.
+
+# Everything in the dataset dates from around here, not from today, so that
+# the same seed gives the same rows whenever it's run.  (recent_hearts does
+# still depend on the date daily-hearts is run.)
+EPOCH = datetime.datetime(2025, 1, 1)
+
+categories_by_type = {
+    'watchface': ['Faces'],
+    'watchapp': ['Daily', 'Tools & Utilities', 'Notifications', 'Remotes', 'Health & Fitness', 'Games'],
+}
+
+def percentile(values, p):
+    # values must already be sorted
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def _object_id(rng):
+    return f"{rng.getrandbits(96):024x}"
+
+def _insert(table, rows, batch_size=5000):
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[i:i + batch_size])
+
+def generate_dataset(developers, apps_per_developer, users, seed):
+    """
+    Populate an empty database.  Returns a count of the rows made, by table.
+    """
+    rng = random.Random(seed)
+    rows = {table: [] for table in ('categories', 'developers', 'apps', 'releases', 'binaries', 'asset_collections',
+                                    'collections', 'collection_apps', 'home_banners', 'category_banner_apps',
+                                    'user_likes', 'locker_entries')}
+
+    categories = {}
+    for app_type, names in categories_by_type.items():
+        for name in names:
+            category = {'id': _object_id(rng), 'name': name, 'slug': name.lower().replace(' & ', '-').replace(' ', '-'),
+                        'colour': f"{rng.getrandbits(24):06x}", 'icon': _object_id(rng), 'app_type': app_type,
+                        'is_visible': True}
+            rows['categories'].append(category)
+            categories.setdefault(app_type, []).append(category['id'])
+
+    apps_by_type = {'watchface': [], 'watchapp': []}
+    for d in range(developers):
+        developer_id = _object_id(rng)
+        rows['developers'].append({'id': developer_id, 'name': f"Developer {d}"})
+        for a in range(apps_per_developer):
+            app_type = 'watchface' if rng.random() < 0.6 else 'watchapp'
+            app_id = _object_id(rng)
+            created_at = EPOCH - datetime.timedelta(days=rng.randrange(3650))
+            # Some of the watchfaces come from the generator, and have the
+            # UUIDs that generated_filter() looks for.
+            if app_type == 'watchface' and rng.random() < 0.1:
+                app_uuid = str(uuid.UUID(int=(0x13371337 << 96) | rng.getrandbits(96)))
+            else:
+                app_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+
+            # Every app runs somewhere; most run nearly everywhere.
+            compatibility = [hw for hw in valid_platforms if rng.random() < 0.8] or [rng.choice(valid_platforms)]
+            n_releases = rng.randint(1, 6)
+            published = created_at
+            for r in range(n_releases):
+                release_id = _object_id(rng)
+                rows['releases'].append({'id': release_id, 'app_id': app_id, 'has_pbw': True,
+                                         'capabilities': ['configurable'] if rng.random() < 0.3 else [],
+                                         'js_md5': None, 'published_date': published,
+                                         'release_notes': f"Release {r} of app {app_id}.", 'version': f"1.{r}",
+                                         'compatibility': compatibility, 'is_published': True})
+                for hw in compatibility:
+                    rows['binaries'].append({'release_id': release_id, 'platform': hw, 'sdk_major': 5,
+                                             'sdk_minor': 86, 'process_info_flags': rng.getrandbits(8),
+                                             'icon_resource_id': rng.randrange(100)})
+                published += datetime.timedelta(days=rng.randrange(1, 120))
+
+            for hw in compatibility:
+                rows['asset_collections'].append({'app_id': app_id, 'platform': hw,
+                                                  'description': f"A {app_type} for {hw}. " * rng.randint(1, 20),
+                                                  'screenshots': [_object_id(rng) for _ in range(rng.randint(1, 5))],
+                                                  'headers': [_object_id(rng)] if rng.random() < 0.5 else [],
+                                                  'banner': _object_id(rng) if rng.random() < 0.2 else None})
+
+            rows['apps'].append({'id': app_id, 'app_uuid': app_uuid, 'category_id': rng.choice(categories[app_type]),
+                                 'created_at': created_at, 'updated_at': published, 'developer_id': developer_id,
+                                 'hearts': 0, 'random_weekly': None, 'recent_hearts': None,
+                                 'icon_large': _object_id(rng) if app_type == 'watchapp' else '',
+                                 'icon_small': _object_id(rng) if app_type == 'watchapp' else '',
+                                 'published_date': created_at, 'source': None, 'title': f"{app_type.title()} {d}-{a}",
+                                 'timeline_enabled': False, 'type': app_type, 'website': None,
+                                 'visible': rng.random() < 0.95, 'timeline_token': None,
+                                 'installs': 0, 'discourse_topic_id': 0})
+            apps_by_type[app_type].append(app_id)
+
+    collection_id = 0
+    for app_type, app_ids in apps_by_type.items():
+        for n in range(3):
+            collection_id += 1
+            rows['collections'].append({'id': collection_id, 'name': f"{app_type.title()} Collection {n}",
+                                        'slug': f"{app_type}-collection-{n}", 'app_type': app_type,
+                                        'platforms': valid_platforms})
+            for app_id in rng.sample(app_ids, min(len(app_ids), max(1, len(app_ids) // 10))):
+                rows['collection_apps'].append({'collection_id': collection_id, 'app_id': app_id})
+        for app_id in rng.sample(app_ids, min(len(app_ids), 3)):
+            rows['home_banners'].append({'app_type': app_type, 'app_id': app_id})
+        for category_id in categories[app_type]:
+            for app_id in rng.sample(app_ids, min(len(app_ids), 2)):
+                rows['category_banner_apps'].append({'category_id': category_id, 'app_id': app_id})
+
+    # Likes and lockers are long-tailed: most people have a few apps, and a
+    # few people have a great many.
+    all_apps = [app['id'] for app in rows['apps']]
+    hearts = dict.fromkeys(all_apps, 0)
+    installs = dict.fromkeys(all_apps, 0)
+    for user_id in range(1, users + 1):
+        size = min(len(all_apps), int(rng.paretovariate(1.2) * 5))
+        for app_id in rng.sample(all_apps, size):
+            rows['locker_entries'].append({'app_id': app_id, 'user_id': user_id,
+                                           'user_token': f"{rng.getrandbits(192):048x}"})
+            installs[app_id] += 1
+            if rng.random() < 0.3:
+                rows['user_likes'].append({'user_id': user_id, 'app_id': app_id,
+                                           'created_at': EPOCH - datetime.timedelta(days=rng.randrange(90))})
+                hearts[app_id] += 1
+    for app in rows['apps']:
+        app['hearts'] = hearts[app['id']]
+        app['installs'] = installs[app['id']]
+
+    for table in (Category.__table__, Developer.__table__, App.__table__, Release.__table__, Binary.__table__,
+                  AssetCollection.__table__, Collection.__table__, collection_apps, HomeBanners.__table__,
+                  category_banner_apps, UserLike.__table__, LockerEntry.__table__):
+        _insert(table, rows[table.name])
+    db.session.commit()
+
+    # The same jobs that keep these up to date in production.
+    App.generate_random_weekly()
+    App.generate_recent_hearts()
+
+    return {table: len(table_rows) for table, table_rows in rows.items()}
+
+@contextlib.contextmanager
+def _as_user(user_id):
+    # The locker asks the auth service who we are; that's not what we're
+    # here to measure.
+    get_uid = locker_views.get_uid
+    locker_views.get_uid = lambda: user_id
+    try:
+        yield
+    finally:
+        locker_views.get_uid = get_uid
+
+def benchmark_routes(hardware, sample_size, seed):
+    """
+    The requests to make for each route, as a list of URLs per route name.
+    """
+    rng = random.Random(seed)
+    app_ids = sorted(x for (x,) in db.session.query(App.id).filter(App.visible == True))
+    sample = rng.sample(app_ids, min(len(app_ids), sample_size))
+    collection = Collection.query.filter_by(app_type='watchface').order_by(Collection.id).first()
+    pages = [f"/api/v1/apps/collection/all/watchfaces?hardware={hardware}&limit=20&offset={offset}"
+             for offset in range(0, 20 * sample_size, 20)]
+    if collection is not None:
+        pages += [f"/api/v1/apps/collection/{collection.slug}/watchfaces?hardware={hardware}&limit=20&offset={offset}"
+                  for offset in range(0, 100, 20)]
+    return {
+        'home': [f"/api/v1/home/{home_type}?hardware={hardware}" for home_type in ('watchfaces', 'apps')],
+        'collection_page': pages,
+        'app_by_id': [f"/api/v1/apps/id/{app_id}?hardware={hardware}" for app_id in sample],
+        'locker': ["/api/v1/locker"],
+        'changelog': [f"/api/v1/applications/{app_id}/changelog" for app_id in sample],
+    }
+
+def _summary(values, scale=1):
+    values = sorted(values)
+    return {
+        'mean': round(sum(values) / len(values) * scale, 3) if values else 0,
+        'p50': round(percentile(values, 50) * scale, 3),
+        'p90': round(percentile(values, 90) * scale, 3),
+        'p95': round(percentile(values, 95) * scale, 3),
+        'p99': round(percentile(values, 99) * scale, 3),
+        'max': round(values[-1] * scale, 3) if values else 0,
+    }
+
+def run_benchmark(routes, iterations, warmup, locker_user):
+    """
+    Make every request in `routes` `iterations` times, after `warmup` untimed
+    rounds, and return a machine-readable summary of how each route did.
+    """
+    client = current_app.test_client()
+    results = {}
+    with _as_user(locker_user):
+        for name, urls in routes.items():
+            for i in range(warmup):
+                client.get(urls[i % len(urls)])
+
+            timings = []
+            queries = []
+            errors = 0
+            for i in range(iterations):
+                url = urls[i % len(urls)]
+                responses = []
+                start = time.perf_counter()
+                statements = capture_statements(lambda: responses.append(client.get(url)))
+                timings.append(time.perf_counter() - start)
+                queries.append(sum(count for _, _, count in statements))
+                if responses[0].status_code != 200:
+                    errors += 1
+
+            # Measure memory in a second pass, so tracemalloc's overhead
+            # doesn't end up in the timings.
+            peaks = []
+            for i in range(min(iterations, len(urls))):
+                tracemalloc.start()
+                try:
+                    client.get(urls[i])
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+
+            results[name] = {
+                'requests': iterations,
+                'errors': errors,
+                'latency_ms': _summary(timings, 1000),
+                'sql_queries': _summary(queries),
+                'peak_alloc_kib': _summary(peaks, 1 / 1024),
+            }
+    return results
+
+def benchmark_report(results, **meta):
+    return {
+        'meta': {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            **meta,
+        },
+        'routes': results,
+    }
+
+def compare_reports(old, new):
+    """
+    Yield (route, metric, old, new) for the headline numbers of two
+    benchmark_report()s.
+    """
+    for route in new['routes']:
+        if route not in old['routes']:
+            continue
+        for metric, stat in (('latency_ms', 'p50'), ('latency_ms', 'p95'), ('sql_queries', 'p50'), ('peak_alloc_kib', 'p50')):
+            yield route, f"{metric}.{stat}", old['routes'][route][metric][stat], new['routes'][route][metric][stat]
+
+def write_report(report, output):
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
@@ -1,20 +1,24 @@
+import collections
 import datetime
-import functools
 import hashlib
 import io
 import json
-from queue import *
-from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import tempfile
 import yaml
 
 import flask.json
 import shutil
+import struct
 import subprocess
+import sys
+import time
+import tracemalloc
 import zipfile
 
 import click
 import os
+from flask import current_app
 from flask.cli import AppGroup
 
 import requests
@@ -25,8 +29,18 @@ from algoliasearch import algoliasearch
 
 from .utils import id_generator, algolia_app
 from .models import Category, db, App, Developer, Release, CompanionApp, Binary, AssetCollection, LockerEntry, UserLike, Collection, AvailableArchive
-from .pbw import PBW, release_from_pbw
-from .s3 import upload_pbw, upload_asset, download_pbw, download_asset, upload_archive
+from .pbw import PBW, PBWBundle, release_from_pbw, extract_release_metadata
+from .image import PREFERRED_GROUPINGS, PREVIEW_WIDTHS, render_preview_image, encode_preview, supported_preview_formats, platform_borders, fallback_image
+from .preview_queue import enqueue_preview_render, run_preview_worker
+from .discord_queue import run_discord_worker
+from .bench import percentile, generate_dataset, benchmark_routes, run_benchmark, benchmark_report, compare_reports, write_report
+from .explain import capture_statements, compiled_statement, explain_statement, print_plan_summary, seq_scans
+from .api import home, apps_by_collection, global_filter
+from .locker import locker_entries, jsonify_locker_app
+from . import sitemap, discourse
+from .archive import export_archive_to_zip, consolidate_archive_to_zip, archive_manifest, latest_archive_chain
+from .derivatives import ASSET_KINDS, generate_derivatives, upload_image
+from .s3 import upload_pbw, download_pbw, upload_archive, download_archive, upload_archive_manifest, download_archive_manifest
 from .settings import config
 
 if config['ALGOLIA_ADMIN_API_KEY']:
@@ -78,7 +92,7 @@ def fix_caps():
         release_id = pbw_path[:-4]
         try:
             pbw = PBW(f'pbws/{pbw_path}', 'aplite')
-            caps = [x for x in pbw.get_capabilities() if x != '']
+            caps = pbw.get_capabilities()
         except (KeyError, zipfile.BadZipFile):
             print("Invalid PBW!?")
             continue
@@ -92,6 +106,421 @@ def fix_caps():
     db.session.commit()
 
 
+def _download_pbw_bytes(release_id):
+    buf = io.BytesIO()
+    download_pbw(release_id, buf)
+    return buf.getvalue()
+
+
+def _upsert_release_metadata(releases, results):
+    # releases: {id: (has_pbw, capabilities, js_md5)} as currently stored.
+    # results: {id: extract_release_metadata(...)} for the ones we parsed.
+    existing = {
+        (row.release_id, row.platform): row
+        for row in db.session.query(Binary.id, Binary.release_id, Binary.platform, Binary.sdk_major,
+                                    Binary.sdk_minor, Binary.process_info_flags, Binary.icon_resource_id)
+                             .filter(Binary.release_id.in_(list(results.keys())))
+    }
+
+    new_binaries = []
+    changed_binaries = []
+    changed_releases = []
+    for release_id, metadata in results.items():
+        for platform, values in metadata['binaries'].items():
+            row = existing.get((release_id, platform))
+            if row is None:
+                new_binaries.append({'release_id': release_id, 'platform': platform, **values})
+            elif any(getattr(row, k) != v for k, v in values.items()):
+                changed_binaries.append({'id': row.id, **values})
+
+        if releases[release_id] != (True, metadata['capabilities'], metadata['js_md5']):
+            changed_releases.append({'id': release_id, 'has_pbw': True, 'capabilities': metadata['capabilities'], 'js_md5': metadata['js_md5']})
+
+    db.session.bulk_insert_mappings(Binary, new_binaries)
+    db.session.bulk_update_mappings(Binary, changed_binaries)
+    db.session.bulk_update_mappings(Release, changed_releases)
+    return len(new_binaries), len(changed_binaries), len(changed_releases)
+
+
+@apps.command('reindex-binaries')
+@click.option('--checkpoint', default='reindex-binaries.checkpoint', help='File recording the last release id committed.')
+@click.option('--restart', is_flag=True, help='Ignore any existing checkpoint.')
+@click.option('--downloads', type=int, default=16, help='Concurrent PBW downloads.')
+@click.option('--workers', type=int, default=None, help='PBW parsing processes (default: one per CPU).')
+@click.option('--batch-size', type=int, default=200)
+@click.option('--include-no-pbw', is_flag=True, help='Also try releases that are marked has_pbw=False.')
+def reindex_binaries(checkpoint, restart, downloads, workers, batch_size, include_no_pbw):
+    last_id = None
+    if not restart and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            last_id = f.read().strip() or None
+        print(f"Resuming after release {last_id}")
+
+    n_releases = 0
+    n_bytes = 0
+    n_inserted = 0
+    n_updated = 0
+    n_releases_updated = 0
+    failures = collections.Counter()
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=downloads) as downloader, ProcessPoolExecutor(max_workers=workers) as parser:
+        while True:
+            query = db.session.query(Release.id, Release.has_pbw, Release.capabilities, Release.js_md5).order_by(Release.id)
+            if last_id is not None:
+                query = query.filter(Release.id > last_id)
+            if not include_no_pbw:
+                query = query.filter(Release.has_pbw == True)
+            batch = query.limit(batch_size).all()
+            if not batch:
+                break
+
+            releases = {row.id: (row.has_pbw, row.capabilities, row.js_md5) for row in batch}
+            pending_downloads = {downloader.submit(_download_pbw_bytes, release_id): release_id for release_id in releases}
+            pending_parses = {}
+            for future in as_completed(pending_downloads):
+                release_id = pending_downloads[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    failures[f"download: {type(e).__name__}"] += 1
+                    continue
+                n_bytes += len(data)
+                pending_parses[parser.submit(extract_release_metadata, data)] = release_id
+
+            results = {}
+            for future in as_completed(pending_parses):
+                release_id = pending_parses[future]
+                try:
+                    results[release_id] = future.result()
+                except Exception as e:
+                    failures[f"parse: {type(e).__name__}"] += 1
+
+            inserted, updated, releases_updated = _upsert_release_metadata(releases, results)
+            db.session.commit()
+            n_inserted += inserted
+            n_updated += updated
+            n_releases_updated += releases_updated
+            n_releases += len(batch)
+
+            last_id = batch[-1].id
+            with open(checkpoint, 'w') as f:
+                f.write(last_id)
+
+            elapsed = time.time() - start
+            print(f"... {n_releases} releases ({n_releases / elapsed:.1f}/s), up to {last_id} ...")
+
+    elapsed = time.time() - start
+    print(f"Done: {n_releases} releases in {elapsed:.1f}s ({n_releases / max(elapsed, 0.001):.1f}/s), "
+          f"{n_bytes / 1024 / 1024:.1f} MiB downloaded ({n_bytes / 1024 / 1024 / max(elapsed, 0.001):.1f} MiB/s)")
+    print(f"Binaries: {n_inserted} inserted, {n_updated} updated; releases updated: {n_releases_updated}")
+    if failures:
+        print("Failures: " + ", ".join(f"{kind}: {count}" for kind, count in failures.most_common()))
+
+
+def _derivative_jobs(kinds, app_id):
+    # (asset id, kind, platform, app type); the same banner is usually shared
+    # by every platform's asset collection, so only do each one once.
+    seen = set()
+    apps = db.session.query(App.id, App.type, App.icon_large, App.icon_small).order_by(App.id)
+    asset_collections = db.session.query(AssetCollection.platform, AssetCollection.screenshots, AssetCollection.headers).order_by(AssetCollection.app_id)
+    if app_id:
+        apps = apps.filter(App.id == app_id)
+        asset_collections = asset_collections.filter(AssetCollection.app_id == app_id)
+
+    def job(id, kind, platform=None, app_type=None):
+        if id and (id, kind, platform) not in seen:
+            seen.add((id, kind, platform))
+            return [(id, kind, platform, app_type)]
+        return []
+
+    for app in apps.yield_per(500):
+        if 'large_icon' in kinds:
+            yield from job(app.icon_large, 'large_icon', app_type=app.type)
+        if 'small_icon' in kinds:
+            yield from job(app.icon_small, 'small_icon')
+    for collection in asset_collections.yield_per(500):
+        if 'screenshot' in kinds:
+            for screenshot in collection.screenshots:
+                yield from job(screenshot, 'screenshot', platform=collection.platform)
+        if 'banner' in kinds:
+            for header in collection.headers:
+                yield from job(header, 'banner')
+
+
+@apps.command('backfill-derivatives')
+@click.option('--kind', 'kinds', multiple=True, type=click.Choice(ASSET_KINDS), help='Only these kinds of asset (default: all).')
+@click.option('--app', 'app_id', default=None, help='Only this app.')
+@click.option('--workers', type=int, default=8)
+@click.option('--force', is_flag=True, help='Regenerate derivatives that already exist.')
+def backfill_derivatives(kinds, app_id, workers, force):
+    kinds = kinds or ASSET_KINDS
+    generated = 0
+    skipped = 0
+    failures = collections.Counter()
+    start = time.time()
+
+    jobs = _derivative_jobs(kinds, app_id)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Bounded, so that we don't hold a future for every asset in the store.
+            chunk = [job for _, job in zip(range(workers * 50), jobs)]
+            if not chunk:
+                break
+            pending = {executor.submit(generate_derivatives, id, kind, None, platform, app_type, force): (id, kind) for id, kind, platform, app_type in chunk}
+            for future in as_completed(pending):
+                id, kind = pending[future]
+                try:
+                    sizes = future.result()
+                except Exception as e:
+                    print(f"Failed to generate derivatives for {kind} {id}: {e}")
+                    failures[type(e).__name__] += 1
+                    continue
+                if sizes:
+                    generated += len(sizes)
+                else:
+                    skipped += 1
+            print(f"... {generated} derivatives generated, {skipped} assets already done ({time.time() - start:.1f}s) ...")
+
+    print(f"Done: {generated} derivatives generated, {skipped} assets already done, in {time.time() - start:.1f}s")
+    if failures:
+        print("Failures: " + ", ".join(f"{kind}: {count}" for kind, count in failures.most_common()))
+
+
+def _pbw_corpus(source):
+    # Either a directory of .pbw files (like the one fix-capabilities uses),
+    # or an archive produced by export-archive.
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith('.pbw'):
+                with open(os.path.join(source, name), 'rb') as f:
+                    yield name, f.read()
+    else:
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                if info.filename.startswith('binaries/') and info.filename.endswith('.pbw'):
+                    yield info.filename, zf.read(info)
+
+
+def _parse_pbw_fully(data):
+    bundle = PBWBundle(data)
+    pbw = bundle.for_platform('aplite')
+    pbw.get_capabilities()
+    pbw.has_javascript
+    for platform in bundle.platforms():
+        pbw = bundle.for_platform(platform)
+        if pbw.is_app_bundle:
+            pbw.get_app_metadata()
+    bundle.close()
+
+
+@apps.command('bench-pbw')
+@click.argument('source')
+@click.option('--limit', type=int, default=None)
+@click.option('--verbose', is_flag=True)
+def bench_pbw(source, limit, verbose):
+    timings = []
+    peaks = []
+    failed = 0
+    for n, (name, data) in enumerate(_pbw_corpus(source)):
+        if limit is not None and n >= limit:
+            break
+        try:
+            start = time.perf_counter()
+            _parse_pbw_fully(data)
+            elapsed = time.perf_counter() - start
+
+            # Measure memory in a second pass, so tracemalloc's overhead
+            # doesn't end up in the timings.
+            tracemalloc.start()
+            try:
+                _parse_pbw_fully(data)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        except (KeyError, ValueError, struct.error, zipfile.BadZipFile) as e:
+            print(f"{name}: failed to parse: {repr(e)}")
+            failed += 1
+            continue
+        timings.append(elapsed)
+        peaks.append(peak)
+        if verbose:
+            print(f"{name}: {len(data)} bytes, {elapsed * 1000:.2f} ms, {peak / 1024:.1f} KiB peak")
+
+    if not timings:
+        print("No PBWs parsed.")
+        return
+    timings.sort()
+    peaks.sort()
+    print(f"{len(timings)} PBWs parsed, {failed} failed")
+    print(f"parse time ms: mean {sum(timings) / len(timings) * 1000:.2f}, p50 {percentile(timings, 50) * 1000:.2f}, "
+          f"p95 {percentile(timings, 95) * 1000:.2f}, max {timings[-1] * 1000:.2f}")
+    print(f"peak memory KiB: mean {sum(peaks) / len(peaks) / 1024:.1f}, p50 {percentile(peaks, 50) / 1024:.1f}, "
+          f"p95 {percentile(peaks, 95) / 1024:.1f}, max {peaks[-1] / 1024:.1f}")
+
+
+@apps.command('bench-preview')
+@click.option('--iterations', type=int, default=20)
+def bench_preview(iterations):
+    # Renders with the fallback screenshots, so this needs no network.
+    title = "A Rather Long Watchface Title That Will Need Ellipsizing"
+    for platforms in PREFERRED_GROUPINGS:
+        if any(platform not in platform_borders for platform in platforms):
+            continue
+        screenshots = {platform: fallback_image(platform) for platform in platforms}
+        variants = [(fmt, width) for fmt in supported_preview_formats() for width in PREVIEW_WIDTHS]
+        render_times = []
+        encode_times = collections.defaultdict(list)
+        encoded_bytes = {}
+        for _ in range(iterations):
+            start = time.perf_counter()
+            canvas = render_preview_image(title, "Some Developer", platforms, screenshots)
+            render_times.append(time.perf_counter() - start)
+            for fmt, width in variants:
+                start = time.perf_counter()
+                encoded_bytes[fmt, width] = len(encode_preview(canvas, fmt, width))
+                encode_times[fmt, width].append(time.perf_counter() - start)
+        render_times.sort()
+        print(f"{'+'.join(platforms):>16}: render p50 {percentile(render_times, 50) * 1000:.2f} ms, "
+              f"p95 {percentile(render_times, 95) * 1000:.2f} ms")
+        for fmt, width in variants:
+            times = sorted(encode_times[fmt, width])
+            print(f"{'':>16}  {fmt:>4} {width:>3}px: encode p50 {percentile(times, 50) * 1000:.2f} ms, "
+                  f"{encoded_bytes[fmt, width]} bytes")
+
+
+@apps.command('preview-worker')
+@click.option('--processes', type=int, default=None, help='Render processes (default: PREVIEW_RENDER_WORKERS; 0 renders in this one).')
+@click.option('--batch-size', type=int, default=20)
+@click.option('--poll-interval', type=float, default=5.0)
+@click.option('--once', is_flag=True, help='Exit once the queue is empty, rather than waiting for more.')
+def preview_worker(processes, batch_size, poll_interval, once):
+    if processes is None:
+        processes = config['PREVIEW_RENDER_WORKERS']
+    rendered, failed = run_preview_worker(processes, batch_size, poll_interval, once)
+    print(f"Done: {rendered} previews rendered, {failed} failed")
+
+
+@apps.command('enqueue-previews')
+@click.option('--all', 'everything', is_flag=True, help='Re-render every preview, not only the missing ones.')
+def enqueue_previews(everything):
+    # For switching to QUEUE_WORKERS=external, or when the preview layout
+    # changes.
+    query = App.query.options(load_only(App.id))
+    if not everything:
+        query = query.filter(App.preview_image == None)
+    count = 0
+    for app in query:
+        enqueue_preview_render(app.id)
+        count += 1
+    db.session.commit()
+    print(f"Queued {count} previews")
+
+
+@apps.command('discord-worker')
+@click.option('--batch-size', type=int, default=50)
+@click.option('--poll-interval', type=float, default=5.0)
+@click.option('--once', is_flag=True, help='Exit once the queue is empty, rather than waiting for more.')
+def discord_worker(batch_size, poll_interval, once):
+    sent, deferred = run_discord_worker(batch_size, poll_interval, once)
+    print(f"Done: {sent} Discord messages sent, {deferred} deferred")
+
+
+@apps.command('discourse-worker')
+@click.option('--batch-size', type=int, default=10)
+@click.option('--poll-interval', type=float, default=10.0)
+@click.option('--once', is_flag=True, help='Exit once the queue is empty, rather than waiting for more.')
+def discourse_worker(batch_size, poll_interval, once):
+    posted, failed = discourse.run_announcement_worker(batch_size, poll_interval, once)
+    print(f"Done: {posted} announcements posted, {failed} failed")
+
+
+@apps.command('discourse-failed')
+@click.option('--retry', is_flag=True, help='Put them back in the queue.')
+def discourse_failed(retry):
+    jobs = discourse.failed_announcements()
+    for job in jobs:
+        print(f"{job.idempotency_key} (app {job.app_id}), {job.attempts} attempts: {job.last_error}")
+        if retry:
+            job.attempts = 0
+            job.claimed_at = None
+            job.available_at = datetime.datetime.utcnow()
+    db.session.commit()
+    print(f"{len(jobs)} announcements {'requeued' if retry else 'given up on'}")
+    if jobs and not retry:
+        sys.exit(1)
+
+
+@apps.command('build-sitemaps')
+@click.option('--full', is_flag=True, help='Rewrite every sitemap, not only the ones whose apps have changed.')
+def build_sitemaps(full):
+    start = time.time()
+    manifest, rewritten = sitemap.build_sitemaps(full)
+    n_apps = sum(entry['count'] for entry in manifest['apps'])
+    print(f"Done: {n_apps} apps in {len(manifest['apps'])} sitemaps ({rewritten} rewritten) in {time.time() - start:.1f}s")
+
+
+@apps.command('bench-sitemap')
+@click.option('--iterations', type=int, default=5)
+@click.option('--synthetic', is_flag=True, help='Use made-up apps instead of querying the database.')
+def bench_sitemap(iterations, synthetic):
+    apps_per_file = config['SITEMAP_MAX_URLS'] // (2 * len(sitemap.languages))
+    for label, n_apps in (('page', sitemap.apps_per_page), ('file', apps_per_file)):
+        if synthetic:
+            now = datetime.datetime.utcnow()
+            rows = [(f"{i:024x}", (i % 7) / 5, now) for i in range(n_apps)]
+        times = []
+        peaks = []
+        size = 0
+        for _ in range(iterations):
+            if not synthetic:
+                rows = sitemap.visible_apps().limit(n_apps).yield_per(1000)
+            tracemalloc.start()
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in sitemap.sitemap_xml(sitemap.app_paths(rows)))
+            times.append(time.perf_counter() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        times.sort()
+        print(f"{label} ({n_apps} apps, {size} bytes): p50 {percentile(times, 50) * 1000:.1f} ms, "
+              f"p95 {percentile(times, 95) * 1000:.1f} ms, peak {max(peaks) / 1024:.0f} KiB")
+
+
+@apps.command('bench-import')
+@click.option('--module', default='appstore')
+@click.option('--runs', type=int, default=5)
+@click.option('--top', type=int, default=15)
+@click.option('--max-ms', type=float, default=None, help="Fail if importing --module takes longer than this.")
+def bench_import(module, runs, top, max_ms):
+    # Same numbers as `python -X importtime`, but the median of a few fresh
+    # interpreters, since a single run is far too noisy to compare.  Older
+    # Pythons ignore -X options they don't know, so check rather than report
+    # nothing.
+    if sys.version_info < (3, 7):
+        raise click.ClickException(f"bench-import needs Python 3.7 or later for -X importtime; this is {sys.version.split()[0]}")
+    cumulative = collections.defaultdict(list)
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative_us, name = line[len('import time:'):].split('|')
+            cumulative[name.strip()].append(int(cumulative_us) / 1000)
+
+    if module not in cumulative:
+        raise click.ClickException(f"got no -X importtime samples for {module}")
+    medians = {name: sorted(times)[len(times) // 2] for name, times in cumulative.items()}
+    for name, ms in sorted(medians.items(), key=lambda item: -item[1])[:top]:
+        print(f"{ms:>9.1f} ms  {name}")
+    for name in (module, 'appstore.image'):
+        if name in medians:
+            print(f"{name}: {medians[name]:.1f} ms")
+
+    if max_ms is not None and medians[module] > max_ms:
+        raise click.ClickException(f"importing {module} took {medians[module]:.1f} ms, over the {max_ms:.1f} ms budget")
+
+
 @apps.command('import-apps')
 @click.argument('app_type')
 def import_apps(app_type):
@@ -115,13 +544,13 @@ def import_apps(app_type):
                     print("Failed to grab pbw.")
                     continue
             try:
-                PBW(filename, 'aplite')
+                bundle = PBWBundle(filename)
             except zipfile.BadZipFile:
                 print("Bad PBW!")
                 os.unlink(filename)
                 continue
         else:
-            filename = None
+            bundle = None
 
         app_obj = App(
             id=app['id'],
@@ -189,12 +618,9 @@ def import_apps(app_type):
                                          banner=None)
             db.session.add(collection)
 
-        if filename:
-            for platform in ['aplite', 'basalt', 'chalk', 'diorite', 'emery', 'flint', 'gabbro']:
-                pbw = PBW(filename, platform)
-                if not pbw.has_platform:
-                    continue
-                metadata = pbw.get_app_metadata()
+        if bundle:
+            for platform in bundle.platforms():
+                metadata = bundle.for_platform(platform).get_app_metadata()
                 binary = Binary(release_id=release['id'], platform=platform,
                                 sdk_major=metadata['sdk_version_major'], sdk_minor=metadata['sdk_version_minor'],
                                 process_info_flags=metadata['flags'], icon_resource_id=metadata['icon_resource_id'])
@@ -257,14 +683,15 @@ def import_app_from_locker(locker_app):
                 with open(filename, 'wb') as f:
                     shutil.copyfileobj(r.raw, f)
         try:
-            if PBW(filename, 'aplite').zip.testzip() is not None:
+            bundle = PBWBundle(filename)
+            if bundle.zip.testzip() is not None:
                 raise zipfile.BadZipFile
         except zipfile.BadZipFile:
             print("Bad PBW!")
             os.unlink(filename)
             return False
     else:
-        filename = None
+        bundle = None
 
     created_at = datetime.datetime.utcfromtimestamp(int(locker_app['id'][:8], 16)).replace(tzinfo=datetime.timezone.utc)
 
@@ -311,8 +738,8 @@ def import_app_from_locker(locker_app):
     )
     db.session.add(app)
 
-    if filename:
-        pbw = PBW(filename, 'aplite')
+    if bundle:
+        pbw = bundle.for_platform('aplite')
         js_md5 = None
         if pbw.has_javascript:
             with pbw.zip.open('pebble-js-app.js', 'r') as f:
@@ -329,11 +756,8 @@ def import_app_from_locker(locker_app):
             is_published=True,
         )
         db.session.add(release_obj)
-        for platform in ['aplite', 'basalt', 'chalk', 'diorite', 'emery', 'flint', 'gabbro']:
-            pbw = PBW(filename, platform)
-            if not pbw.has_platform:
-                continue
-            metadata = pbw.get_app_metadata()
+        for platform in bundle.platforms():
+            metadata = bundle.for_platform(platform).get_app_metadata()
             binary = Binary(release=release_obj, platform=platform,
                             sdk_major=metadata['sdk_version_major'], sdk_minor=metadata['sdk_version_minor'],
                             process_info_flags=metadata['flags'], icon_resource_id=metadata['icon_resource_id'])
@@ -468,8 +892,8 @@ def update_patched_release(new_pbw, patchlvl):
 @click.argument('pbw_file')
 @click.argument('release_notes')
 def new_release(pbw_file, release_notes):
-    pbw = PBW(pbw_file, 'aplite')
-    with pbw.zip.open('appinfo.json') as f:
+    bundle = PBWBundle(pbw_file)
+    with bundle.zip.open('appinfo.json') as f:
         j = json.load(f)
     uuid = j['uuid']
     version = j['versionLabel']
@@ -478,7 +902,7 @@ def new_release(pbw_file, release_notes):
     print(f"Previous version {release_old.version}, new version {version}, release notes {release_old.release_notes}")
     if version == release_old.version:
         version = f"{version}-rbl"
-    release_new = release_from_pbw(app, pbw_file,
+    release_new = release_from_pbw(app, bundle,
                                    release_notes = release_notes,
                                    published_date = datetime.datetime.utcnow(),
                                    version = version,
@@ -496,8 +920,8 @@ def new_app(conf):
         return f"{os.path.dirname(conf)}/{base}"
 
     pbw_file = params['pbw_file']
-    pbw = PBW(path(pbw_file), 'aplite')
-    with pbw.zip.open('appinfo.json') as f:
+    bundle = PBWBundle(path(pbw_file))
+    with bundle.zip.open('appinfo.json') as f:
         appinfo = json.load(f)
     
     if App.query.filter(App.app_uuid == appinfo['uuid']).count() > 0:
@@ -511,7 +935,7 @@ def new_app(conf):
         print(f"Created developer {developer.id}")
     
     if 'header' in params:
-        header_asset = upload_asset(path(params['header']))
+        header_asset = upload_image(path(params['header']), 'banner')
     else:
         header_asset = None
     
@@ -521,7 +945,7 @@ def new_app(conf):
         asset_collections = { x['name']: AssetCollection(
             platform=x['name'],
             description=params['description'],
-            screenshots=[upload_asset(path(s)) for s in x['screenshots']],
+            screenshots=[upload_image(path(s), 'screenshot', platform=x['name']) for s in x['screenshots']],
             headers = [header_asset] if header_asset else [],
             banner = None
         ) for x in params['assets']},
@@ -531,8 +955,8 @@ def new_app(conf):
         developer = developer,
         hearts = 0,
         releases = [],
-        icon_large = upload_asset(path(params['large_icon'])),
-        icon_small = upload_asset(path(params['small_icon'])) if 'small_icon' in params else '',
+        icon_large = upload_image(path(params['large_icon']), 'large_icon', app_type=params['type']),
+        icon_small = upload_image(path(params['small_icon']), 'small_icon') if 'small_icon' in params else '',
         source = params['source'],
         title = params['title'],
         type = params['type'],
@@ -542,7 +966,7 @@ def new_app(conf):
     db.session.add(app_obj)
     print(f"Created app {app_obj.id}")
     
-    release = release_from_pbw(app_obj, path(pbw_file),
+    release = release_from_pbw(app_obj, bundle,
                                release_notes = params['release_notes'],
                                published_date = datetime.datetime.utcnow(),
                                version = appinfo['versionLabel'],
@@ -564,12 +988,12 @@ def update_app(appid, conf):
         return f"{os.path.dirname(conf)}/{base}"
 
     pbw_file = params['pbw_file']
-    pbw = PBW(path(pbw_file), 'aplite')
-    with pbw.zip.open('appinfo.json') as f:
+    bundle = PBWBundle(path(pbw_file))
+    with bundle.zip.open('appinfo.json') as f:
         appinfo = json.load(f)
     
     if 'header' in params:
-        header_asset = upload_asset(path(params['header']))
+        header_asset = upload_image(path(params['header']), 'banner')
     else:
         header_asset = None
 
@@ -581,18 +1005,18 @@ def update_app(appid, conf):
         x['name']: AssetCollection(
             platform=x['name'],
             description=params['description'],
-            screenshots=[upload_asset(path(s)) for s in x['screenshots']],
+            screenshots=[upload_image(path(s), 'screenshot', platform=x['name']) for s in x['screenshots']],
             headers = [header_asset] if header_asset else [],
             banner = None
         ) for x in params['assets'] }
-    app_obj.icon_large = upload_asset(path(params['large_icon'])),
-    app_obj.icon_small = upload_asset(path(params['small_icon'])) if 'small_icon' in params else '',
+    app_obj.icon_large = upload_image(path(params['large_icon']), 'large_icon', app_type=app_obj.type),
+    app_obj.icon_small = upload_image(path(params['small_icon']), 'small_icon') if 'small_icon' in params else '',
     app_obj.source = params['source'],
     app_obj.title = params['title'],
     app_obj.website = params['website']
     print(f"Updated app {app_obj.id}")
     
-    release = release_from_pbw(app_obj, path(pbw_file),
+    release = release_from_pbw(app_obj, bundle,
                                release_notes = params['release_notes'],
                                published_date = datetime.datetime.utcnow(),
                                version = appinfo['versionLabel'],
@@ -607,192 +1031,204 @@ def update_app(appid, conf):
         else:
             algolia_index.delete_objects([app_obj.id])
 
-def export_archive_to_zip(fn, test_only=False, n_threads=20):
-    # test-only: only output a few files, so you can run this without a fast
-    # connection to gcs
-    assets = set()
-    binaries = set()
-    
-    def _mk_release(rel):
-        binaries.add(rel.id)
-
-        return {
-            'has_pbw': rel.has_pbw,
-            'binaries': { plat: {
-                'sdk_major': b.sdk_major,
-                'sdk_minor': b.sdk_minor,
-                'process_info_flags': b.process_info_flags,
-                'icon_resource_id': b.icon_resource_id,
-            } for plat,b in rel.binaries.items() },
-            'capabilities': rel.capabilities,
-            'js_md5': rel.js_md5,
-            'published_date': rel.published_date.timestamp() if rel.published_date else None,
-            'release_notes': rel.release_notes,
-            'version': rel.version,
-            'compatibility': rel.compatibility,
-        }
-    
-    def _mk_asset_collection(ass):
-        for img in ass.headers:
-            assets.add(img)
-        assets.add(ass.banner)
-
-        return {
-            'description': ass.description,
-            'screenshots': ass.screenshots,
-            'headers': ass.headers,
-            'banner': ass.banner,
-        }
-    
-    def _mk_app(app):
-        if _mk_app.n % 1000 == 0:
-            print(f"... {_mk_app.n} / {_mk_app.ntotal} ...")
-        _mk_app.n += 1
-        assets.add(app.icon_large)
-        assets.add(app.icon_small)
-        return {
-            'uuid': app.app_uuid,
-            'asset_collections': { plat: _mk_asset_collection(ass) for plat,ass in app.asset_collections.items() },
-            'category_id': app.category_id,
-            'companion_apps': { plat:
-                {
-                    'icon': c.icon,
-                    'url': c.url,
-                    'name': c.name,
-                    'pebblekit3': c.pebblekit3,
-                } for plat,c in app.companions.items() },
-            'collection_ids': [ c.id for c in app.collections ],
-            'created_at': app.created_at.timestamp() if app.created_at else None,
-            'developer_id': app.developer_id,
-            'hearts': app.hearts,
-            'releases': { rel.id: _mk_release(rel) for rel in app.releases if rel.is_published },
-            'icon_large': app.icon_large,
-            'icon_small': app.icon_small,
-            'published_date': app.published_date.timestamp() if app.published_date else None,
-            'source': app.source,
-            'title': app.title,
-            'timeline_enabled': app.timeline_enabled,
-            'type': app.type,
-            'website': app.website,
-        }
-    _mk_app.n = 0
-
-    with zipfile.ZipFile(fn, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
-        with zf.open("metadata/apps.json", 'w') as appsf:
-            print(f"Querying apps...")
-            _mk_app.ntotal = App.query.filter(App.visible == True).count()
-            apps = { app.id: _mk_app(app) for app in App.query.filter(App.visible == True).yield_per(1000) if app.visible }
-            print(f"Exporting apps.json...")
-            json.dump(apps, io.TextIOWrapper(appsf))
-        
-        with zf.open("metadata/categories.json", 'w') as categoriesf:
-            print(f"Exporting categories.json...")
-            categories = {
-                c.id: {
-                    'name': c.name,
-                    'slug': c.slug,
-                    'colour': c.colour,
-                    'icon': c.icon,
-                    'app_type': c.app_type,
-                    'banner_apps': [ app.id for app in c.banner_apps],
-                } for c in Category.query.filter(Category.is_visible == True)
-            }
-            json.dump(categories, io.TextIOWrapper(categoriesf))
-        
-        with zf.open("metadata/collections.json", 'w') as collectionsf:
-            print(f"Exporting collections.json...")
-            collections = {
-                c.id: {
-                    'name': c.name,
-                    'slug': c.slug,
-                    'app_type': c.app_type,
-                    'platforms': c.platforms,
-                } for c in Collection.query
-            }
-            json.dump(collections, io.TextIOWrapper(collectionsf))
-        
-        with zf.open("metadata/developers.json", 'w') as developersf:
-            print(f"Exporting developers.json...")
-            developers = {
-                d.id: d.name
-                for d in Developer.query
-            }
-            
-            # XXX: at some point it might be nice to also provide a Rebble
-            # user ID for a developer?  though I guess also developers who
-            # want to provide this to a user of the archive to verify
-            # themselves could just as well give a user oauth creds to
-            # verify their developer_id
-            json.dump(developers, io.TextIOWrapper(developersf))
-        
-        zip_targets = Queue()
-        downloads_failed = {}
-
-        for ass in assets:
-            if ass == "" or ass is None:
-                continue
-            zip_targets.put((f"assets/{ass[0]}/{ass[1]}/{ass}", functools.partial(download_asset, ass)))
-        
-        for pbw in binaries:
-            if pbw == "" or pbw is None:
-                continue
-            zip_targets.put((f"binaries/{pbw[0]}/{pbw[1]}/{pbw}.pbw", functools.partial(download_pbw, pbw)))
-        
-        n = 0
-        zip_lock = Lock()
-        def download_thread():
-            nonlocal n, downloads_failed, zip_targets
-            while True:
-                try:
-                    fname, download = zip_targets.get_nowait()
-                except Empty:
-                    return
-
-                try:
-                    if test_only and n > 50:
-                        raise TimeoutError()
-                    buf = io.BytesIO()
-                    download(buf)
-                    with zip_lock, zf.open(fname, 'w') as zff:
-                        zff.write(buf.getbuffer())
-                    buf.close()
-                except Exception as e:
-                    downloads_failed[fname] = repr(e)
-
-                if (n % 100) == 0:
-                    print(f"... {n} done, {zip_targets.qsize()} to go ...")
-                n += 1
-                
-                zip_targets.task_done()
-        
-        for i in range(n_threads):
-            Thread(target=download_thread).start()
-        zip_targets.join()
-        
-        with zf.open("metadata/failed_downloads.json", "w") as failedf:
-            json.dump(downloads_failed, io.TextIOWrapper(failedf))
-
-        with open(f"{os.path.dirname(__file__)}/ARCHIVE_LICENSE", "rb") as rf, zf.open("LICENSE.txt", "w") as wf:
-            wf.write(rf.read())
-
 @apps.command('export-archive')
 @click.option('--upload', is_flag=True)
 @click.option('--output')
 @click.option('--test', is_flag=True) # only dump 100 binaries of each type
-def export_archive(output, upload, test):
+@click.option('--delta', is_flag=True, help="Only include the assets and PBWs that aren't already in the latest archive or its deltas")
+@click.option('--resume', is_flag=True, help="Carry on from where an interrupted export to the same --output left off")
+def export_archive(output, upload, test, delta, resume):
     print(f"Preparing to export archive...")
+    if output:
+        # Progress is checkpointed next to the archive, for --resume.
+        state_path = f"{output}.state"
+    elif resume:
+        raise click.ClickException("--resume needs the --output of the export to resume")
+    else:
+        output = tempfile.TemporaryFile()
+        state_path = None
+    now = datetime.datetime.now()
+
+    chain = latest_archive_chain() if delta else []
+    previous_manifest = download_archive_manifest(chain[-1].filename) if chain else None
+    if delta and previous_manifest is None:
+        print("No earlier archive with a manifest to build on; exporting a full archive instead.")
+
+    if previous_manifest is not None:
+        filename = f"appstore-archive-{now:%Y%m%d%H%M%S}-delta.zip"
+        description = {'kind': 'delta', 'base': previous_manifest['base'], 'previous': previous_manifest['archives']}
+        packed = export_archive_to_zip(output, test_only=test, previous=previous_manifest['contents'], description=description,
+                                       state_path=state_path, resume=resume)
+    else:
+        filename = f"appstore-archive-{now.year:04d}{now.month:02d}.zip"
+        packed = export_archive_to_zip(output, test_only=test, description={'kind': 'full'},
+                                       state_path=state_path, resume=resume)
+
+    if upload:
+        print(f"uploading to {filename}")
+        upload_archive(filename, output)
+        upload_archive_manifest(filename, archive_manifest(filename, packed, previous_manifest))
+        db.session.add(AvailableArchive(filename=filename, created_at=now,
+                                        base_id=chain[0].id if previous_manifest is not None else None))
+        db.session.commit()
+    if state_path:
+        os.unlink(state_path)
+
+
+@apps.command('consolidate-archive')
+@click.option('--upload', is_flag=True)
+@click.option('--output')
+@click.option('--workdir', help="Where to download the archives being consolidated (default: a temporary directory)")
+def consolidate_archive(output, upload, workdir):
+    """
+    Build a full archive out of the latest full archive and its deltas, so
+    that only assets and PBWs added since the last delta are downloaded.
+    """
+    chain = latest_archive_chain()
+    if len(chain) < 2:
+        print("The latest archive is already a full one; nothing to consolidate.")
+        return
+    manifest = download_archive_manifest(chain[-1].filename)
+    if manifest is None:
+        raise click.ClickException(f"{chain[-1].filename} has no manifest")
     if not output:
         output = tempfile.TemporaryFile()
-    export_archive_to_zip(output, test_only=test)
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        local_archives = {}
+        for filename in manifest['archives']:
+            print(f"Downloading {filename}...")
+            local_archives[filename] = os.path.join(tmpdir, filename)
+            with open(local_archives[filename], 'wb') as f:
+                download_archive(filename, f)
+        packed = consolidate_archive_to_zip(output, manifest, local_archives)
+
     if upload:
         now = datetime.datetime.now()
-        filename = f"appstore-archive-{now.year:04d}{now.month:02d}.zip"
+        # Not the usual monthly name, which the base may well already have.
+        filename = f"appstore-archive-{now:%Y%m%d%H%M%S}.zip"
         print(f"uploading to {filename}")
         upload_archive(filename, output)
-        db.session.add(AvailableArchive(filename=filename, created_at=datetime.datetime.now()))
+        upload_archive_manifest(filename, archive_manifest(filename, packed))
+        db.session.add(AvailableArchive(filename=filename, created_at=now))
         db.session.commit()
 
 
+def _hot_paths(hw, app_type, user_id):
+    plural = f"{app_type}s"
+    collection = Collection.query.filter_by(app_type=app_type).first()
+    if user_id is None:
+        # Whoever has the biggest locker makes for the worst case.
+        user_id = (db.session.query(LockerEntry.user_id)
+                   .group_by(LockerEntry.user_id)
+                   .order_by(db.func.count().desc())
+                   .limit(1)
+                   .scalar())
+
+    def in_request(path, fn):
+        def run():
+            with current_app.test_request_context(f"/api/v1/{path}?hardware={hw}"):
+                fn()
+        return run
+
+    paths = [
+        (f"home/{plural}", in_request(f"home/{plural}", lambda: home(plural))),
+        *((f"collection/{slug}/{plural}", in_request(f"apps/collection/{slug}/{plural}", lambda slug=slug: apps_by_collection(slug, plural)))
+          for slug in ['all', 'most-loved', 'recently-updated', *([collection.slug] if collection else [])]),
+        ("hw_compat", lambda: App.query.filter(global_filter(hw)).distinct().limit(20).all()),
+        ("sitemap/visible_apps", lambda: sitemap.visible_apps().all()),
+        ("sitemap/base_paths", sitemap.base_paths),
+    ]
+    if user_id is not None:
+        paths.append((f"locker ({user_id})", in_request("locker", lambda: [jsonify_locker_app(x) for x in locker_entries(user_id) if x.app is not None])))
+    return paths
+
+@apps.command('explain-hot-paths')
+@click.option('--hardware', default='basalt')
+@click.option('--type', 'app_type', type=click.Choice(['watchapp', 'watchface']), default='watchface')
+@click.option('--user', 'user_id', type=int, default=None, help='Locker to load (default: the biggest one).')
+@click.option('--verbose', is_flag=True, help='Print whole plans, not only the interesting nodes.')
+def explain_hot_paths(hardware, app_type, user_id, verbose):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) the queries behind the busiest routes and the
+    daily jobs, against whatever database we are configured with.
+    """
+    scans = collections.Counter()
+    try:
+        for label, fn in _hot_paths(hardware, app_type, user_id):
+            for statement, parameters, count in capture_statements(fn):
+                plan = explain_statement(statement, parameters)
+                print_plan_summary(label, statement, count, plan, verbose)
+                scans.update(node['Relation Name'] for node in seq_scans(plan))
+        # ANALYZE really does the update, so this has to be rolled back.
+        statement, parameters = compiled_statement(App.recent_hearts_update())
+        plan = explain_statement(statement, parameters)
+        print_plan_summary("daily-hearts", statement, 1, plan, verbose)
+        scans.update(node['Relation Name'] for node in seq_scans(plan))
+    finally:
+        db.session.rollback()
+
+    print("Sequential scans: " + (", ".join(f"{relation} x{n}" for relation, n in scans.most_common()) or "none"))
+
+
+@apps.command('bench-seed')
+@click.option('--developers', type=int, default=200)
+@click.option('--apps-per-developer', type=int, default=10)
+@click.option('--users', type=int, default=2000)
+@click.option('--seed', type=int, default=1337)
+def bench_seed(developers, apps_per_developer, users, seed):
+    """
+    Fill an empty database with a made-up appstore for bench-api.
+    """
+    if db.session.query(App.id).first() is not None:
+        raise click.ClickException("There are apps in this database already; bench-seed only fills an empty one.")
+    start = time.time()
+    counts = generate_dataset(developers, apps_per_developer, users, seed)
+    print(", ".join(f"{n} {table}" for table, n in counts.items()))
+    print(f"Done in {time.time() - start:.1f}s")
+
+
+@apps.command('bench-api')
+@click.option('--iterations', type=int, default=100)
+@click.option('--warmup', type=int, default=10)
+@click.option('--hardware', default='basalt')
+@click.option('--sample-size', type=int, default=20, help='How many apps and pages to spread requests over.')
+@click.option('--seed', type=int, default=1337)
+@click.option('--user', 'user_id', type=int, default=None, help='Locker to load (default: the biggest one).')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON report.')
+def bench_api(iterations, warmup, hardware, sample_size, seed, user_id, output):
+    """
+    Time the public API through the test client, and report latency, SQL
+    statements and memory per route as JSON.
+    """
+    if user_id is None:
+        user_id = (db.session.query(LockerEntry.user_id)
+                   .group_by(LockerEntry.user_id)
+                   .order_by(db.func.count().desc())
+                   .limit(1)
+                   .scalar())
+    routes = benchmark_routes(hardware, sample_size, seed)
+    results = run_benchmark(routes, iterations, warmup, user_id)
+    for name, result in results.items():
+        print(f"{name:>16}: p50 {result['latency_ms']['p50']:.2f} ms, p95 {result['latency_ms']['p95']:.2f} ms, "
+              f"{result['sql_queries']['p50']} queries, peak {result['peak_alloc_kib']['p50']:.0f} KiB"
+              + (f", {result['errors']} errors" if result['errors'] else ''), file=sys.stderr)
+    write_report(benchmark_report(results, iterations=iterations, warmup=warmup, hardware=hardware,
+                                  sample_size=sample_size, seed=seed, locker_user=user_id), output)
+
+
+@apps.command('bench-compare')
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+def bench_compare(old, new):
+    """
+    Compare two bench-api reports.
+    """
+    for route, metric, before, after in compare_reports(json.load(old), json.load(new)):
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{route:>16} {metric:<20} {before:>10} -> {after:<10} {change}")
+
+
 @apps.command('random-weekly')
 def random_weekly():
     App.generate_random_weekly()
@@ -0,0 +1,165 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageSequence
+
+from .s3 import upload_asset, download_asset, asset_exists
+from .settings import config
+from .utils import plat_dimensions
+
+ASSET_KINDS = ('screenshot', 'banner', 'large_icon', 'small_icon')
+
+def derivative_sizes(kind, platform=None, app_type=None):
+    """
+    The (width, height, exact) sizes that generate_image_url asks the image
+    host for, for each kind of asset.
+    """
+    if kind == 'screenshot':
+        # The legacy API asks for 144x168 whatever the platform.  Each
+        # binary's platform list (jsonify_hardware_platforms) asks for
+        # whichever screenshot asset_fallback lands on, fitted into that
+        # platform's size; the last resort fallback can land anywhere, so
+        # that could be any platform's size.
+        exact = {plat_dimensions[platform], (144, 168)}
+        fitted = set(plat_dimensions.values())
+        return [(w, h, True) for w, h in sorted(exact)] + [(w, h, False) for w, h in sorted(fitted)]
+    elif kind == 'banner':
+        return [(720, 320, False)]
+    elif kind == 'large_icon':
+        sizes = {(80, 80), (144, 144)}
+        if app_type == 'watchface':
+            # Watchfaces use their large icon as the list image on every platform.
+            sizes |= set(plat_dimensions.values())
+    elif kind == 'small_icon':
+        sizes = {(28, 28), (48, 48)}
+    else:
+        raise ValueError(f"Unknown asset kind {kind}")
+    return [(w, h, True) for w, h in sorted(sizes)]
+
+def derivative_path(width, height, exact):
+    # Mirrors the URL generate_image_url builds, so that IMAGE_ROOT/exact/WxH/<id>
+    # maps straight onto S3_DERIVATIVE_PATH/exact/WxH/<id>.
+    return f"{config['S3_DERIVATIVE_PATH']}{'exact/' if exact else ''}{width}x{height}/"
+
+def _resize(frame, width, height, exact):
+    if exact:
+        return frame.resize((width, height), resample=Image.LANCZOS)
+    frame = frame.copy()
+    frame.thumbnail((width, height), resample=Image.LANCZOS)
+    return frame
+
+def render_derivatives(data, sizes):
+    """
+    Decode `data` once and produce each of `sizes` from it, in the source's
+    own format.  Animated GIFs keep all of their frames.  Returns the mime
+    type and a dict of size to encoded bytes.
+    """
+    source = Image.open(io.BytesIO(data))
+    fmt = source.format
+    mode = 'RGB' if fmt == 'JPEG' else 'RGBA'
+    durations = []
+    frames = []
+    for frame in ImageSequence.Iterator(source):
+        durations.append(frame.info.get('duration', 100))
+        frames.append(frame.convert(mode))
+
+    output = {}
+    for width, height, exact in sizes:
+        resized = [_resize(frame, width, height, exact) for frame in frames]
+        buffer = io.BytesIO()
+        if len(resized) > 1:
+            resized[0].save(buffer, format=fmt, save_all=True, append_images=resized[1:],
+                            duration=durations, loop=source.info.get('loop', 0))
+        else:
+            resized[0].save(buffer, format=fmt)
+        output[width, height, exact] = buffer.getvalue()
+
+    return Image.MIME[fmt], output
+
+def generate_derivatives(id, kind, data=None, platform=None, app_type=None, force=True):
+    sizes = derivative_sizes(kind, platform, app_type)
+    if not force:
+        sizes = [size for size in sizes if not asset_exists(id, derivative_path(*size))]
+    if not sizes:
+        return []
+
+    if data is None:
+        buffer = io.BytesIO()
+        download_asset(id, buffer)
+        data = buffer.getvalue()
+
+    mime_type, derivatives = render_derivatives(data, sizes)
+    for size, encoded in derivatives.items():
+        buffer = io.BytesIO(encoded)
+        # HACK: upload_asset puts this in a print, which is only really valid for actual Files...
+        setattr(buffer, 'name', f"{id} at {size[0]}x{size[1]}")
+        upload_asset(buffer, mime_type, path=derivative_path(*size), id=id)
+    return sizes
+
+def _generate_logged(id, kind, data, platform, app_type):
+    try:
+        return generate_derivatives(id, kind, data, platform, app_type)
+    except Exception as e:
+        # The image host still resizes on a miss, and apps backfill-derivatives
+        # will pick it up later, so this is not worth failing an upload over.
+        print(f"Failed to generate derivatives for {kind} {id}: {e}")
+        return []
+
+def app_derivative_jobs(app):
+    """
+    (asset id, kind, platform, app type) for every image `app` has.
+    """
+    jobs = []
+    if app.icon_large:
+        jobs.append((app.icon_large, 'large_icon', None, app.type))
+    if app.icon_small:
+        jobs.append((app.icon_small, 'small_icon', None, None))
+    banners = set()
+    for platform, collection in app.asset_collections.items():
+        jobs.extend((screenshot, 'screenshot', platform, None) for screenshot in collection.screenshots)
+        banners.update(collection.headers)
+    jobs.extend((banner, 'banner', None, None) for banner in sorted(banners))
+    return jobs
+
+def fill_missing_derivatives(jobs):
+    # For the preview worker: only what isn't there yet, and one bad image
+    # doesn't stop the rest.
+    generated = 0
+    for id, kind, platform, app_type in jobs:
+        try:
+            generated += len(generate_derivatives(id, kind, platform=platform, app_type=app_type, force=False))
+        except Exception as e:
+            print(f"Failed to generate derivatives for {kind} {id}: {e}")
+    return generated
+
+_pool = None
+
+def queue_derivatives(id, kind, data, platform=None, app_type=None):
+    global _pool
+    if config['IMAGE_DERIVATIVE_WORKERS'] == 0:
+        if config['QUEUE_WORKERS'] == 'external':
+            # On Lambda nothing is guaranteed to run once the response is
+            # sent, and there can be dozens of screenshots to do.  Every
+            # upload also queues the app's preview, and the preview worker
+            # fills in whatever derivatives are missing.
+            return []
+        return _generate_logged(id, kind, data, platform, app_type)
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=config['IMAGE_DERIVATIVE_WORKERS'], thread_name_prefix='derivatives')
+    return _pool.submit(_generate_logged, id, kind, data, platform, app_type)
+
+def upload_image(file, kind, mime_type=None, platform=None, app_type=None):
+    """
+    upload_asset() for screenshots, banners and icons: also queues up every
+    size the store will ask for.
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            data = f.read()
+    else:
+        file.seek(0)
+        data = file.read()
+        file.seek(0)
+    id = upload_asset(file, mime_type)
+    queue_derivatives(id, kind, data, platform=platform, app_type=app_type)
+    return id
@@ -9,6 +9,7 @@ from datetime import datetime
 from .utils import demand_authed_request, get_uid
 from .models import LockerEntry, UserLike, db, App, Developer, UserFlag
 from .discord import report_app_flag
+from .replicas import use_primary
 from .settings import config
 
 parent_app = None
@@ -23,6 +24,7 @@ else:
 
 
 @legacy_api.route('/users/me')
+@use_primary
 def me():
     result = demand_authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me/pebble/appstore")
     me = result.json()
@@ -45,6 +47,7 @@ def me():
 
 
 @legacy_api.route('/users/me/developer', methods=['GET'])
+@use_primary
 def my_apps():
     result = demand_authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me/pebble/appstore")
     me = result.json()
@@ -159,8 +162,9 @@ def add_flag(app_id):
         app = App.query.filter_by(id=app_id).one()
         flag = UserFlag(user_id=uid, app_id=app_id)
         db.session.add(flag)
-        db.session.commit()
+        # Queued along with the flag, so a repeat flag doesn't report twice.
         report_app_flag(uid, app.title, app.developer.name, app_id, app.app_uuid)
+        db.session.commit()
     except NoResultFound:
         abort(404)
         return
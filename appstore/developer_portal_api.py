@@ -1,4 +1,3 @@
-import json
 import datetime
 import secrets
 
@@ -10,15 +9,18 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest
 from sqlalchemy.exc import DataError
-from zipfile import BadZipFile
 
-from .utils import demand_authed_request, id_generator, validate_new_app_fields, is_valid_category, is_valid_appinfo, is_valid_platform, clone_asset_collection_without_images, is_valid_image_file, is_valid_image_size, get_max_image_dimensions, is_users_developer_id, user_is_wizard, newAppValidationException, algolia_app, first_version_is_newer, get_uid
+from .utils import demand_authed_request, id_generator, validate_new_app_fields, is_valid_category, is_valid_appinfo, is_valid_platform, clone_asset_collection_without_images, probe_image, is_permitted_image, has_image_dimensions, get_max_image_dimensions, is_users_developer_id, user_is_wizard, newAppValidationException, algolia_app, first_version_is_newer, get_uid
 from .models import db, App, Developer, Release, AssetCollection, AvailableArchive
-from .pbw import PBW, release_from_pbw
-from .s3 import upload_pbw, upload_asset, get_link_for_archive
+from .pbw import release_from_metadata
+from .pbw_validator import validate_pbw_isolated
+from .s3 import upload_pbw, get_link_for_archive
+from .derivatives import upload_image
+from .preview_queue import ensure_preview, invalidate_preview
+from .replicas import use_primary
 from .settings import config
 from .discord import audit_log
-from .discourse import get_topic_url_for_app, is_valid_topic_url, user_owns_discourse_topic, topic_url_to_id
+from .discourse import get_topic_url_for_app, is_valid_topic_url, user_owns_discourse_topic, topic_url_to_id, DiscourseUnavailable
 from . import discord, discourse
 
 parent_app = None
@@ -93,15 +95,16 @@ def submit_new_app():
             "gabbro": [],
         }
 
-        try:
-            pbw_file = request.files['pbw'].read()
-            pbw = PBW(pbw_file, 'aplite')
-            with pbw.zip.open('appinfo.json') as f:
-                appinfo = json.load(f)
-        except BadZipFile as e:
-            return jsonify(error="Your pbw file is corrupt or invalid", e="invalid.pbw"), 400
-        except KeyError as e:
-            return jsonify(error="Your pbw file is invalid or corrupt", e="invalid.pbw"), 400
+        # This runs out of process, so a huge or malicious pbw can't tie up
+        # this worker.
+        pbw_file = request.files['pbw'].read()
+        validation = validate_pbw_isolated(pbw_file)
+        if not validation['valid']:
+            error = validation['errors'][0]
+            return jsonify(error=error['error'], e=error['e'], errors=validation['errors']), 400
+
+        appinfo = validation['appinfo']
+        metadata = validation['metadata']
 
 
         appinfo_valid, appinfo_validation_error = is_valid_appinfo(appinfo)
@@ -136,7 +139,7 @@ def submit_new_app():
 
         # Upload banner if present
         if "banner" in request.files:
-            header_asset = upload_asset(request.files["banner"], request.files["banner"].content_type)
+            header_asset = upload_image(request.files["banner"], 'banner', request.files["banner"].content_type)
         else:
             header_asset = None
 
@@ -171,7 +174,7 @@ def submit_new_app():
             asset_collections={x: AssetCollection(
                 platform=x,
                 description=params['description'],
-                screenshots=[upload_asset(s, s.content_type) for s in screenshots[x]],
+                screenshots=[upload_image(s, 'screenshot', s.content_type, platform=x) for s in screenshots[x]],
                 headers=[header_asset] if header_asset else [],
                 banner=None
             ) for x in screenshots},
@@ -183,8 +186,8 @@ def submit_new_app():
             discourse_topic_id=0,
             hearts=0,
             releases=[],
-            icon_large=upload_asset(request.files['large_icon'], request.files["large_icon"].content_type),
-            icon_small=upload_asset(request.files['small_icon'], request.files["small_icon"].content_type) if 'small_icon' in request.files else '',
+            icon_large=upload_image(request.files['large_icon'], 'large_icon', request.files["large_icon"].content_type, app_type=params['type']),
+            icon_small=upload_image(request.files['small_icon'], 'small_icon', request.files["small_icon"].content_type) if 'small_icon' in request.files else '',
             source=params['source'] if 'source' in params else "",
             title=params['title'],
             type=params['type'],
@@ -195,12 +198,13 @@ def submit_new_app():
         )
         db.session.add(app_obj)
         print(f"Created app {app_obj.id}")
+        ensure_preview(app_obj)
 
-        release = release_from_pbw(app_obj, pbw_file,
-                                   release_notes=params['release_notes'],
-                                   published_date=datetime.datetime.utcnow(),
-                                   version=appinfo['versionLabel'],
-                                   compatibility=appinfo.get('targetPlatforms', ['aplite']))
+        release = release_from_metadata(app_obj, metadata,
+                                        release_notes=params['release_notes'],
+                                        published_date=datetime.datetime.utcnow(),
+                                        version=appinfo['versionLabel'],
+                                        compatibility=appinfo.get('targetPlatforms', ['aplite']))
         print(f"Created release {release.id}")
         upload_pbw(release, request.files['pbw'])
         db.session.commit()
@@ -210,22 +214,24 @@ def submit_new_app():
 
         if is_visible:
             try:
-                discourse.announce_new_app(app_obj, pbw.is_generated())
+                discourse.announce_new_app(app_obj, metadata['is_generated'])
             except Exception as e:
                 # We don't want to fail just because Discourse is being weird
                 print(f"Discourse is being weird: {repr(e)}")
 
             try:
-                discord.announce_new_app(app_obj, pbw.is_generated())
+                discord.announce_new_app(app_obj, metadata['is_generated'])
             except Exception as e:
                 # We don't want to fail just because Discord is being weird
                 print(f"Discord is being weird: {repr(e)}")
         else:
             try:
-                discord.announce_new_app(app_obj, pbw.is_generated(), True)
+                discord.announce_new_app(app_obj, metadata['is_generated'], True)
             except Exception as e:
                 # We don't want to fail just because Discord is being weird
                 print(f"Discord is being weird: {repr(e)}")
+        # The Discord announcements are queued, for apps discord-worker.
+        db.session.commit()
 
         return jsonify(success=True, id=app_obj.id)
 
@@ -291,6 +297,10 @@ def update_app_fields(app_id):
             for x in app.asset_collections:
                 app.asset_collections[x].description = req["description"]
 
+        # The title is drawn into the preview.
+        if "title" in req:
+            invalidate_preview(app)
+
         db.session.commit()
         if algolia_index:
             if app.visible:
@@ -322,14 +332,13 @@ def submit_new_release(app_id):
 
     pbw_file = request.files['pbw'].read()
 
-    try:
-        pbw = PBW(pbw_file, 'aplite')
-        with pbw.zip.open('appinfo.json') as f:
-            appinfo = json.load(f)
-    except BadZipFile:
-        return jsonify(error="Your pbw file is invalid or corrupted", e="invalid.pbw"), 400
-    except KeyError:
-        return jsonify(error="Your pbw file is invalid or corrupted", e="invalid.pbw"), 400
+    validation = validate_pbw_isolated(pbw_file)
+    if not validation['valid']:
+        error = validation['errors'][0]
+        return jsonify(error=error['error'], e=error['e'], errors=validation['errors']), 400
+
+    appinfo = validation['appinfo']
+    metadata = validation['metadata']
 
     appinfo_valid, appinfo_valid_reason = is_valid_appinfo(appinfo)
     if not appinfo_valid:
@@ -350,28 +359,31 @@ def submit_new_release(app_id):
             message="The app version in appinfo.json is not greater than the latest release on the store. Please increment versionLabel in your appinfo.json and try again."
             ), 400
 
-    release_new = release_from_pbw(app, pbw_file,
-                                   release_notes=data["release_notes"],
-                                   published_date=datetime.datetime.utcnow(),
-                                   version=version,
-                                   compatibility=appinfo.get('targetPlatforms', ['aplite']))
+    release_new = release_from_metadata(app, metadata,
+                                        release_notes=data["release_notes"],
+                                        published_date=datetime.datetime.utcnow(),
+                                        version=version,
+                                        compatibility=appinfo.get('targetPlatforms', ['aplite']))
 
     upload_pbw(release_new, request.files['pbw'])
     App.query.filter_by(id=app_id).update({'updated_at': datetime.datetime.utcnow()})
+    ensure_preview(app)
     db.session.commit()
 
     if app.visible:
         try:
-            discord.announce_release(app, release_new, pbw.is_generated())
+            discord.announce_release(app, release_new, metadata['is_generated'])
         except Exception as e:
             # We don't want to fail just because Discord webhook is being weird
             print(f"Discord is being weird: {repr(e)}")
 
         try:
-            discourse.announce_release(app, release_new, pbw.is_generated())
+            discourse.announce_release(app, release_new, metadata['is_generated'])
         except Exception as e:
             # We don't want to fail just because Discourse webhook is being weird
             print(f"Discourse is being weird: {repr(e)}")
+        # The Discord announcement is queued, for apps discord-worker.
+        db.session.commit()
 
     return jsonify(success=True)
 
@@ -425,6 +437,7 @@ def set_app_visbility(app_id):
 
 
 @devportal_api.route('/app/<app_id>/timeline_token')
+@use_primary
 def apps_timeline_token(app_id):
     try:
         app = App.query.filter(App.id == app_id).one()
@@ -448,6 +461,7 @@ def missing_platform(app_id):
     return jsonify(error="Missing platform", e="platform.missing", message="Use /app/<id>/screenshots/<platform>"), 400
 
 @devportal_api.route('/app/<app_id>/screenshots/<platform>', methods=['GET'])
+@use_primary
 def get_app_screenshots(app_id, platform):
     # Check app exists
 
@@ -489,11 +503,12 @@ def new_app_screenshots(app_id, platform):
         return jsonify(error="Missing file: screenshot", e="screenshot.missing"), 400
 
     # Check it's a valid image file
-    if not is_valid_image_file(new_image):
+    image = probe_image(new_image)
+    if not is_permitted_image(image):
         return jsonify(error="Illegal image type", e="screenshots.illegalvalue"), 400
 
     # Check it's the correct size
-    if not is_valid_image_size(new_image, f"screenshot_{platform}"):
+    if not has_image_dimensions(image, f"screenshot_{platform}"):
         max_w, max_h = get_max_image_dimensions(f"screenshot_{platform}")
         return jsonify(error="Invalid image size", e="screenshots.illegaldimensions", message=f"Image should be {max_w}x{max_h}"), 400
 
@@ -506,12 +521,12 @@ def new_app_screenshots(app_id, platform):
             return jsonify(error="Maximum number of screenshots for platform", e="screenshot.full", message="There are already the maximum number of screenshots allowed for this platform. Delete one and try again"), 409
 
     screenshots = list(asset_collection.screenshots)
-    new_image_id = upload_asset(new_image, new_image.content_type)
+    new_image_id = upload_image(new_image, 'screenshot', new_image.content_type, platform=platform)
     screenshots.append(new_image_id)
     asset_collection.screenshots = screenshots
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
     db.session.commit()
 
     return jsonify(success=True, id=new_image_id, platform=platform)
@@ -549,7 +564,7 @@ def delete_screenshot(app_id, platform, screenshot_id):
     asset_collection.screenshots = list(filter(lambda x: x != screenshot_id, asset_collection.screenshots))
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
 
     db.session.commit()
     return jsonify(success=True, message=f"Deleted screenshot {screenshot_id}", id=screenshot_id, platform=platform)
@@ -595,11 +610,12 @@ def move_screenshot(app_id, platform):
     asset_collection.screenshots = req["order"]
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
 
     db.session.commit()
     return jsonify(success=True, message=f"Updated screenshot order", platform=platform)
 @devportal_api.route('/app/<app_id>/banners/<platform>', methods=['GET'])
+@use_primary
 def get_app_banners(app_id, platform):
     # Check app exists
 
@@ -641,11 +657,12 @@ def new_app_banner(app_id, platform):
         return jsonify(error="Missing file: banner", e="banner.missing"), 400
 
     # Check it's a valid image file
-    if not is_valid_image_file(new_image):
+    image = probe_image(new_image)
+    if not is_permitted_image(image):
         return jsonify(error="Illegal image type", e="banner.illegalvalue"), 400
 
     # Check it's the correct size
-    if not is_valid_image_size(new_image, "banner"):
+    if not has_image_dimensions(image, "banner"):
         max_w, max_h = get_max_image_dimensions("banner")
         return jsonify(error="Invalid image size", e="banner.illegaldimensions", message=f"Image should be {max_w}x{max_h}"), 400
 
@@ -659,12 +676,12 @@ def new_app_banner(app_id, platform):
             return jsonify(error="Maximum number of banners for platform", e="banners.full", message="There are already the maximum number of banners allowed for this platform. Delete one and try again"), 409
 
     headers = list(asset_collection.headers)
-    new_image_id = upload_asset(new_image, new_image.content_type)
+    new_image_id = upload_image(new_image, 'banner', new_image.content_type)
     headers.append(new_image_id)
     asset_collection.headers = headers
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
 
     db.session.commit()
 
@@ -703,12 +720,13 @@ def delete_banner(app_id, platform, banner_id):
     asset_collection.headers = list(filter(lambda x: x != banner_id, asset_collection.headers))
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
 
     db.session.commit()
     return jsonify(success=True, message=f"Deleted banner {banner_id}", id=banner_id, platform=platform)
 
 @devportal_api.route('/app/<app_id>/icons', methods=['GET'])
+@use_primary
 def get_app_icons(app_id):
     try:
         app = App.query.filter(App.id == app_id).one()
@@ -719,6 +737,7 @@ def get_app_icons(app_id):
     return jsonify(small=app.icon_small, large=app.icon_large)
 
 @devportal_api.route('/app/<app_id>/icon/<size>', methods=['GET'])
+@use_primary
 def get_app_icon(app_id, size):
     if size not in ("large", "small"):
         return jsonify(error="Invalid icon size. Expected 'small' or 'large'.", e="size.invalid"), 404
@@ -752,7 +771,8 @@ def new_app_icon(app_id, size):
         return jsonify(error="Missing file: icon", e="icon.missing"), 400
 
     # Check it's a valid image file
-    if not is_valid_image_file(new_image):
+    image = probe_image(new_image)
+    if not is_permitted_image(image):
         return jsonify(error="Illegal image type", e="icon.illegalvalue"), 400
 
     # Only apps are allowed to have smallicons, not watchfaces
@@ -760,23 +780,24 @@ def new_app_icon(app_id, size):
         return jsonify(error="Watchfaces are not allowed small icons", e="icon.disallowed"), 400
 
     # Check it's the correct size
-    if not is_valid_image_size(new_image, f"{size}_icon"):
+    if not has_image_dimensions(image, f"{size}_icon"):
         max_w, max_h = get_max_image_dimensions(f"{size}_icon")
         return jsonify(error="Invalid image size", e="icon.illegaldimensions", message=f"Image should be {max_w}x{max_h}"), 400
 
-    new_image_id = upload_asset(new_image, new_image.content_type)
+    new_image_id = upload_image(new_image, f"{size}_icon", new_image.content_type, app_type=app.type)
     if size == "large":
         app.icon_large = new_image_id
     elif size == "small":
         app.icon_small = new_image_id
 
     # Invalidate the cached preview.
-    app.preview_image = None
+    invalidate_preview(app)
     db.session.commit()
 
     return jsonify(success=True, id=new_image_id, size=size)
 
 @devportal_api.route("/app/<app_id>/forum", methods=['GET'])
+@use_primary
 def get_app_forum_url(app_id):
     try:
         app = App.query.filter(App.id == app_id).one()
@@ -809,10 +830,18 @@ def update_app_forum_url(app_id):
     if not is_valid_topic_url(req["new_url"]):
         return jsonify(error="Invalid URL for new discourse topic", e="url.invalid"), 400
 
-    if not user_owns_discourse_topic(req["new_url"]):
-        return jsonify(error="You are not the creator of the provided discourse topic", e="url.permissions.missing"), 400
+    try:
+        topic_id = topic_url_to_id(req["new_url"])
+    except (ValueError, IndexError):
+        return jsonify(error="Invalid URL for new discourse topic", e="url.invalid"), 400
+
+    try:
+        if not user_owns_discourse_topic(req["new_url"]):
+            return jsonify(error="You are not the creator of the provided discourse topic", e="url.permissions.missing"), 400
+    except DiscourseUnavailable:
+        return jsonify(error="The forum isn't responding right now. Please try again later", e="discourse.unavailable"), 503
 
-    app.discourse_topic_id = topic_url_to_id(req["new_url"])
+    app.discourse_topic_id = topic_id
     db.session.commit()
 
     return jsonify(success=True, new_url=app.discourse_topic_id)
@@ -917,6 +946,7 @@ def wizard_delete_app(app_id):
     return jsonify(success=True, id=app_id)
 
 @devportal_api.route('/wizard/app/<app_id>', methods=['GET'])
+@use_primary
 def wizard_get_s3_assets(app_id):
     if not user_is_wizard():
         return jsonify(error="You are not a wizard", e="permission.denied"), 403
@@ -953,8 +983,16 @@ def wizard_get_s3_assets(app_id):
 def download_archive():
     uid = get_uid() # unused, does auth so AI scrapers don't waste all our bandwidth, though
 
-    archive = AvailableArchive.query.order_by(AvailableArchive.created_at.desc()).limit(1).one()
-    return jsonify(success=True, url=get_link_for_archive(archive.filename))
+    # The latest full archive, and the deltas that bring it up to date.
+    archive = (AvailableArchive.query
+               .filter(AvailableArchive.base_id == None)
+               .order_by(AvailableArchive.created_at.desc())
+               .limit(1).one())
+    deltas = (AvailableArchive.query
+              .filter(AvailableArchive.base_id == archive.id)
+              .order_by(AvailableArchive.created_at))
+    return jsonify(success=True, url=get_link_for_archive(archive.filename),
+                   deltas=[get_link_for_archive(delta.filename) for delta in deltas])
 
 def init_app(app, url_prefix='/api/dp'):
     global parent_app
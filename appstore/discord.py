@@ -1,9 +1,6 @@
-import json
-import requests
 import random
 
-from flask import current_app
-
+from .discord_queue import enqueue_discord_message
 from .settings import config
 from .utils import get_app_description, generate_image_url, who_am_i
 import appstore # break the circular dependency to import get_topic_url_for_app from discourse
@@ -27,7 +24,7 @@ def announce_release(app, release, is_generated):
             "value": release_notes
         }]
 
-        topic_url = appstore.discourse.get_topic_url_for_app(app)
+        topic_url = appstore.discourse.get_topic_url_for_app(app) or appstore.discourse.pending_topic_url(app)
         if topic_url:
             request_fields.append({
                 "name": "Discuss it on the Rebble Dev Forum!",
@@ -94,7 +91,7 @@ def announce_new_app(app, is_generated, is_hidden = False):
                     "value": "Unlisted"
         })
 
-    topic_url = appstore.discourse.get_topic_url_for_app(app)
+    topic_url = appstore.discourse.get_topic_url_for_app(app) or appstore.discourse.pending_topic_url(app)
     if topic_url:
         request_fields.append({
             "name": "Discuss it on the Rebble Dev Forum!",
@@ -151,7 +148,8 @@ def audit_log(operation, affected_app_uuid = None):
         }]
     }
 
-    send_admin_discord_webhook(request_data)
+    # Wizards tend to come in bursts, so these can share a message.
+    send_admin_discord_webhook(request_data, coalescable = True)
 
 def report_app_flag(reported_by, app_name, developer_name, app_id, affected_app_uuid = None):
 
@@ -254,22 +252,10 @@ def truncate_data(embed):
 def send_discord_webhook(request_data, is_generated = False):
     request_data['embeds'][0] = truncate_data(request_data['embeds'][0])
     if not is_generated:
-        if config['DISCORD_HOOK_URL'] is not None:
-            headers = {'Content-Type': 'application/json'}
-            r = requests.post(config['DISCORD_HOOK_URL'], data=json.dumps(request_data), headers=headers)
-            if r.status_code != 200:
-                current_app.logger.warning(f"Discord returned {r.status_code} with message: {r.text}")
+        enqueue_discord_message('DISCORD_HOOK_URL', request_data)
     else:
-        if config['DISCORD_GENERATED_HOOK_URL'] is not None:
-            headers = {'Content-Type': 'application/json'}
-            r = requests.post(config['DISCORD_GENERATED_HOOK_URL'], data=json.dumps(request_data), headers=headers)
-            if r.status_code != 200:
-                current_app.logger.warning(f"Discord returned {r.status_code} with message: {r.text}")
-
-def send_admin_discord_webhook(request_data):
-    if config['DISCORD_ADMIN_HOOK_URL'] is not None:
-        request_data['embeds'][0] = truncate_data(request_data['embeds'][0])
-        headers = {'Content-Type': 'application/json'}
-        r = requests.post(config['DISCORD_ADMIN_HOOK_URL'], data=json.dumps(request_data), headers=headers)
-        if r.status_code != 200:
-            current_app.logger.warning(f"Discord returned {r.status_code} with message: {r.text}")
+        enqueue_discord_message('DISCORD_GENERATED_HOOK_URL', request_data)
+
+def send_admin_discord_webhook(request_data, coalescable = False):
+    request_data['embeds'][0] = truncate_data(request_data['embeds'][0])
+    enqueue_discord_message('DISCORD_ADMIN_HOOK_URL', request_data, coalescable)
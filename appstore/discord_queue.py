@@ -0,0 +1,195 @@
+import datetime
+import json
+import time
+
+import requests
+from sqlalchemy import or_
+
+from .models import db, DiscordMessage
+from .settings import config
+from .workers import request_drain
+
+# Discord messages are sent by `flask apps discord-worker` (or, with
+# QUEUE_WORKERS=inline, a thread in the web process; see workers.py), never
+# in a web request.  enqueue_discord_message only adds a row to the caller's
+# session, so a message goes out if and only if the change it announces is
+# committed.
+
+HOOKS = ('DISCORD_HOOK_URL', 'DISCORD_GENERATED_HOOK_URL', 'DISCORD_ADMIN_HOOK_URL')
+
+# Discord won't take more than this many embeds in one message.
+MAX_EMBEDS = 10
+
+def enqueue_discord_message(hook, payload, coalescable=False):
+    if config[hook] is None:
+        return
+    now = datetime.datetime.utcnow()
+    db.session.add(DiscordMessage(hook=hook, payload=payload, coalescable=coalescable,
+                                  created_at=now, available_at=now, attempts=0))
+    request_drain()
+
+def claim_discord_messages(hooks, limit):
+    now = datetime.datetime.utcnow()
+    lease_expiry = now - datetime.timedelta(seconds=config['DISCORD_WEBHOOK_LEASE'])
+    messages = (DiscordMessage.query
+                .filter(DiscordMessage.hook.in_(hooks))
+                .filter(DiscordMessage.available_at <= now)
+                .filter(or_(DiscordMessage.claimed_at == None, DiscordMessage.claimed_at < lease_expiry))
+                .filter(DiscordMessage.attempts < config['DISCORD_WEBHOOK_MAX_ATTEMPTS'])
+                .order_by(DiscordMessage.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+                .all())
+    for message in messages:
+        message.claimed_at = now
+    db.session.commit()
+    return messages
+
+def _embeds(message):
+    return message.payload.get('embeds', [])
+
+def _everything_but_embeds(message):
+    return {k: v for k, v in message.payload.items() if k != 'embeds'}
+
+def discord_backlog():
+    # Messages still to be sent, whether or not they're ready to go.
+    return (DiscordMessage.query
+            .filter(DiscordMessage.attempts < config['DISCORD_WEBHOOK_MAX_ATTEMPTS'])
+            .count())
+
+def coalesce_messages(messages):
+    """
+    Split `messages` into the groups to send as one webhook call each: runs
+    of coalescable messages to the same hook, that differ only in their
+    embeds, share a message, up to Discord's limit on embeds, and everything
+    else goes on its own.
+    """
+    groups = []
+    for message in messages:
+        if groups and message.coalescable:
+            last = groups[-1]
+            if (last[0].coalescable and last[0].hook == message.hook and
+                    _everything_but_embeds(last[0]) == _everything_but_embeds(message) and
+                    sum(len(_embeds(m)) for m in last) + len(_embeds(message)) <= MAX_EMBEDS):
+                last.append(message)
+                continue
+        groups.append([message])
+    return groups
+
+def _group_payload(group):
+    if len(group) == 1:
+        return group[0].payload
+    # coalesce_messages only groups messages whose content, username and so
+    # on are the same, so the first one's will do for all of them.
+    return dict(group[0].payload, embeds=[embed for message in group for embed in _embeds(message)])
+
+def _retry_after(response):
+    # Seconds, from the headers: the webhook URLs don't pin an API version,
+    # and before v8 the body's retry_after was in milliseconds.
+    for header in ('X-RateLimit-Reset-After', 'Retry-After'):
+        try:
+            return float(response.headers[header])
+        except (KeyError, ValueError):
+            pass
+    return 1.0
+
+def _release(group, delay=0):
+    available_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    for message in group:
+        message.claimed_at = None
+        message.available_at = available_at
+
+def _retry_later(group, error):
+    for message in group:
+        message.attempts += 1
+        message.last_error = error[:1000]
+        if message.attempts >= config['DISCORD_WEBHOOK_MAX_ATTEMPTS']:
+            print(f"Giving up on Discord message {message.id} after {message.attempts} attempts: {error}")
+    # Exponential backoff: 10s, 20s, 40s... up to an hour.
+    _release(group, min(10 * 2 ** (group[0].attempts - 1), 3600))
+
+def _give_up(group, error):
+    print(f"Discord rejected message {[m.id for m in group]}: {error}")
+    for message in group:
+        message.attempts = config['DISCORD_WEBHOOK_MAX_ATTEMPTS']
+        message.last_error = error[:1000]
+
+def send_discord_group(group, buckets):
+    """
+    Post one coalesced group, and settle its messages according to how
+    Discord took it.  `buckets` maps each hook to the time before which we
+    mustn't send to it again.  Returns whether the group was delivered.
+    """
+    hook = group[0].hook
+    try:
+        r = requests.post(config[hook], data=json.dumps(_group_payload(group)),
+                          headers={'Content-Type': 'application/json'},
+                          timeout=config['DISCORD_WEBHOOK_TIMEOUT'])
+    except requests.RequestException as e:
+        _retry_later(group, repr(e))
+        return False
+
+    # Discord tells us how much of the bucket is left after every call, so
+    # that we can wait rather than run into a 429.
+    if r.headers.get('X-RateLimit-Remaining') == '0':
+        buckets[hook] = time.time() + float(r.headers.get('X-RateLimit-Reset-After', 1))
+
+    if r.status_code == 429:
+        retry_after = _retry_after(r)
+        is_global = r.headers.get('X-RateLimit-Global', '').lower() == 'true'
+        if not is_global:
+            try:
+                is_global = bool(r.json().get('global'))
+            except Exception:
+                pass
+        for blocked in (HOOKS if is_global else (hook,)):
+            buckets[blocked] = max(buckets.get(blocked, 0), time.time() + retry_after)
+        # Not the message's fault, so it doesn't count as an attempt.
+        _release(group, retry_after)
+        return False
+    if r.status_code >= 500:
+        _retry_later(group, f"{r.status_code}: {r.text}")
+        return False
+    if r.status_code >= 400:
+        # Retrying a message Discord doesn't like won't make it like it.
+        _give_up(group, f"{r.status_code}: {r.text}")
+        return False
+
+    for message in group:
+        db.session.delete(message)
+    return True
+
+def run_discord_worker(batch_size, poll_interval, once, deadline=None):
+    buckets = {}
+    sent = 0
+    deferred = 0
+
+    while True:
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            break
+        ready = [hook for hook in HOOKS if config[hook] is not None and buckets.get(hook, 0) <= now]
+        messages = claim_discord_messages(ready, batch_size) if ready else []
+        if not messages:
+            if once and len(ready) == len([hook for hook in HOOKS if config[hook] is not None]):
+                break
+            # Sleep until the next bucket opens up, if that's sooner.
+            waits = [buckets[hook] - now for hook in buckets if buckets[hook] > now]
+            if deadline is not None:
+                waits.append(deadline - now)
+            time.sleep(min([poll_interval] + waits))
+            continue
+
+        for group in coalesce_messages(messages):
+            if buckets.get(group[0].hook, 0) > time.time():
+                # An earlier group used up the bucket; leave it for later.
+                _release(group)
+            elif send_discord_group(group, buckets):
+                sent += len(group)
+            else:
+                deferred += len(group)
+            db.session.commit()
+
+        print(f"... {sent} Discord messages sent, {deferred} deferred ...")
+
+    return sent, deferred
@@ -1,9 +1,16 @@
+import datetime
+import threading
+import time
+
 from pydiscourse.client import DiscourseClient
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
 
 from .settings import config
-from .models import App, db
+from .models import App, DiscourseAnnouncement, Release, db
 from .discord import random_party_emoji
 from .utils import get_app_description, generate_image_url, demand_authed_request
+from .workers import request_drain
 import requests
 import json
 
@@ -21,44 +28,79 @@ if config['DISCOURSE_API_KEY'] is None:
     _client = None
     print("== Discourse Integration not configured.")
 else:
-    _client = DiscourseClient(host=f"https://{config['DISCOURSE_HOST']}", api_username=config['DISCOURSE_USER'], api_key=config['DISCOURSE_API_KEY'])
+    _client = DiscourseClient(host=f"https://{config['DISCOURSE_HOST']}", api_username=config['DISCOURSE_USER'], api_key=config['DISCOURSE_API_KEY'],
+                              timeout=config['DISCOURSE_TIMEOUT'])
 
 def _md_quotify(text):
     return '\n'.join("> " + line for line in text.split('\n'))
 
-def _create_or_post_to_topic(app, is_generated, text):
-    if is_generated:
-        # For now, we don't post about generated watchfaces.  Maybe they
-        # should go in their own topic later?
-        return
-
-    if app.discourse_topic_id == -1:
-        # We have manually set that we don't want a Discourse topic at all
-        # for this app.  Don't post at all.
-        return
-
-    if app.discourse_topic_id == 0:
-        # This app doesn't have a topic of its own yet; create a new one,
-        # and store it in the database.
-        
+def _topic_external_id(app):
+    return f"appstore-app-{app.id}"
+
+def _discourse_get(path, timeout=None):
+    # pydiscourse doesn't follow redirects, and only speaks JSON.
+    return requests.get(f"https://{config['DISCOURSE_HOST']}{path}",
+                        headers={'Api-Key': config['DISCOURSE_API_KEY'], 'Api-Username': config['DISCOURSE_USER']},
+                        timeout=timeout or config['DISCOURSE_TIMEOUT'])
+
+def _find_topic(app):
+    """
+    The id of the topic a previous attempt made for `app`, if there is one.
+    """
+    r = _discourse_get(f"/t/external_id/{_topic_external_id(app)}.json")
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()['id']
+
+def _ensure_topic(app, text):
+    """
+    Give `app` a topic of its own, opening with `text`, and store it in the
+    database.
+    """
+    topic_id = _find_topic(app)
+    if topic_id is None:
         if app.type == "watchapp":
             tags = ['pebble-app', 'watchapp', app.category.name]
             type_displayed = "Watchapp"
         else:
             tags = ['pebble-app', 'watchface']
             type_displayed = "Watchface"
-        
-        # If any of this fails, someone can swallow the exception externally.
+
+        # The external id is what lets a retry find this topic again, if we
+        # never heard back about it.
         rv = _client.create_post(text,
             category_id=config['DISCOURSE_SHOWCASE_TOPIC_ID'],
             title=f"{type_displayed}: {app.title} by {app.developer.name}",
-            tags=tags)
-
-        App.query.filter_by(app_uuid=app.app_uuid).update({'discourse_topic_id': rv['topic_id']})
-        db.session.commit()
-        app.discourse_topic_id = rv['topic_id']
-    else:
-        _client.create_post(text, category_id=config['DISCOURSE_SHOWCASE_TOPIC_ID'], topic_id=app.discourse_topic_id)
+            tags=tags,
+            external_id=_topic_external_id(app))
+        topic_id = rv['topic_id']
+
+    App.query.filter_by(id=app.id).update({'discourse_topic_id': topic_id})
+    db.session.commit()
+    app.discourse_topic_id = topic_id
+
+def _topic_contains(topic_id, marker):
+    # /raw/ gives a topic's posts a page at a time, running out (or 404ing)
+    # past the last page.
+    page = 1
+    while True:
+        r = _discourse_get(f"/raw/{topic_id}?page={page}")
+        if r.status_code == 404 and page > 1:
+            return False
+        r.raise_for_status()
+        if marker in r.text:
+            return True
+        if not r.text.strip():
+            return False
+        page += 1
+
+def _post_to_topic(app, key, text, retrying):
+    marker = f"<!-- {key} -->"
+    if retrying and _topic_contains(app.discourse_topic_id, marker):
+        # A previous attempt got the post in before it failed.
+        return
+    _client.create_post(f"{text}\n{marker}\n", category_id=config['DISCOURSE_SHOWCASE_TOPIC_ID'], topic_id=app.discourse_topic_id)
 
 def banner(app):
     asset_collections = app.asset_collections
@@ -87,14 +129,8 @@ def screenshot_section(app):
             output += "\n\n"
     return output
 
-def announce_release(app, release, is_generated):
-    if config["TEST_APP_UUID"] is not None and config["TEST_APP_UUID"] == str(app.app_uuid):
-        return
-
-    if app.discourse_topic_id == 0:
-        announce_new_app(app, is_generated, is_new=False)
-
-    _create_or_post_to_topic(app, is_generated, text=f"""
+def _release_text(app, release):
+    return f"""
 # {random_party_emoji()} Update alert!
 
 :party: {app.developer.name} just released *version *{release.version}** of **{app.title}**!
@@ -105,14 +141,10 @@ def announce_release(app, release, is_generated):
 
 {_md_quotify(release.release_notes or "N/A")}
 
-""")
+"""
 
-def announce_new_app(app, is_generated, is_new=True):
-
-    if config["TEST_APP_UUID"] is not None and config["TEST_APP_UUID"] == str(app.app_uuid):
-        return
-
-    _create_or_post_to_topic(app, is_generated, text=f"""
+def _new_app_text(app, is_new):
+    return f"""
 {banner(app)}
 
 # {app.title} by {app.developer.name}
@@ -128,7 +160,139 @@ def announce_new_app(app, is_generated, is_new=True):
 {screenshot_section(app)}
 
 ###### *P.S.: I'm just a helpful robot that posted this.  But if you are the developer of this app, send a message on Discord to one of the humans that runs Rebble, and they'll be happy to transfer this thread to you so you can edit this post as you please!*
-""")
+"""
+
+def _queue_announcement(app, release, is_generated):
+    if _client is None:
+        return
+
+    if config["TEST_APP_UUID"] is not None and config["TEST_APP_UUID"] == str(app.app_uuid):
+        return
+
+    if is_generated:
+        # For now, we don't post about generated watchfaces.  Maybe they
+        # should go in their own topic later?
+        return
+
+    if app.discourse_topic_id == -1:
+        # We have manually set that we don't want a Discourse topic at all
+        # for this app.  Don't post at all.
+        return
+
+    now = datetime.datetime.utcnow()
+    key = f"release-{release.id}" if release is not None else f"new-app-{app.id}"
+    db.session.execute(insert(DiscourseAnnouncement)
+                       .values(idempotency_key=key, app_id=app.id, release_id=release.id if release is not None else None,
+                               created_at=now, available_at=now, attempts=0)
+                       .on_conflict_do_nothing(index_elements=[DiscourseAnnouncement.idempotency_key]))
+    request_drain()
+
+# These only queue the announcement, in the caller's transaction; the posting
+# is done by `flask apps discourse-worker` (or a thread in the web process;
+# see workers.py).
+
+def announce_release(app, release, is_generated):
+    _queue_announcement(app, release, is_generated)
+
+def announce_new_app(app, is_generated):
+    _queue_announcement(app, None, is_generated)
+
+def post_announcement(job):
+    app = App.query.get(job.app_id)
+    if app.discourse_topic_id == -1:
+        return
+
+    retrying = job.attempts > 1
+    if job.release_id is None:
+        if app.discourse_topic_id == 0:
+            _ensure_topic(app, _new_app_text(app, is_new=True))
+        else:
+            _post_to_topic(app, job.idempotency_key, _new_app_text(app, is_new=True), retrying)
+    else:
+        release = Release.query.get(job.release_id)
+        if app.discourse_topic_id == 0:
+            _ensure_topic(app, _new_app_text(app, is_new=False))
+        _post_to_topic(app, job.idempotency_key, _release_text(app, release), retrying)
+
+def claim_announcements(limit):
+    now = datetime.datetime.utcnow()
+    lease_expiry = now - datetime.timedelta(seconds=config['DISCOURSE_ANNOUNCE_LEASE'])
+    jobs = (DiscourseAnnouncement.query
+            .filter(DiscourseAnnouncement.available_at <= now)
+            .filter(or_(DiscourseAnnouncement.claimed_at == None, DiscourseAnnouncement.claimed_at < lease_expiry))
+            .filter(DiscourseAnnouncement.attempts < config['DISCOURSE_ANNOUNCE_MAX_ATTEMPTS'])
+            .order_by(DiscourseAnnouncement.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+    for job in jobs:
+        job.claimed_at = now
+        job.attempts += 1
+    db.session.commit()
+    return jobs
+
+def failed_announcements():
+    """
+    Announcements the worker has given up on.  They stay queued until
+    retried with `flask apps discourse-failed --retry`.
+    """
+    return (DiscourseAnnouncement.query
+            .filter(DiscourseAnnouncement.attempts >= config['DISCOURSE_ANNOUNCE_MAX_ATTEMPTS'])
+            .order_by(DiscourseAnnouncement.id)
+            .all())
+
+def announcement_backlog():
+    # Announcements still to be posted, whether or not they're ready to go.
+    return (DiscourseAnnouncement.query
+            .filter(DiscourseAnnouncement.attempts < config['DISCOURSE_ANNOUNCE_MAX_ATTEMPTS'])
+            .count())
+
+def run_announcement_worker(batch_size, poll_interval, once, deadline=None):
+    posted = 0
+    failed = 0
+
+    while True:
+        if deadline is not None and time.time() >= deadline:
+            break
+        jobs = claim_announcements(batch_size)
+        if not jobs:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        for job in jobs:
+            try:
+                post_announcement(job)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Failed to post announcement {job.idempotency_key}: {repr(e)}")
+                job.last_error = repr(e)[:1000]
+                job.claimed_at = None
+                # Exponential backoff: 30s, 1m, 2m... up to an hour.
+                job.available_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=min(30 * 2 ** (job.attempts - 1), 3600))
+                if job.attempts >= config['DISCOURSE_ANNOUNCE_MAX_ATTEMPTS']:
+                    print(f"Giving up on {job.idempotency_key} after {job.attempts} attempts")
+                failed += 1
+            else:
+                db.session.delete(job)
+                posted += 1
+            db.session.commit()
+
+        print(f"... {posted} announcements posted, {failed} failed ...")
+
+    return posted, failed
+
+def pending_topic_url(app):
+    """
+    Where the topic for `app` will be, if it doesn't have one yet but is
+    queued to get one.  Discourse redirects this to the topic once it exists.
+    """
+    if app.discourse_topic_id != 0 or _client is None:
+        return None
+    if DiscourseAnnouncement.query.filter_by(app_id=app.id).count() == 0:
+        return None
+    return f"https://{config['DISCOURSE_HOST']}/t/external_id/{_topic_external_id(app)}"
 
 def get_topic_url_for_app(app):
     if app.discourse_topic_id > 0:
@@ -159,14 +323,98 @@ def topic_url_to_id(topic_url):
         # Long url with page: https://discourse.example.com/t/topic-title/12345/2
         return int(sections[5])
 
+class DiscourseUnavailable(Exception):
+    pass
+
+class CircuitBreaker(object):
+    """
+    Stops calling something for `cooldown` seconds once it has failed
+    `threshold` times in a row, so that callers fail fast rather than each
+    waiting out a timeout.  After the cooldown one call is let through to see
+    whether it has recovered.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def call(self, fn, *args):
+        trial = False
+        with self.lock:
+            if self.opened_at is not None:
+                if time.time() - self.opened_at < self.cooldown:
+                    raise DiscourseUnavailable("the forum is not responding")
+                # Half open: this call is the trial, and everyone else keeps
+                # failing fast until it's done.
+                self.opened_at = time.time()
+                trial = True
+        try:
+            result = fn(*args)
+        except Exception:
+            # Whatever went wrong, a failed trial re-opens the breaker for
+            # another cooldown.
+            with self.lock:
+                self.failures += 1
+                if trial or self.failures >= self.threshold:
+                    self.opened_at = time.time()
+            raise
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+_breaker = CircuitBreaker(config['DISCOURSE_BREAKER_THRESHOLD'], config['DISCOURSE_BREAKER_COOLDOWN'])
+
+# Topic id to (expiry, owner).  Topics change hands rarely, and only when an
+# admin moves them.
+_owner_cache = {}
+_owner_cache_lock = threading.Lock()
+_owner_cache_size = 1024
+
+def _fetch_topic_owner(topic_id):
+    # Anonymously, so that only public topics count: with the bot's key we
+    # could see, and so hand out, private ones too.
+    r = requests.get(f"https://{config['DISCOURSE_HOST']}/t/{topic_id}.json", timeout=config['DISCOURSE_LOOKUP_TIMEOUT'])
+    if r.status_code >= 500:
+        r.raise_for_status()
+    if r.status_code != 200:
+        # Missing or private; either way, not something you can own.
+        return None
+    topic = r.json()
+    if not topic.get("visible", True):
+        # Unlisted, which anyone with the link can still read.
+        return None
+    return topic["details"]["created_by"]["username"]
+
 def fetch_owner_from_topic_url(topic_url):
-    #The py client sucks a bit so we'll just call the JSON
-    topic = requests.request("GET", topic_url + ".json").json()
-    topic_owner = topic["details"]["created_by"]["username"]
-    return topic_owner
+    topic_id = topic_url_to_id(topic_url)
+    now = time.time()
+    with _owner_cache_lock:
+        cached = _owner_cache.get(topic_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    try:
+        owner = _breaker.call(_fetch_topic_owner, topic_id)
+    except requests.RequestException as e:
+        raise DiscourseUnavailable(repr(e))
+
+    if owner is not None:
+        with _owner_cache_lock:
+            if len(_owner_cache) >= _owner_cache_size:
+                # Oldest first.
+                del _owner_cache[next(iter(_owner_cache))]
+            _owner_cache.pop(topic_id, None)
+            _owner_cache[topic_id] = (now + config['DISCOURSE_OWNER_CACHE_TTL'], owner)
+    return owner
 
 def user_owns_discourse_topic(discourse_topic_url):
     discourse_username = fetch_owner_from_topic_url(discourse_topic_url)
+    if discourse_username is None:
+        return False
 
     auth_result = demand_authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me/pebble/appstore")
     me = auth_result.json()
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+class DiskCache(object):
+    """
+    A size-bounded, least-recently-used cache of immutable blobs on local
+    disk.  Several processes (gunicorn workers, export threads) may share one
+    directory: fills are written to a temporary file and renamed into place,
+    so a reader never sees a partially downloaded object, and recency is kept
+    in each file's mtime so that eviction works across processes.
+    """
+
+    FILL_PREFIX = '.fill-'
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        # Evict down to this, rather than to max_bytes, so that we don't end
+        # up rescanning the directory on every single fill.
+        self.low_water_bytes = int(max_bytes * 0.9)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self.bytes_filled = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _path_for(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(self.FILL_PREFIX) or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue  # evicted by someone else while we were looking
+            entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+
+    def _evict(self, keep):
+        # `keep` is the entry just filled, which mustn't go before it has
+        # had a chance to be used.
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.low_water_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+    def _open_cached(self, path):
+        try:
+            os.utime(path)
+            return open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def _serve(self, f, file):
+        if isinstance(file, str):
+            with open(file, 'wb') as destination:
+                shutil.copyfileobj(f, destination)
+        else:
+            shutil.copyfileobj(f, file)
+        return f.tell()
+
+    def fetch(self, key, file, fill):
+        """
+        Copy the blob for `key` into `file` (a path or a writable file
+        object).  On a miss, `fill` is called with a file object to write
+        the blob into; nothing is cached if it raises.
+        """
+        path = self._path_for(key)
+        cached = self._open_cached(path)
+        if cached is not None:
+            with cached:
+                size = self._serve(cached, file)
+            with self.lock:
+                self.hits += 1
+                self.bytes_served += size
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=self.FILL_PREFIX)
+        with os.fdopen(fd, 'w+b') as f:
+            try:
+                fill(f)
+                f.flush()
+                size = f.tell()
+                # Anything bigger than this would be evicted again by the
+                # very fill that stored it, so just pass it on.
+                keep = size <= self.low_water_bytes
+                if keep:
+                    os.replace(tmp_path, path)
+                else:
+                    os.unlink(tmp_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+            with self.lock:
+                self.misses += 1
+                self.bytes_filled += size
+                if keep:
+                    self.total_bytes += size
+                    if self.total_bytes > self.max_bytes:
+                        self._evict(path)
+
+            # Serve from the file we just wrote rather than holding the whole
+            # blob in memory.  This handle stays good whatever happens to the
+            # entry in the meantime.
+            f.seek(0)
+            self._serve(f, file)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+                'bytes_filled': self.bytes_filled,
+                'bytes_cached': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,99 @@
+import collections
+import json
+
+from sqlalchemy import event
+
+from .models import db
+
+# Support for `flask apps explain-hot-paths`: run some code, note down every
+# statement it sends to the database, then have postgres EXPLAIN ANALYZE
+# each of them, so that we can see the plans our hot paths actually get.
+
+# A row estimate this far out, either way, is worth pointing at.
+MISESTIMATE_RATIO = 10
+
+def capture_statements(fn):
+    """
+    Call `fn`, and return the statements it executed as a list of
+    (statement, parameters, count), in the order they were first seen.  The
+    same statement run with different parameters (say, a lazy load once per
+    row) is listed once, with the parameters of its first run.
+    """
+    statements = collections.OrderedDict()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            return
+        if statement in statements:
+            statements[statement][1] += 1
+        else:
+            statements[statement] = [parameters, 1]
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return [(statement, parameters, count) for statement, (parameters, count) in statements.items()]
+
+def compiled_statement(statement):
+    compiled = statement.compile(dialect=db.engine.dialect)
+    return str(compiled), compiled.params
+
+def explain_statement(statement, parameters):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) one statement in the current session, and
+    return postgres's JSON plan for it.  ANALYZE really runs the statement,
+    so anything that writes must be explained inside a transaction that is
+    rolled back afterwards.
+    """
+    result = db.session.connection().exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+def plan_nodes(node, depth=0):
+    yield depth, node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child, depth + 1)
+
+def _describe(node):
+    description = node['Node Type']
+    if 'Relation Name' in node:
+        description += f" on {node['Relation Name']}"
+    if 'Index Name' in node:
+        description += f" using {node['Index Name']}"
+    return description
+
+def _rows(node):
+    if node.get('Actual Loops', 0) == 0:
+        return f"est {node['Plan Rows']} rows, never executed"
+    return (f"est {node['Plan Rows']} rows, actual {node['Actual Rows']} x{node['Actual Loops']}, "
+            f"{node['Actual Total Time'] * node['Actual Loops']:.2f} ms")
+
+def _misestimated(node):
+    if node.get('Actual Loops', 0) == 0:
+        return False
+    estimated = max(node['Plan Rows'], 1)
+    actual = max(node['Actual Rows'], 1)
+    return max(estimated, actual) >= 100 and max(estimated / actual, actual / estimated) >= MISESTIMATE_RATIO
+
+def seq_scans(plan):
+    return [node for _, node in plan_nodes(plan['Plan']) if node['Node Type'] == 'Seq Scan']
+
+def print_plan_summary(label, statement, count, plan, verbose=False):
+    root = plan['Plan']
+    print(f"== {label}: run {count}x, {plan['Execution Time']:.2f} ms (planning {plan['Planning Time']:.2f} ms), "
+          f"{root.get('Shared Hit Blocks', 0)} blocks hit, {root.get('Shared Read Blocks', 0)} read")
+    print(f"   {' '.join(statement.split())[:160]}")
+    for depth, node in plan_nodes(root):
+        if verbose:
+            print(f"   {'  ' * depth}{_describe(node)}: {_rows(node)}")
+            continue
+        if node['Node Type'] == 'Seq Scan':
+            print(f"   SEQ SCAN {node['Relation Name']}: {_rows(node)}"
+                  + (f", filter {node['Filter']}" if 'Filter' in node else ''))
+        elif _misestimated(node):
+            print(f"   MISESTIMATE {_describe(node)}: {_rows(node)}")
@@ -6,6 +6,7 @@ import beeline
 from flask import Flask
 from PIL import Image, ImageDraw, ImageFont, ImageChops
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from math import ceil
 
 from .s3 import download_asset
@@ -15,8 +16,6 @@ parent_app = None
 
 static_folder = os.path.join(os.path.dirname(__file__), 'static')
 
-background = Image.open(os.path.join(static_folder, 'background.png')).convert('RGBA')
-
 text_color=(255, 255, 255)
 
 overlay_box=(0, 392, 780, 520)
@@ -25,61 +24,98 @@ base_title_position=(36, 404)
 base_author_position=(36, 460)
 base_text_space=530
 
-icon_mask = Image.open(os.path.join(static_folder, 'icon-mask.png')).convert('L')
-chalk_mask = Image.open(os.path.join(static_folder, 'chalk-mask.png')).convert('L')
-gabbro_mask = Image.open(os.path.join(static_folder, 'gabbro-mask.png')).convert('L')
-
 platform_borders = {
     'aplite': {
-        'image': Image.open(os.path.join(static_folder, 'aplite-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-bw.png')).convert("RGBA"),
+        'image': 'aplite-border.png',
+        'fallback': 'fallback-bw.png',
         'offset': (68,106)
     },
     'basalt': {
-        'image': Image.open(os.path.join(static_folder, 'basalt-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-basalt.png')).convert("RGBA"),
+        'image': 'basalt-border.png',
+        'fallback': 'fallback-basalt.png',
         'offset': (88,111)
     },
     'chalk': {
-        'image': Image.open(os.path.join(static_folder, 'chalk-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-chalk.png')).convert("RGBA"),
+        'image': 'chalk-border.png',
+        'fallback': 'fallback-chalk.png',
         'offset': (71,105)
     },
     'diorite': {
-        'image': Image.open(os.path.join(static_folder, 'diorite-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-bw.png')).convert("RGBA"),
+        'image': 'diorite-border.png',
+        'fallback': 'fallback-bw.png',
         'offset': (54, 110)
     },
     'emery': {
-        'image': Image.open(os.path.join(static_folder, 'emery-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-emery.png')).convert("RGBA"),
+        'image': 'emery-border.png',
+        'fallback': 'fallback-emery.png',
         'offset': (65, 79)
     },
     'flint': {
-        'image': Image.open(os.path.join(static_folder, 'diorite-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-bw.png')).convert("RGBA"),
+        'image': 'diorite-border.png',
+        'fallback': 'fallback-bw.png',
         'offset': (54, 110)
     },
     'gabbro': {
-        'image': Image.open(os.path.join(static_folder, 'gabbro-border.png')).convert("RGBA"),
-        'fallback': Image.open(os.path.join(static_folder, 'fallback-gabbro.png')).convert("RGBA"),
+        'image': 'gabbro-border.png',
+        'fallback': 'fallback-gabbro.png',
         'offset': (56, 65)
     }
 }
 
-font_large = ImageFont.truetype(os.path.join(static_folder, 'Lato-Bold.ttf'), 48)
-font_small = ImageFont.truetype(os.path.join(static_folder, 'Lato-Regular.ttf'), 32)
+# The art and fonts are only needed by the preview route, so they are loaded
+# the first time something asks for them rather than on import; every Lambda
+# cold start and CLI command imports this module.  See prewarm() for workers
+# that would rather pay for it up front.
+@lru_cache(maxsize=None)
+def static_image(filename, mode='RGBA'):
+    return Image.open(os.path.join(static_folder, filename)).convert(mode)
+
+@lru_cache(maxsize=None)
+def static_font(filename, size):
+    return ImageFont.truetype(os.path.join(static_folder, filename), size)
+
+def background():
+    return static_image('background.png')
+
+def border_image(platform):
+    return static_image(platform_borders[platform]['image'])
+
+def fallback_image(platform):
+    return static_image(platform_borders[platform]['fallback'])
+
+def mask_image(name):
+    return static_image(f"{name}-mask.png", 'L')
+
+def font_large():
+    return static_font('Lato-Bold.ttf', 48)
+
+def font_small():
+    return static_font('Lato-Regular.ttf', 32)
+
+# Widths we will serve previews at; the first is the size we render at.
+PREVIEW_WIDTHS = (780, 480, 240)
+
+PREVIEW_FORMATS = {
+    'png': {'mime_type': 'image/png', 'options': {}},
+    'webp': {'mime_type': 'image/webp', 'options': {'quality': 85, 'method': 4}},
+    # Only if a Pillow with AVIF support (or pillow-avif-plugin) is around.
+    'avif': {'mime_type': 'image/avif', 'options': {'quality': 60, 'speed': 8}},
+}
+
+# In order of preference; the first one we have screenshots for all of wins.
+PREFERRED_GROUPINGS = [['gabbro', 'emery'], ['diorite', 'emery'], ['flint', 'emery'], ['basalt', 'emery'],
+    ['chalk', 'emery'], ['gabbro', 'chalk'], ['gabbro', 'basalt'], ['gabro', 'flint'], ['gabro', 'diorite'],
+    ['basalt', 'diorite'], ['basalt', 'flint'], ['basalt', 'chalk'], ['basalt', 'aplite'],
+    ['gabbro'], ['flint'], ['emery'], ['diorite'], ['chalk'], ['basalt'], ['aplite']]
 
 def preferred_grouping(platforms):
-    order = [['gabbro', 'emery'], ['diorite', 'emery'], ['flint', 'emery'], ['basalt', 'emery'],
-        ['chalk', 'emery'], ['gabbro', 'chalk'], ['gabbro', 'basalt'], ['gabro', 'flint'], ['gabro', 'diorite'],
-        ['basalt', 'diorite'], ['basalt', 'flint'], ['basalt', 'chalk'], ['basalt', 'aplite'],
-        ['gabbro'], ['flint'], ['emery'], ['diorite'], ['chalk'], ['basalt'], ['aplite']]
-    for selection in order:
+    for selection in PREFERRED_GROUPINGS:
       if len(selection) == len(selection & platforms):
         return selection
 
 def load_image_from_id(id, fallback):
+    if id is None:
+        return fallback
     try:
         file = io.BytesIO()
         download_asset(id, file)
@@ -106,45 +142,108 @@ def load_images_parallel(ids_with_fallbacks):
 
     return output
 
+@lru_cache(maxsize=4096)
+def text_width(font, text):
+    return font.getlength(text)
+
 def draw_text_ellipsized(draw, text, font, xy, max_width):
-    if draw.textlength(text, font=font) <= max_width:
+    if text_width(font, text) <= max_width:
         draw.text(xy, text, font=font, fill=text_color)
         return
 
     ellipsis = "…"
-    ellipsis_width = draw.textlength(ellipsis, font=font)
-
-    trimmed = ""
-    for char in text:
-        if draw.textlength(trimmed + char, font=font) + ellipsis_width <= max_width:
-            trimmed += char
+    available = max_width - text_width(font, ellipsis)
+
+    # Find the longest prefix that still fits alongside the ellipsis.
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_width(font, text[:mid]) <= available:
+            lo = mid
         else:
-            break
+            hi = mid - 1
+
+    draw.text(xy, text[:lo] + ellipsis, font=font, fill=text_color)
+
+# Backgrounds with the borders for a grouping already composited onto them,
+# keyed by the grouping.  Each slot also keeps the pieces needed to redo the
+# screenshot's rectangle exactly as compositing it under the border would:
+# the template there before its border went on, and the border itself.
+_layouts = {}
 
-    draw.text(xy, trimmed + ellipsis, font=font, fill=text_color)
+def _build_layout(platforms):
+    template = background().copy()
+    start_x = ceil((template.width - sum(border_image(platform).width for platform in platforms)) / 2)
 
-def platform_image_in_border(canvas, image, top_left, platform):
-    border = platform_borders[platform]
+    slots = []
+    for platform in platforms:
+        border = border_image(platform)
+        offset_x, offset_y = platform_borders[platform]['offset']
+        width, height = plat_dimensions[platform]
+        position = (start_x + offset_x, offset_y)
+
+        slots.append({
+            'platform': platform,
+            'position': position,
+            'under': template.crop((*position, position[0] + width, position[1] + height)),
+            'over': border.crop((offset_x, offset_y, offset_x + width, offset_y + height)),
+        })
+        template.alpha_composite(border, (start_x, 0))
+        start_x += border.width
+
+    return {'template': template, 'slots': slots}
+
+def layout_for_grouping(platforms):
+    key = tuple(platforms)
+    if key not in _layouts:
+        _layouts[key] = _build_layout(platforms)
+    return _layouts[key]
+
+def platform_image_in_slot(canvas, image, slot):
+    platform = slot['platform']
     image = image.resize(plat_dimensions[platform], resample=Image.NEAREST)
 
     if platform == 'chalk':
-        image.putalpha(chalk_mask)
+        image.putalpha(mask_image('chalk'))
     if platform == 'gabbro':
-        image.putalpha(gabbro_mask)
+        image.putalpha(mask_image('gabbro'))
 
-    ix = top_left[0] + border['offset'][0]
-    iy = top_left[1] + border['offset'][1]
+    region = slot['under'].copy()
+    region.alpha_composite(image)
+    region.alpha_composite(slot['over'])
+    canvas.paste(region, slot['position'])
 
-    canvas.alpha_composite(image, (ix, iy))
+def render_preview_image(title, developer, platforms, screenshots, icon_image=None):
+    layout = layout_for_grouping(platforms)
+    canvas = layout['template'].copy()
+    draw = ImageDraw.Draw(canvas)
 
-    canvas.alpha_composite(border['image'], top_left)
+    for slot in layout['slots']:
+        platform_image_in_slot(canvas, screenshots[slot['platform']], slot)
 
-def generate_preview_image(title, developer, icon, screenshots):
-    canvas = background.copy()
-    draw = ImageDraw.Draw(canvas)
+    title_position = base_title_position
+    author_position = base_author_position
+    text_space = base_text_space
+
+    if icon_image:
+        icon_image = icon_image.resize((80,80))
+        icon_image.putalpha(ImageChops.multiply(mask_image('icon'), icon_image.split()[3]))
+        canvas.alpha_composite(icon_image, icon_position)
+        title_position = (title_position[0] + 88, title_position[1])
+        author_position = (author_position[0] + 88, author_position[1])
+        text_space -= 88
 
-    platforms = preferred_grouping(screenshots.keys())
-    start_x = ceil((canvas.width - sum(platform_borders[platform]['image'].width for platform in platforms)) / 2)
+    span = beeline.start_span(context = { "name": "render_text" })
+    draw_text_ellipsized(draw, title, font_large(), title_position, text_space)
+    draw_text_ellipsized(draw, developer, font_small(), author_position, text_space)
+    beeline.finish_span(span)
+
+    return canvas
+
+def generate_preview_canvas(title, developer, icon, screenshots):
+    # An app with no screenshots at all still gets a preview, of the stock
+    # screenshot.
+    platforms = preferred_grouping(screenshots.keys()) or ['basalt']
 
     image_ids = {}
 
@@ -152,53 +251,61 @@ def generate_preview_image(title, developer, icon, screenshots):
         image_ids['icon'] = (icon, None)
 
     for platform in platforms:
-        image_ids[platform] = (screenshots[platform], platform_borders[platform]['fallback'])
+        image_ids[platform] = (screenshots.get(platform), fallback_image(platform))
 
     span = beeline.start_span(context = { "name": "load_images" })
     loaded_images = load_images_parallel(image_ids)
     beeline.finish_span(span)
 
     span = beeline.start_span(context = { "name": "render_images" })
-    for platform in platforms:
-        platform_image_in_border(
-            canvas=canvas,
-            image=loaded_images[platform],
-            top_left=(start_x, 0),
-            platform=platform
-        )
-        start_x += platform_borders[platform]['image'].width
-
-    title_position = base_title_position
-    author_position = base_author_position
-    text_space = base_text_space
+    canvas = render_preview_image(title, developer, platforms, loaded_images, loaded_images.get('icon'))
+    beeline.finish_span(span)
 
-    icon_image = loaded_images['icon'] if 'icon' in loaded_images else None
+    return canvas
 
-    if icon_image:
-        icon_image = icon_image.resize((80,80))
-        icon_image.putalpha(ImageChops.multiply(icon_mask, icon_image.split()[3]))
-        canvas.alpha_composite(icon_image, icon_position)
-        title_position = (title_position[0] + 88, title_position[1])
-        author_position = (author_position[0] + 88, author_position[1])
-        text_space -= 88
-    beeline.finish_span(span)
+def supported_preview_formats():
+    Image.init()
+    return [fmt for fmt in PREVIEW_FORMATS if fmt.upper() in Image.SAVE]
 
-    span = beeline.start_span(context = { "name": "render_text" })
-    draw_text_ellipsized(draw, title, font_large, title_position, text_space)
-    draw_text_ellipsized(draw, developer, font_small, author_position, text_space)
-    beeline.finish_span(span)
+def preview_variant_id(preview_image, fmt, width):
+    # The full size PNG lives at the preview's own id; every other variant
+    # sits next to it under a name derived from it.
+    if fmt == 'png' and width == PREVIEW_WIDTHS[0]:
+        return preview_image
+    return f"{preview_image}.{width}.{fmt}"
 
-    span = beeline.start_span(context = { "name": "encode_png" })
+def encode_preview(canvas, fmt='png', width=None):
+    span = beeline.start_span(context = { "name": f"encode_{fmt}" })
 
     try:
+        if width and width != canvas.width:
+            canvas = canvas.resize((width, round(canvas.height * width / canvas.width)), resample=Image.LANCZOS)
         buffer = io.BytesIO()
-        canvas.save(buffer, format='PNG')
-        buffer.seek(0)
+        canvas.save(buffer, format=fmt.upper(), **PREVIEW_FORMATS[fmt]['options'])
+        beeline.add_context_field("preview.encoded_bytes", buffer.tell())
     finally:
         beeline.finish_span(span)
 
     return buffer.getvalue()
 
+def generate_preview_image(title, developer, icon, screenshots):
+    return encode_preview(generate_preview_canvas(title, developer, icon, screenshots), 'png')
+
+def prewarm():
+    """
+    Load all of the art and fonts and build every layout now, for long-lived
+    workers that would rather not make the first preview request wait.
+    """
+    for platforms in PREFERRED_GROUPINGS:
+        if all(platform in platform_borders for platform in platforms):
+            layout_for_grouping(platforms)
+    for platform in platform_borders:
+        fallback_image(platform)
+    for name in ('icon', 'chalk', 'gabbro'):
+        mask_image(name)
+    font_large()
+    font_small()
+
 def init_app(app):
     global parent_app
     parent_app = app
@@ -8,6 +8,7 @@ from sqlalchemy.orm.exc import NoResultFound
 from .settings import config
 from .models import App, LockerEntry, db
 from .api import api
+from .replicas import use_primary
 from .utils import get_uid, generate_pbw_url, asset_fallback, generate_image_url, plat_dimensions, jsonify_companion, jsonify_hardware_platforms, get_access_token, HARDWARE_SUPPORT
 
 
@@ -69,16 +70,22 @@ def jsonify_locker_app(entry):
     } if release and len(release.binaries) else {})}
 
 
+def locker_entries(uid):
+    return LockerEntry.query.filter_by(user_id=uid).options(joinedload(LockerEntry.app))
+
+
 @api.route("/locker")
+@use_primary
 def locker():
     uid = get_uid()
-    entries = LockerEntry.query.filter_by(user_id=uid).options(joinedload(LockerEntry.app))
+    entries = locker_entries(uid)
     response = jsonify({'applications': [jsonify_locker_app(x) for x in entries if x.app is not None]})
     response.headers['ETag'] = str(int(time.time()))
     return response
 
 
 @api.route("/locker/<app_uuid>", methods=['GET', 'PUT', 'DELETE'])
+@use_primary
 def app_locker(app_uuid):
     uid = get_uid()
     if request.method == 'GET':
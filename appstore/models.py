@@ -1,10 +1,52 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_migrate import Migrate
-from sqlalchemy import Table, desc, Date
+from sqlalchemy import Table, desc, Date, orm, event
 from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.sql.selectable import Select, CompoundSelect
 
-db = SQLAlchemy()
+from .query_stats import TimedQueuePool, TimedNullPool
+from .settings import config
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends plain SELECTs to the read replica the request picked (see
+    replicas.py), if it picked one.  Anything else might be a write, so goes
+    to the primary, and so does everything after it, so that the request
+    reads its own writes.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = g.get('db_replica') if has_app_context() else None
+        if replica is not None:
+            if not self._flushing and isinstance(clause, (Select, CompoundSelect)) and clause._for_update_arg is None:
+                return replica
+            g.db_replica = None
+        return super().get_bind(mapper, clause, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    timeout = g.get('db_statement_timeout') if has_request_context() else None
+    if timeout:
+        # SET LOCAL lasts only until the end of the transaction, so it can't
+        # leak to whoever gets this connection next, even through pgbouncer.
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Our Flask-SQLAlchemy predates SQLALCHEMY_ENGINE_OPTIONS.
+        result = super().apply_driver_hacks(app, sa_url, options)
+        options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        return result
+
+
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
 
@@ -101,7 +143,7 @@ class App(db.Model):
         db.session.commit()
 
     @classmethod
-    def generate_recent_hearts(cls):
+    def recent_hearts_update(cls):
         decay_cte = (
             db.select(
                 UserLike.app_id,
@@ -126,8 +168,11 @@ class App(db.Model):
                 )
             )
         )
+        return decay_update
 
-        db.session.execute(decay_update)
+    @classmethod
+    def generate_recent_hearts(cls):
+        db.session.execute(cls.recent_hearts_update())
         db.session.commit()
 
 category_banner_apps = Table('category_banner_apps', db.Model.metadata,
@@ -190,12 +235,14 @@ class Release(db.Model):
     compatibility = db.Column(ARRAY(db.Text))
     is_published = db.Column(db.Boolean)
 db.Index('release_app_compatibility_index', Release.compatibility, postgresql_using="gin")
+# App.releases is always loaded newest first.
+db.Index('release_app_published_date_index', Release.app_id, Release.published_date.desc())
 
 
 class Binary(db.Model):
     __tablename__ = "binaries"
     id = db.Column(db.Integer(), primary_key=True)
-    release_id = db.Column(db.String(24), db.ForeignKey('releases.id', ondelete='cascade'))
+    release_id = db.Column(db.String(24), db.ForeignKey('releases.id', ondelete='cascade'), index=True)
     release = db.relationship('Release', back_populates='binaries')
     platform = db.Column(db.String)
     sdk_major = db.Column(db.Integer)
@@ -229,6 +276,50 @@ class UserFlag(db.Model):
     app = db.relationship('App')
 db.Index('user_flag_app_user_index', UserFlag.app_id, UserFlag.user_id, unique=True)
 
+class PreviewRender(db.Model):
+    """
+    Apps whose preview image needs rendering by `flask apps preview-worker`.
+    """
+    __tablename__ = "preview_renders"
+    app_id = db.Column(db.String(24), db.ForeignKey('apps.id', ondelete='cascade'), primary_key=True)
+    requested_at = db.Column(db.DateTime, nullable=False, index=True)
+    claimed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_error = db.Column(db.String)
+
+class DiscordMessage(db.Model):
+    """
+    Webhook messages waiting to be sent by `flask apps discord-worker`.
+    """
+    __tablename__ = "discord_messages"
+    id = db.Column(db.Integer(), primary_key=True)
+    # The config key holding the webhook URL, rather than the URL itself.
+    hook = db.Column(db.String, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    # Whether this may be sent in the same message as its neighbours.
+    coalescable = db.Column(db.Boolean, nullable=False, default=False, server_default='false')
+    created_at = db.Column(db.DateTime, nullable=False)
+    available_at = db.Column(db.DateTime, nullable=False, index=True)
+    claimed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_error = db.Column(db.String)
+
+class DiscourseAnnouncement(db.Model):
+    """
+    Forum posts waiting to be made by `flask apps discourse-worker`.
+    """
+    __tablename__ = "discourse_announcements"
+    id = db.Column(db.Integer(), primary_key=True)
+    # One announcement per app or release, however many times it is queued.
+    idempotency_key = db.Column(db.String, nullable=False, unique=True)
+    app_id = db.Column(db.String(24), db.ForeignKey('apps.id', ondelete='cascade'), nullable=False, index=True)
+    release_id = db.Column(db.String(24), db.ForeignKey('releases.id', ondelete='cascade'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    available_at = db.Column(db.DateTime, nullable=False, index=True)
+    claimed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_error = db.Column(db.String)
+
 class AvailableArchive(db.Model):
     """
     Archives in S3 of the appstore database.
@@ -237,8 +328,30 @@ class AvailableArchive(db.Model):
     id = db.Column(db.Integer(), primary_key=True, index=True)
     created_at = db.Column(db.DateTime, index=True)
     filename = db.Column(db.String)
+    # Set for delta archives, which only hold the assets and PBWs that aren't
+    # already in this full archive or an earlier delta on it.
+    base_id = db.Column(db.Integer(), db.ForeignKey('available_archives.id'), nullable=True, index=True)
+
+def engine_options():
+    options = dict(config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if config['DATABASE_PGBOUNCER']:
+        # pgbouncer pools connections already; holding on to them here as
+        # well would only tie up its server connections.  Nothing here uses
+        # session state (session-level SETs, prepared statements, advisory
+        # locks or LISTEN), so transaction mode is safe.
+        for option in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_pre_ping'):
+            options.pop(option, None)
+        options['poolclass'] = TimedNullPool
+    else:
+        options['poolclass'] = TimedQueuePool
+    return options
+
+def _choose_statement_timeout():
+    g.db_statement_timeout = config['DATABASE_ROUTE_STATEMENT_TIMEOUTS'].get(request.endpoint, config['DATABASE_STATEMENT_TIMEOUT'])
 
 def init_app(app):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    app.before_request(_choose_statement_timeout)
     db.init_app(app)
     migrate.init_app(app, db)
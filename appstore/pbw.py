@@ -15,6 +15,46 @@ from .utils import id_generator
 PLATFORMS = ['aplite', 'basalt', 'chalk', 'diorite', 'emery', 'flint', 'gabbro']
 GENERATED_ID_PREFIX = "13371337"
 
+class PBWBundle(object):
+    """
+    A PBW archive opened once and shared between every platform in it.
+    Per-platform access goes through PBW, which is a thin view that keeps
+    manifests and binary headers cached here, keyed by their real path in the
+    archive.
+    """
+    def __init__(self, pbw):
+        self.path = None
+        # pbw can be file path or bytes bundle. Determine which
+        if isinstance(pbw, str):
+            bundle_abs_path = os.path.abspath(pbw)
+            if not os.path.exists(bundle_abs_path):
+                raise Exception("Bundle does not exist: " + pbw)
+
+            self.path = bundle_abs_path
+
+            with open(bundle_abs_path, "rb") as fh:
+                bundle = io.BytesIO(fh.read())
+        else:
+            bundle = io.BytesIO(pbw)
+
+        self.zip = zipfile.ZipFile(bundle)
+        self.contents = set(self.zip.namelist())
+        self.manifests = {}
+        self.headers = {}
+        self._views = {}
+
+    def for_platform(self, platform):
+        if platform not in self._views:
+            self._views[platform] = PBW(self, platform)
+        return self._views[platform]
+
+    def platforms(self):
+        return [platform for platform in PLATFORMS if self.for_platform(platform).has_platform]
+
+    def close(self):
+        self.zip.close()
+
+
 class PBW(object):
     MANIFEST_FILENAME = 'manifest.json'
     UNIVERSAL_FILES = {'appinfo.json', 'pebble-js-app.js'}
@@ -36,6 +76,9 @@ class PBW(object):
             '16s'   # uuid
     ]
 
+    app_metadata_struct = struct.Struct(''.join(STRUCT_DEFINITION))
+    app_metadata_length_bytes = app_metadata_struct.size
+
     PLATFORM_PATHS = {
         'aplite': ('aplite/', ''),
         'basalt': ('basalt/',),
@@ -47,27 +90,15 @@ class PBW(object):
     }
 
     def __init__(self, pbw, platform):
+        # pbw can be an already opened PBWBundle, or anything PBWBundle
+        # itself accepts.
+        if not isinstance(pbw, PBWBundle):
+            pbw = PBWBundle(pbw)
+        self.bundle = pbw
         self.platform = platform
-        # pbw can be file path or bytes bundle. Determine which
-        if isinstance(pbw, str):
-            bundle_abs_path = os.path.abspath(pbw)
-            if not os.path.exists(bundle_abs_path):
-                raise Exception("Bundle does not exist: " + pbw)
-
-            self.path = bundle_abs_path
-
-            with open(bundle_abs_path, "rb") as fh:
-                bundle = io.BytesIO(fh.read())
-        else:
-            bundle = io.BytesIO(pbw)
-
-        self.zip = zipfile.ZipFile(bundle)
-        self.manifest = None
-        self.header = None
-        self._zip_contents = set(self.zip.namelist())
-
-        self.app_metadata_struct = struct.Struct(''.join(self.STRUCT_DEFINITION))
-        self.app_metadata_length_bytes = self.app_metadata_struct.size
+        self.path = pbw.path
+        self.zip = pbw.zip
+        self._zip_contents = pbw.contents
 
         self.print_pbl_logs = False
 
@@ -87,26 +118,28 @@ class PBW(object):
             return None
 
     def get_manifest(self):
-        if self.manifest:
-            return self.manifest
+        manifest_path = self.get_real_path(self.MANIFEST_FILENAME)
+        if manifest_path in self.bundle.manifests:
+            return self.bundle.manifests[manifest_path]
 
-        if self.get_real_path(self.MANIFEST_FILENAME) not in self.zip.namelist():
+        if manifest_path not in self._zip_contents:
             raise FileNotFoundError("Could not find {}; are you sure this is a PebbleBundle?".format(self.MANIFEST_FILENAME))
 
-        self.manifest = json.loads(self.zip.read(self.get_real_path(self.MANIFEST_FILENAME)).decode('utf-8'))
-        return self.manifest
+        manifest = json.loads(self.zip.read(manifest_path).decode('utf-8'))
+        self.bundle.manifests[manifest_path] = manifest
+        return manifest
 
     def get_app_metadata(self):
-        if self.header:
-            return self.header
-
         app_manifest = self.get_manifest()['application']
+        app_path = self.get_real_path(app_manifest['name'])
+        if app_path in self.bundle.headers:
+            return self.bundle.headers[app_path]
 
-        app_bin = self.zip.open(self.get_real_path(app_manifest['name'])).read()
-
-        header = app_bin[0:self.app_metadata_length_bytes]
+        # Only the header is needed, so don't inflate the whole binary.
+        with self.zip.open(app_path) as f:
+            header = f.read(self.app_metadata_length_bytes)
         values = self.app_metadata_struct.unpack(header)
-        self.header = {
+        self.bundle.headers[app_path] = {
             'sentinel': values[0],
             'struct_version_major': values[1],
             'struct_version_minor': values[2],
@@ -125,15 +158,15 @@ class PBW(object):
             'num_relocation_entries': values[15],
             'uuid': uuid.UUID(bytes=values[16])
         }
-        return self.header
+        return self.bundle.headers[app_path]
 
     def is_generated(self):
         with self.zip.open('appinfo.json') as f:
             appinfo = json.load(f)
-            return str(appinfo["uuid"]).startswith(GENERATED_ID_PREFIX)
+            return str(appinfo.get("uuid", "")).startswith(GENERATED_ID_PREFIX)
 
     def close(self):
-        self.zip.close()
+        self.bundle.close()
 
     @property
     def is_app_bundle(self):
@@ -149,7 +182,7 @@ class PBW(object):
 
     @property
     def has_javascript(self):
-        return 'pebble-js-app.js' in [x.filename for x in self.zip.filelist]
+        return 'pebble-js-app.js' in self._zip_contents
 
     @property
     def has_platform(self):
@@ -183,30 +216,59 @@ class PBW(object):
         return self.get_real_path(self.get_worker_info()['name'])
 
     def get_capabilities(self):
+        # Some SDK versions write an empty string where there are none.
         with self.zip.open('appinfo.json') as f:
-            return json.load(f).get('capabilities', [])
+            return [x for x in json.load(f).get('capabilities', []) if x != '']
     
+    def get_binary_values(self):
+        metadata = self.get_app_metadata()
+        return {
+            'sdk_major': metadata['sdk_version_major'],
+            'sdk_minor': metadata['sdk_version_minor'],
+            'process_info_flags': metadata['flags'],
+            'icon_resource_id': metadata['icon_resource_id'],
+        }
+
     def create_binary(self, release):
         if not self.has_platform:
             return
-        metadata = self.get_app_metadata()
-        binary = Binary(release=release, platform=self.platform,
-                        sdk_major=metadata['sdk_version_major'], sdk_minor=metadata['sdk_version_minor'],
-                        process_info_flags=metadata['flags'], icon_resource_id=metadata['icon_resource_id'])
+        binary = Binary(release=release, platform=self.platform, **self.get_binary_values())
         db.session.add(binary)
-        
-def release_from_pbw(app, bundle, release_notes=None, published_date=datetime.datetime.utcnow(), version='', compatibility=[]):
-    pbw = PBW(bundle, 'aplite')
+
+def extract_release_metadata(bundle):
+    """
+    Everything a Release and its Binary rows take from a PBW, as plain data,
+    so that it can be worked out in another process.
+    """
+    if not isinstance(bundle, PBWBundle):
+        bundle = PBWBundle(bundle)
+    pbw = bundle.for_platform('aplite')
     js_md5 = None
     if pbw.has_javascript:
         with pbw.zip.open('pebble-js-app.js', 'r') as f:
             js_md5 = hashlib.md5(f.read()).hexdigest()
+    return {
+        'capabilities': pbw.get_capabilities(),
+        'js_md5': js_md5,
+        'is_generated': pbw.is_generated(),
+        'binaries': {platform: bundle.for_platform(platform).get_binary_values() for platform in bundle.platforms()},
+    }
+        
+def release_from_pbw(app, bundle, release_notes=None, published_date=datetime.datetime.utcnow(), version='', compatibility=[]):
+    return release_from_metadata(app, extract_release_metadata(bundle), release_notes=release_notes,
+                                 published_date=published_date, version=version, compatibility=compatibility)
+
+def release_from_metadata(app, metadata, release_notes=None, published_date=None, version='', compatibility=[]):
+    """
+    release_from_pbw, given what extract_release_metadata found in the PBW
+    rather than the PBW itself.
+    """
     release = Release(
         id=id_generator.generate(),
         app_id=app.id,
         has_pbw=True,
-        capabilities=pbw.get_capabilities(),
-        js_md5=js_md5,
+        capabilities=metadata['capabilities'],
+        js_md5=metadata['js_md5'],
         published_date=published_date,
         release_notes=release_notes,
         version=version,
@@ -215,8 +277,7 @@ def release_from_pbw(app, bundle, release_notes=None, published_date=datetime.da
     )
     db.session.add(release)
     
-    for platform in PLATFORMS:
-        pbw = PBW(bundle, platform)
-        pbw.create_binary(release)
+    for platform, values in metadata['binaries'].items():
+        db.session.add(Binary(release=release, platform=platform, **values))
     
     return release
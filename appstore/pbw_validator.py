@@ -0,0 +1,316 @@
+import array
+import json
+import multiprocessing
+import signal
+import struct
+import sys
+import zipfile
+import zlib
+import resource
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from .pbw import PBWBundle, PLATFORMS, extract_release_metadata
+from .settings import config
+
+# Zip bomb limits.  Real PBWs are a few hundred KB at most; these leave a lot
+# of headroom while still refusing anything absurd.
+MAX_ENTRIES = 256
+MAX_UNCOMPRESSED_BYTES = 32 * 1024 * 1024
+MAX_COMPRESSION_RATIO = 100
+# Compression ratios of tiny (or all-zero) files are meaningless.
+RATIO_CHECK_MIN_BYTES = 1024 * 1024
+
+APP_SENTINEL = b'PBLAPP\0\0'
+
+# See pbpack.py in the SDK: a 12 byte header (file count, content CRC,
+# timestamp), then a fixed size table of 16 byte entries, then the content.
+PBPACK_HEADER = struct.Struct('<III')
+PBPACK_ENTRY = struct.Struct('<IIII')
+PBPACK_TABLE_ENTRIES = 256
+PBPACK_CONTENT_START = PBPACK_HEADER.size + PBPACK_TABLE_ENTRIES * PBPACK_ENTRY.size
+
+
+class ValidationTimeout(Exception):
+    pass
+
+
+# Bit-reversed bytes, to get zlib's (reflected) CRC-32 to compute the
+# unreflected one the watch uses.
+_BIT_REVERSE = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def stm32_crc(data):
+    # The CRC the watch's hardware CRC unit produces: CRC-32/MPEG-2 over
+    # 32-bit little-endian words, fed most significant byte first, with a
+    # trailing partial word padded in its own peculiar way.  This does it
+    # all in C, by rearranging the bytes so that zlib.crc32 computes it: a
+    # 32MB pack takes well under a second, where a byte-at-a-time loop in
+    # Python took several.
+    whole = len(data) - len(data) % 4
+    words = array.array('I', data[:whole])  # 'I' is 4 bytes everywhere we run
+    if sys.byteorder == 'little':
+        words.byteswap()
+    tail = data[whole:]
+    stream = words.tobytes() + (b'\0' * (4 - len(tail)) + tail if tail else b'')
+    crc = zlib.crc32(stream.translate(_BIT_REVERSE)) ^ 0xffffffff
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+def _error(result, e, message):
+    result['errors'].append({'error': message, 'e': e})
+
+
+def _check_zip_limits(zf, result):
+    infos = zf.infolist()
+    if len(infos) > MAX_ENTRIES:
+        _error(result, 'pbw.toomanyfiles', f"Your pbw file contains too many files ({len(infos)}, maximum {MAX_ENTRIES})")
+        return False
+
+    total = 0
+    for info in infos:
+        total += info.file_size
+        if info.file_size > RATIO_CHECK_MIN_BYTES and info.file_size > info.compress_size * MAX_COMPRESSION_RATIO:
+            _error(result, 'pbw.toolarge', f"{info.filename} in your pbw file is compressed suspiciously well")
+            return False
+    if total > MAX_UNCOMPRESSED_BYTES:
+        _error(result, 'pbw.toolarge', f"Your pbw file is too large when uncompressed ({total} bytes, maximum {MAX_UNCOMPRESSED_BYTES})")
+        return False
+
+    return True
+
+
+def _read_limited(zf, path):
+    # The sizes in the central directory are only a claim; don't let a
+    # lying entry inflate past it.
+    info = zf.getinfo(path)
+    with zf.open(info) as f:
+        data = f.read(info.file_size + 1)
+    if len(data) != info.file_size:
+        raise zipfile.BadZipFile(f"{path} is not the size it claims to be")
+    return data
+
+
+def _check_binary(pbw, kind, info, appinfo, result):
+    platform = pbw.platform
+    path = pbw.get_real_path(info['name'])
+    if path is None:
+        _error(result, 'pbw.binary.missing', f"The {platform} {kind} binary listed in the manifest is missing")
+        return
+    data = _read_limited(pbw.zip, path)
+
+    if len(data) < pbw.app_metadata_length_bytes:
+        _error(result, 'pbw.binary.truncated', f"The {platform} {kind} binary is too short to contain a header")
+        return
+    header = pbw.app_metadata_struct.unpack(data[:pbw.app_metadata_length_bytes])
+    sentinel, app_size, header_crc, app_uuid = header[0], header[7], header[9], header[16]
+
+    if sentinel != APP_SENTINEL:
+        _error(result, 'pbw.binary.sentinel', f"The {platform} {kind} binary does not start with a valid app header")
+    if 'size' in info and info['size'] != len(data):
+        _error(result, 'pbw.binary.size', f"The {platform} {kind} binary is {len(data)} bytes, but the manifest says {info['size']}")
+    if app_size > len(data):
+        _error(result, 'pbw.binary.size', f"The {platform} {kind} binary header claims more data than the binary contains")
+    if 'crc' in info:
+        # Depending on the SDK that built it, the manifest CRC is either the
+        # one from the binary's header or that of the whole file.
+        if info['crc'] != header_crc and info['crc'] != stm32_crc(data):
+            _error(result, 'pbw.binary.crc', f"The {platform} {kind} binary does not match the CRC in its manifest")
+    if appinfo and 'uuid' in appinfo and sentinel == APP_SENTINEL:
+        if str(appinfo['uuid']).lower().replace('-', '') != app_uuid.hex():
+            _error(result, 'pbw.binary.uuid', f"The {platform} {kind} binary was built for a different UUID than the one in appinfo.json")
+
+
+def _check_resources(pbw, info, result):
+    platform = pbw.platform
+    path = pbw.get_real_path(info['name'])
+    if path is None:
+        _error(result, 'pbw.resources.missing', f"The {platform} resource pack listed in the manifest is missing")
+        return
+    data = _read_limited(pbw.zip, path)
+
+    if 'size' in info and info['size'] != len(data):
+        _error(result, 'pbw.resources.size', f"The {platform} resource pack is {len(data)} bytes, but the manifest says {info['size']}")
+    if len(data) < PBPACK_CONTENT_START:
+        _error(result, 'pbw.resources.truncated', f"The {platform} resource pack is too short to contain a resource table")
+        return
+
+    num_files, content_crc, _ = PBPACK_HEADER.unpack_from(data, 0)
+    if num_files > PBPACK_TABLE_ENTRIES:
+        _error(result, 'pbw.resources.table', f"The {platform} resource pack claims to contain {num_files} resources")
+        return
+
+    content = memoryview(data)[PBPACK_CONTENT_START:]
+    for i in range(num_files):
+        _, offset, length, crc = PBPACK_ENTRY.unpack_from(data, PBPACK_HEADER.size + i * PBPACK_ENTRY.size)
+        if offset + length > len(content):
+            _error(result, 'pbw.resources.table', f"Resource {i + 1} in the {platform} resource pack points outside the pack")
+            return
+        if stm32_crc(bytes(content[offset:offset + length])) != crc:
+            _error(result, 'pbw.resources.crc', f"Resource {i + 1} in the {platform} resource pack is corrupt")
+            return
+
+    if 'crc' in info and info['crc'] != content_crc and info['crc'] != stm32_crc(data):
+        _error(result, 'pbw.resources.crc', f"The {platform} resource pack does not match the CRC in its manifest")
+
+
+def validate_pbw(pbw_file):
+    """
+    Structurally validate a PBW, given as bytes.  This never raises for a bad
+    bundle; it returns a dict with 'valid', a list of 'errors' (each with
+    'error' and 'e', as the dev portal API reports them), any 'warnings', the
+    parsed 'appinfo' and the 'platforms' that have binaries.  A valid PBW
+    also gets the release 'metadata' (see pbw.extract_release_metadata), so
+    that the caller never has to open the bundle itself.
+    """
+    result = {'valid': False, 'errors': [], 'warnings': [], 'appinfo': None, 'platforms': [], 'metadata': None}
+    try:
+        bundle = PBWBundle(pbw_file)
+        if not _check_zip_limits(bundle.zip, result):
+            return result
+
+        if 'appinfo.json' not in bundle.contents:
+            _error(result, 'invalid.pbw', "Your pbw file does not contain an appinfo.json")
+            return result
+        appinfo = json.loads(_read_limited(bundle.zip, 'appinfo.json').decode('utf-8'))
+        if not isinstance(appinfo, dict):
+            _error(result, 'invalid.appinfocontent', "The appinfo.json in your pbw file is not a JSON object")
+            return result
+        result['appinfo'] = appinfo
+
+        platforms = bundle.platforms()
+        result['platforms'] = platforms
+        if not platforms:
+            _error(result, 'invalid.pbw', "Your pbw file does not contain a binary for any platform")
+            return result
+
+        for platform in platforms:
+            pbw = bundle.for_platform(platform)
+            if not pbw.is_app_bundle:
+                _error(result, 'invalid.pbw', f"The {platform} manifest does not describe an app")
+                continue
+            _check_binary(pbw, 'app', pbw.get_application_info(), appinfo, result)
+            if pbw.has_worker:
+                _check_binary(pbw, 'worker', pbw.get_worker_info(), appinfo, result)
+            if pbw.has_resources:
+                _check_resources(pbw, pbw.get_resources_info(), result)
+
+        target_platforms = appinfo.get('targetPlatforms')
+        if isinstance(target_platforms, list):
+            for platform in target_platforms:
+                if platform in PLATFORMS and platform not in platforms:
+                    _error(result, 'pbw.platform.missing', f"targetPlatforms in appinfo.json includes {platform}, but there is no {platform} binary")
+            for platform in platforms:
+                if platform not in target_platforms:
+                    result['warnings'].append(f"Your pbw file contains a {platform} binary, but {platform} is not in targetPlatforms")
+
+        if not result['errors']:
+            result['metadata'] = extract_release_metadata(bundle)
+    except ValidationTimeout:
+        _error(result, 'pbw.timeout', "Your pbw file took too long to validate")
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, KeyError, ValueError, struct.error, EOFError, NotImplementedError, OSError):
+        # ValueError covers JSON and unicode errors; NotImplementedError an
+        # unsupported compression method.
+        _error(result, 'invalid.pbw', "Your pbw file is invalid or corrupted")
+
+    result['valid'] = len(result['errors']) == 0
+    return result
+
+
+def _raise_timeout(signum, frame):
+    raise ValidationTimeout()
+
+
+def _validate_with_limits(pbw_file, time_limit, cpu_limit, memory_limit):
+    # Runs in a pool worker.  The alarm handles a bundle that is merely slow;
+    # the CPU rlimit is a backstop that kills the worker outright if the
+    # alarm somehow doesn't fire.  (The limits are set here rather than in a
+    # pool initializer because python 3.6 doesn't have those.)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = used + cpu_limit
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+    old_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, time_limit)
+    try:
+        return validate_pbw(pbw_file)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking from a web worker that is running other threads can
+            # leave the child holding a lock nobody will ever release, so
+            # spawn where we can (3.7+).  On 3.6 the pool forks; prewarm()
+            # makes sure that happens before gunicorn starts its threads, but
+            # a pool replaced after a timeout is forked from a busy worker.
+            if sys.version_info >= (3, 7):
+                _pool = ProcessPoolExecutor(max_workers=config['PBW_VALIDATION_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+            else:
+                _pool = ProcessPoolExecutor(max_workers=config['PBW_VALIDATION_WORKERS'])
+        return _pool
+
+
+def prewarm():
+    # Start the pool's processes now, while the caller is still single
+    # threaded, rather than on the first upload.
+    if config['PBW_VALIDATION_WORKERS'] > 0:
+        pool = _get_pool()
+        for future in [pool.submit(int) for _ in range(config['PBW_VALIDATION_WORKERS'])]:
+            future.result()
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _failed(e, message):
+    return {'valid': False, 'errors': [{'error': message, 'e': e}], 'warnings': [], 'appinfo': None, 'platforms': [], 'metadata': None}
+
+
+def validate_pbw_isolated(pbw_file):
+    """
+    Validate a PBW in a worker process, so that a large or malicious bundle
+    can't stall the calling web worker.  Returns the same structure as
+    validate_pbw.  With PBW_VALIDATION_WORKERS set to 0 (e.g. on Lambda,
+    which can't run a process pool) it validates inline instead.
+    """
+    time_limit = config['PBW_VALIDATION_TIMEOUT']
+    if config['PBW_VALIDATION_WORKERS'] == 0:
+        return validate_pbw(pbw_file)
+
+    pool = _get_pool()
+    try:
+        future = pool.submit(_validate_with_limits, pbw_file, time_limit, config['PBW_VALIDATION_CPU_LIMIT'],
+                             config['PBW_VALIDATION_MEMORY_LIMIT'])
+        # A little grace on top of the worker's own alarm.
+        return future.result(timeout=time_limit + 5)
+    except TimeoutError:
+        # The worker is wedged; abandon the whole pool rather than have
+        # later submissions queue up behind it.
+        _discard_pool(pool)
+        return _failed('pbw.timeout', "Your pbw file took too long to validate")
+    except (BrokenProcessPool, MemoryError):
+        # Killed by one of its rlimits.
+        _discard_pool(pool)
+        return _failed('pbw.toolarge', "Your pbw file used too many resources to validate")
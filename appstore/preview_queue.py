@@ -0,0 +1,227 @@
+import datetime
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from PIL import Image
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import PendingRollbackError
+
+from .derivatives import app_derivative_jobs, fill_missing_derivatives
+from .image import generate_preview_canvas, encode_preview, preview_variant_id, supported_preview_formats, static_folder, PREVIEW_FORMATS, PREVIEW_WIDTHS
+from .models import db, App, PreviewRender
+from .s3 import upload_asset, download_asset
+from .settings import config
+from .utils import id_generator, valid_platforms
+
+# With QUEUE_WORKERS=external, previews are rendered by `flask apps
+# preview-worker` (or workers.drain_queues on Lambda), never in a web request:
+# uploads and edits queue a render, and the route serves whatever is in S3,
+# or a placeholder while the worker catches up.  Otherwise there is no
+# worker, and the route renders a missing preview itself.
+
+def enqueue_preview_render(app_id, replace=True):
+    now = datetime.datetime.utcnow()
+    statement = insert(PreviewRender).values(app_id=app_id, requested_at=now, attempts=0)
+    if replace:
+        # A render already in flight is working from stale assets, so bump
+        # the request; the worker will notice and go round again.
+        statement = statement.on_conflict_do_update(index_elements=[PreviewRender.app_id],
+                                                    set_={'requested_at': now, 'attempts': 0})
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=[PreviewRender.app_id])
+    db.session.execute(statement)
+
+def invalidate_preview(app):
+    app.preview_image = None
+    if config['QUEUE_WORKERS'] == 'external':
+        enqueue_preview_render(app.id)
+
+def ensure_preview(app):
+    # For new apps and releases: queue a render if there's no preview yet,
+    # without disturbing one already on its way.
+    if not app.preview_image and config['QUEUE_WORKERS'] == 'external':
+        enqueue_preview_render(app.id, replace=False)
+
+@lru_cache(maxsize=None)
+def placeholder_png():
+    # Read straight off disk; the web tier shouldn't need PIL for this.
+    with open(os.path.join(static_folder, 'background.png'), 'rb') as f:
+        return f.read()
+
+def preview_inputs(app):
+    screenshots = {}
+    for hw in valid_platforms:
+        if hw in app.asset_collections and app.asset_collections[hw].screenshots:
+            screenshots[hw] = app.asset_collections[hw].screenshots[0]
+
+    icon = None
+    if app.type == 'watchapp':
+        icon = app.icon_large
+
+    return {'title': app.title, 'developer': app.developer.name, 'icon': icon, 'screenshots': screenshots}
+
+def upload_preview_variant(body, fmt, id):
+    buf = io.BytesIO(body)
+    # HACK: upload_asset puts this in a print, which is only really valid for actual Files...
+    setattr(buf, 'name', f"preview.{fmt}")
+    return upload_asset(buf, mime_type = PREVIEW_FORMATS[fmt]['mime_type'], path = config['S3_PREVIEW_PATH'], id = id)
+
+def render_preview_now(app, fmt, width):
+    """
+    Render `app`'s preview in this request, for when there's no worker to do
+    it.  Stores the full size PNG, which every other variant is derived
+    from, and the variant asked for, and returns the latter's bytes.
+    """
+    canvas = generate_preview_canvas(**preview_inputs(app))
+    png = encode_preview(canvas, 'png')
+    asset = upload_preview_variant(png, 'png', None)
+
+    body = png
+    if preview_variant_id(asset, fmt, width) != asset:
+        body = encode_preview(canvas, fmt, width)
+        upload_preview_variant(body, fmt, preview_variant_id(asset, fmt, width))
+
+    app.preview_image = asset
+    try:
+        db.session.commit()
+    except PendingRollbackError:
+        # if someone else gets to it at the same time, no big deal
+        pass
+    return body
+
+def derive_preview_variant(app, fmt, width):
+    # First request for this variant of a preview rendered in a request;
+    # derive it from the full size PNG.
+    png = io.BytesIO()
+    download_asset(app.preview_image, png, path = config['S3_PREVIEW_PATH'])
+    png.seek(0)
+    body = encode_preview(Image.open(png), fmt, width)
+    upload_preview_variant(body, fmt, preview_variant_id(app.preview_image, fmt, width))
+    return body
+
+def render_and_store_preview(inputs, asset, derivative_jobs=()):
+    # Runs in a worker process.  `asset` comes from the parent, since forked
+    # children would all share its id_generator state.
+    canvas = generate_preview_canvas(**inputs)
+    for fmt in supported_preview_formats():
+        for width in PREVIEW_WIDTHS:
+            upload_preview_variant(encode_preview(canvas, fmt, width), fmt, preview_variant_id(asset, fmt, width))
+    # Where uploads don't make their own derivatives (see
+    # derivatives.queue_derivatives), this is where they get them.
+    fill_missing_derivatives(derivative_jobs)
+    return asset
+
+def claim_preview_renders(limit):
+    now = datetime.datetime.utcnow()
+    # A claim older than the lease belongs to a worker that died, or is a
+    # failure waiting out its backoff.
+    lease_expiry = now - datetime.timedelta(seconds=config['PREVIEW_RENDER_LEASE'])
+    jobs = (PreviewRender.query
+            .filter(or_(PreviewRender.claimed_at == None, PreviewRender.claimed_at < lease_expiry))
+            .filter(PreviewRender.attempts < config['PREVIEW_RENDER_MAX_ATTEMPTS'])
+            .order_by(PreviewRender.requested_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+    claimed = []
+    for job in jobs:
+        job.claimed_at = now
+        job.attempts += 1
+        claimed.append((job.app_id, job.requested_at))
+    db.session.commit()
+    return claimed
+
+def finish_preview_render(app_id, requested_at, asset):
+    App.query.filter(App.id == app_id).update({'preview_image': asset}, synchronize_session=False)
+    done = (PreviewRender.query
+            .filter(PreviewRender.app_id == app_id, PreviewRender.requested_at == requested_at)
+            .delete(synchronize_session=False))
+    if not done:
+        # Invalidated again while we were rendering.
+        PreviewRender.query.filter(PreviewRender.app_id == app_id).update({'claimed_at': None}, synchronize_session=False)
+    db.session.commit()
+
+def fail_preview_render(app_id, error):
+    # Leave the claim in place, so that it is retried once the lease runs
+    # out; after PREVIEW_RENDER_MAX_ATTEMPTS it stays put until the app is
+    # next invalidated.
+    job = PreviewRender.query.get(app_id)
+    if job is not None:
+        job.last_error = error[:1000]
+        if job.attempts >= config['PREVIEW_RENDER_MAX_ATTEMPTS']:
+            print(f"Giving up on the preview for {app_id} after {job.attempts} attempts: {error}")
+    db.session.commit()
+
+def _render_pool(processes):
+    # No processes means render in this one, as on Lambda, which can't run
+    # a process pool.
+    if processes:
+        return ProcessPoolExecutor(max_workers=processes)
+    return ThreadPoolExecutor(max_workers=1)
+
+def run_preview_worker(processes, batch_size, poll_interval, once, deadline=None):
+    rendered = 0
+    failed = 0
+    start = time.time()
+
+    pool = _render_pool(processes)
+    try:
+        while True:
+            if deadline is not None and time.time() >= deadline:
+                break
+            jobs = claim_preview_renders(batch_size)
+            if not jobs:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            pending = {}
+            for app_id, requested_at in jobs:
+                try:
+                    app = App.query.get(app_id)
+                    inputs = preview_inputs(app)
+                    derivative_jobs = app_derivative_jobs(app) if config['IMAGE_DERIVATIVE_WORKERS'] == 0 else []
+                except Exception as e:
+                    # One broken app mustn't take the whole worker down.
+                    print(f"Failed to gather the preview inputs for {app_id}: {e}")
+                    fail_preview_render(app_id, f"{type(e).__name__}: {e}")
+                    failed += 1
+                    continue
+                future = pool.submit(render_and_store_preview, inputs, id_generator.generate(), derivative_jobs)
+                pending[future] = (app_id, requested_at)
+            db.session.rollback()  # don't sit idle in a transaction while we render
+
+            broken = False
+            for future in as_completed(pending):
+                app_id, requested_at = pending[future]
+                try:
+                    asset = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    fail_preview_render(app_id, f"worker died: {e}")
+                    failed += 1
+                    continue
+                except Exception as e:
+                    print(f"Failed to render preview for {app_id}: {e}")
+                    fail_preview_render(app_id, f"{type(e).__name__}: {e}")
+                    failed += 1
+                    continue
+                finish_preview_render(app_id, requested_at, asset)
+                rendered += 1
+
+            if broken:
+                pool.shutdown(wait=False)
+                pool = _render_pool(processes)
+
+            elapsed = time.time() - start
+            print(f"... {rendered} previews rendered, {failed} failed ({rendered / max(elapsed, 0.001):.2f}/s) ...")
+    finally:
+        pool.shutdown()
+
+    return rendered, failed
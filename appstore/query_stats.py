@@ -0,0 +1,106 @@
+import random
+import re
+import time
+
+import beeline
+from flask import g, has_request_context, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+from .settings import config
+
+# Counts and times the SQL each request runs, and puts the totals on its
+# honeycomb span, so that a route that has grown an N+1 stands out.
+# Statements run outside a request (commands, workers) aren't counted.  So
+# is the time spent waiting for a connection from the pool, which is where
+# it shows first when something is holding on to them all.
+
+_placeholder = re.compile(r"%\(\w+\)s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_placeholder_list = re.compile(r"\?(?:\s*,\s*\?)+")
+
+def fingerprint(statement):
+    """
+    `statement` with its parameters and literals taken out, so that the
+    same query is recognisable however it was called.
+    """
+    statement = _placeholder.sub('?', statement)
+    statement = _placeholder_list.sub('?, ...', statement)
+    return ' '.join(statement.split())[:500]
+
+def _before_request():
+    g.sql_count = 0
+    g.sql_ms = 0.0
+    g.sql_slowest = (0.0, None)
+    g.sql_pool_wait_ms = 0.0
+    g.sql_checkouts = 0
+    rate = config['SQL_TRACE_SAMPLE_RATE']
+    g.sql_spans = rate > 0 and random.randrange(rate) == 0
+
+def _teardown_request(exception):
+    if 'sql_count' not in g:
+        return
+    beeline.add_context_field('db.query_count', g.sql_count)
+    beeline.add_context_field('db.total_ms', round(g.sql_ms, 2))
+    beeline.add_context_field('db.pool_checkouts', g.sql_checkouts)
+    beeline.add_context_field('db.pool_wait_ms', round(g.sql_pool_wait_ms, 2))
+    slowest_ms, slowest = g.sql_slowest
+    if slowest is not None:
+        beeline.add_context_field('db.slowest_ms', round(slowest_ms, 2))
+        beeline.add_context_field('db.slowest_statement', slowest)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or 'sql_count' not in g:
+        return
+    span = None
+    if g.sql_spans:
+        span = beeline.start_span(context={'name': 'sql', 'db.statement': fingerprint(statement)})
+    conn.info.setdefault('query_stats', []).append((time.perf_counter(), span))
+
+def _finish(conn, statement):
+    if not conn.info.get('query_stats'):
+        return
+    start, span = conn.info['query_stats'].pop()
+    ms = (time.perf_counter() - start) * 1000
+    if span is not None:
+        beeline.add_context_field('db.duration_ms', round(ms, 2))
+        beeline.finish_span(span)
+
+    g.sql_count += 1
+    g.sql_ms += ms
+    if ms > g.sql_slowest[0]:
+        g.sql_slowest = (ms, fingerprint(statement))
+    if ms >= config['SQL_SLOW_QUERY_MS']:
+        current_app.logger.warning("Slow query (%.0f ms) in %s: %s", ms, request.endpoint, fingerprint(statement))
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _finish(conn, statement)
+
+def _handle_error(context):
+    # Failed statements count too; they took their time all the same.
+    _finish(context.connection, context.statement)
+
+class _TimedCheckout:
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if has_request_context() and 'sql_count' in g:
+                g.sql_checkouts += 1
+                g.sql_pool_wait_ms += (time.perf_counter() - start) * 1000
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+class TimedNullPool(_TimedCheckout, NullPool):
+    pass
+
+def init_app(app):
+    app.before_request(_before_request)
+    # Teardown functions run last-registered first, so this has to be set up
+    # after honeycomb for the fields to make it onto the request span.
+    app.teardown_request(_teardown_request)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
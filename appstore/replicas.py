@@ -0,0 +1,76 @@
+import random
+import threading
+import time
+
+import beeline
+from flask import current_app, g, request
+from sqlalchemy import create_engine, text
+
+from .settings import config
+
+# GET requests to the read-mostly blueprints have their SELECTs sent to a
+# read replica, if there is one that isn't too far behind; the session
+# (models.RoutingSession) sends writes, and everything after them, to the
+# primary regardless.  Views that must see what the same user just wrote
+# can insist on the primary with @use_primary.
+
+read_blueprints = {'api', 'sitemap', 'legacy_api', 'devportal_api'}
+
+_lag_query = text("""
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+""")
+
+class Replica:
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.lag = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def healthy(self):
+        """
+        Whether this replica is close enough to the primary to read from.
+        The lag is looked up at most once per check interval per process.
+        """
+        if time.time() - self.checked_at >= config['DATABASE_REPLICA_LAG_CHECK_INTERVAL'] and self.lock.acquire(blocking=False):
+            try:
+                with self.engine.connect() as conn:
+                    self.lag = float(conn.execute(_lag_query).scalar())
+            except Exception as e:
+                print(f"Couldn't check lag on replica {self.name}: {repr(e)}")
+                self.lag = None
+            finally:
+                self.checked_at = time.time()
+                self.lock.release()
+        return self.lag is not None and self.lag <= config['DATABASE_REPLICA_MAX_LAG']
+
+_replicas = []
+
+def use_primary(fn):
+    """
+    Mark a view as reading its own (or its user's recent) writes, so that it
+    never goes to a replica.  Goes underneath the @route.
+    """
+    fn.use_primary = True
+    return fn
+
+def _choose_replica():
+    g.db_replica = None
+    if not _replicas or request.blueprint not in read_blueprints or request.method not in ('GET', 'HEAD'):
+        return
+    if getattr(current_app.view_functions.get(request.endpoint), 'use_primary', False):
+        return
+    replicas = [replica for replica in _replicas if replica.healthy()]
+    if not replicas:
+        beeline.add_context_field('db.replica', 'primary')
+        return
+    replica = random.choice(replicas)
+    beeline.add_context_field('db.replica', replica.name)
+    g.db_replica = replica.engine
+
+def init_app(app):
+    for i, url in enumerate(config['SQLALCHEMY_REPLICA_URIS']):
+        _replicas.append(Replica(f"replica-{i}", create_engine(url, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))))
+    app.before_request(_choose_replica)
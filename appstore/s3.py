@@ -1,9 +1,11 @@
+import gzip
 import json
 import boto3
 import threading
 from botocore.exceptions import ClientError
 from .models import Binary
 from .settings import config
+from .disk_cache import DiskCache
 from .utils import id_generator
 
 # Try to find a way to get S3 credentials.
@@ -49,6 +51,13 @@ except Exception:
 if not session:
     print("no session")
 
+# Asset and PBW ids are never reused, so anything we have downloaded once can
+# be served from local disk forever after (or at least until it gets evicted).
+if config['S3_CACHE_DIR']:
+    download_cache = DiskCache(config['S3_CACHE_DIR'], config['S3_CACHE_MAX_BYTES'])
+else:
+    download_cache = None
+
 _clients = {}
 
 def _client_for_endpoint(endpoint):
@@ -73,17 +82,24 @@ def upload_pbw(release, file):
         file.seek(0)
         s3.upload_fileobj(file, config['S3_BUCKET'], filename, ExtraArgs = {'ContentType': 'application/zip'})   
 
-def download_pbw(id, file):
-    filename = f"{config['S3_PATH']}{id}.pbw"
+def _download(bucket, filename, file):
     s3 = _client_for_endpoint(s3_endpoint)
-    if isinstance(file, str):
-        s3.download_file(config['S3_BUCKET'], filename, file)
+    if download_cache is not None:
+        download_cache.fetch(f"{bucket}/{filename}", file,
+                             lambda f: s3.download_fileobj(bucket, filename, f))
+    elif isinstance(file, str):
+        s3.download_file(bucket, filename, file)
     else:
-        s3.download_fileobj(config['S3_BUCKET'], filename, file)
+        s3.download_fileobj(bucket, filename, file)
+
+def download_pbw(id, file):
+    filename = f"{config['S3_PATH']}{id}.pbw"
+    _download(config['S3_BUCKET'], filename, file)
 
 
-def upload_asset(file, mime_type = None, path = config['S3_ASSET_PATH']):
-    id = id_generator.generate()
+def upload_asset(file, mime_type = None, path = config['S3_ASSET_PATH'], id = None):
+    if id is None:
+        id = id_generator.generate()
     filename = f"{path}{id}"
 
     if isinstance(file, str):
@@ -112,11 +128,22 @@ def upload_asset(file, mime_type = None, path = config['S3_ASSET_PATH']):
 
 def download_asset(id, file, path = config['S3_ASSET_PATH']):
     filename = f"{path}{id}"
+    _download(config['S3_ASSET_BUCKET'], filename, file)
+
+def asset_exists(id, path = config['S3_ASSET_PATH']):
     s3 = _client_for_endpoint(s3_endpoint)
-    if isinstance(file, str):
-        s3.download_file(config['S3_ASSET_BUCKET'], filename, file)
-    else:
-        s3.download_fileobj(config['S3_ASSET_BUCKET'], filename, file)
+    try:
+        s3.head_object(Bucket=config['S3_ASSET_BUCKET'], Key=f"{path}{id}")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+def download_cache_stats():
+    if download_cache is None:
+        return None
+    return download_cache.stats()
 
 def upload_archive(filename, file, mime_type = 'application/zip'):
     s3_filename = f"{config['S3_ARCHIVE_PATH']}{filename}"
@@ -127,6 +154,47 @@ def upload_archive(filename, file, mime_type = 'application/zip'):
         file.seek(0)
         s3.upload_fileobj(file, config['S3_ARCHIVE_BUCKET'], s3_filename, ExtraArgs = { 'ContentType': mime_type })
 
+def download_archive(filename, file):
+    # Archives are far too big for the download cache, and not immutable.
+    s3 = _client_for_endpoint(s3_endpoint)
+    s3.download_fileobj(config['S3_ARCHIVE_BUCKET'], f"{config['S3_ARCHIVE_PATH']}{filename}", file)
+
+def upload_archive_manifest(filename, manifest):
+    s3 = _client_for_endpoint(s3_endpoint)
+    s3.put_object(Bucket=config['S3_ARCHIVE_BUCKET'], Key=f"{config['S3_ARCHIVE_PATH']}{filename}.manifest.json.gz",
+                  Body=gzip.compress(json.dumps(manifest).encode('utf-8')), ContentType='application/gzip')
+
+def download_archive_manifest(filename):
+    s3 = _client_for_endpoint(s3_endpoint)
+    try:
+        response = s3.get_object(Bucket=config['S3_ARCHIVE_BUCKET'], Key=f"{config['S3_ARCHIVE_PATH']}{filename}.manifest.json.gz")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            # Archives from before there were manifests.
+            return None
+        raise
+    return json.loads(gzip.decompress(response['Body'].read()))
+
+def upload_sitemap(filename, data, mime_type):
+    s3 = _client_for_endpoint(s3_endpoint)
+    s3.put_object(Bucket=config['S3_ASSET_BUCKET'], Key=f"{config['S3_SITEMAP_PATH']}{filename}", Body=data, ContentType=mime_type)
+
+def download_sitemap(filename, file):
+    # Sitemap files are named for their contents, so they are as immutable as
+    # assets and can go through the download cache.
+    _download(config['S3_ASSET_BUCKET'], f"{config['S3_SITEMAP_PATH']}{filename}", file)
+
+def download_sitemap_manifest():
+    # ...but the manifest is rewritten by every build, so it must not.
+    s3 = _client_for_endpoint(s3_endpoint)
+    try:
+        response = s3.get_object(Bucket=config['S3_ASSET_BUCKET'], Key=f"{config['S3_SITEMAP_PATH']}manifest.json")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
 def get_link_for_archive(filename, expiry = 3600):
     s3 = _client_for_endpoint(s3_endpoint)
     return s3.generate_presigned_url('get_object',
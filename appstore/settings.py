@@ -6,6 +6,24 @@ http_protocol = os.environ.get('HTTP_PROTOCOL', 'https')
 config = {
     'DOMAIN_ROOT': domain_root,
     'SQLALCHEMY_DATABASE_URI': os.environ['DATABASE_URL'].replace("postgres://","postgresql://"),
+    # Read-only GETs are spread over these, when there are any.
+    'SQLALCHEMY_REPLICA_URIS': [url.replace("postgres://","postgresql://") for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url],
+    'DATABASE_REPLICA_MAX_LAG': float(os.environ.get('DATABASE_REPLICA_MAX_LAG', '10')),
+    'DATABASE_REPLICA_LAG_CHECK_INTERVAL': float(os.environ.get('DATABASE_REPLICA_LAG_CHECK_INTERVAL', '5')),
+    'SQLALCHEMY_ENGINE_OPTIONS': {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', '5')),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', '10')),
+        'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', 'true').lower() == 'true',
+    },
+    # Behind pgbouncer in transaction mode, pgbouncer does the pooling.
+    'DATABASE_PGBOUNCER': os.environ.get('DATABASE_PGBOUNCER', 'false').lower() == 'true',
+    # In milliseconds, for any statement run by a request; 0 for no limit.
+    'DATABASE_STATEMENT_TIMEOUT': int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', '30000')),
+    # Overrides for particular endpoints, as "api.home=5000,sitemap.app_routes=60000".
+    'DATABASE_ROUTE_STATEMENT_TIMEOUTS': dict((endpoint, int(ms)) for endpoint, ms in
+                                              (item.split('=') for item in os.environ.get('DATABASE_ROUTE_STATEMENT_TIMEOUTS', '').split(',') if item)),
     'PBW_ROOT': os.environ.get('PBW_ROOT', f'http://pbws.{domain_root}/pbw'),
     'IMAGE_ROOT': os.environ.get('IMAGE_ROOT', f'https://assets.rebble.io'),
     'APPSTORE_ROOT': os.environ.get('APPSTORE_ROOT', f'http://apps.{domain_root}'),
@@ -21,9 +39,26 @@ config = {
     'S3_PREVIEW_PATH': os.environ.get('S3_PREVIEW_PATH', 'preview_images/'),
     'S3_ARCHIVE_BUCKET': os.environ.get('S3_ARCHIVE_BUCKET', 'rebble-archive'),
     'S3_ARCHIVE_PATH':   os.environ.get('S3_ARCHIVE_PATH'  , 'appstore/'),
+    'ARCHIVE_FETCH_ATTEMPTS': int(os.environ.get('ARCHIVE_FETCH_ATTEMPTS', '5')),
+    'S3_DERIVATIVE_PATH': os.environ.get('S3_DERIVATIVE_PATH', 'derived/'),
+    # Lambda (zappa) freezes threads once the response is sent, so leave the
+    # derivatives to the preview worker there.
+    'IMAGE_DERIVATIVE_WORKERS': int(os.environ.get('IMAGE_DERIVATIVE_WORKERS', '0' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else '4')),
+    'S3_SITEMAP_PATH': os.environ.get('S3_SITEMAP_PATH', 'sitemaps/'),
+    'SITEMAP_MAX_URLS': int(os.environ.get('SITEMAP_MAX_URLS', '30000')),
+    'SITEMAP_MAX_BYTES': int(os.environ.get('SITEMAP_MAX_BYTES', str(50 * 1000 * 1000))),
+    'S3_CACHE_DIR': os.environ.get('S3_CACHE_DIR', None),
+    'S3_CACHE_MAX_BYTES': int(os.environ.get('S3_CACHE_MAX_BYTES', str(1024 * 1024 * 1024))),
     'HONEYCOMB_KEY': os.environ.get('HONEYCOMB_KEY', None),
+    'SQL_SLOW_QUERY_MS': int(os.environ.get('SQL_SLOW_QUERY_MS', '500')),
+    # Send a span per SQL statement for one request in this many; 0 for none.
+    'SQL_TRACE_SAMPLE_RATE': int(os.environ.get('SQL_TRACE_SAMPLE_RATE', '0')),
     'DISCORD_HOOK_URL': os.environ.get('DISCORD_HOOK_URL', None),
     'DISCORD_ADMIN_HOOK_URL': os.environ.get('DISCORD_ADMIN_HOOK_URL', None),
+    'DISCORD_GENERATED_HOOK_URL': os.environ.get('DISCORD_GENERATED_HOOK_URL', None),
+    'DISCORD_WEBHOOK_TIMEOUT': int(os.environ.get('DISCORD_WEBHOOK_TIMEOUT', '10')),
+    'DISCORD_WEBHOOK_LEASE': int(os.environ.get('DISCORD_WEBHOOK_LEASE', '120')),
+    'DISCORD_WEBHOOK_MAX_ATTEMPTS': int(os.environ.get('DISCORD_WEBHOOK_MAX_ATTEMPTS', '8')),
     'ALGOLIA_DISABLE': os.environ.get('ALGOLIA_DISABLE', False),
     'AWS_ACCESS_KEY': os.environ.get('AWS_ACCESS_KEY', None),
     'AWS_SECRET_KEY': os.environ.get('AWS_SECRET_KEY', None),
@@ -33,4 +68,27 @@ config = {
     'DISCOURSE_API_KEY': os.environ.get('DISCOURSE_API_KEY', None),
     'DISCOURSE_HOST': os.environ.get('DISCOURSE_HOST', f'forum.{domain_root}'),
     'DISCOURSE_SHOWCASE_TOPIC_ID': int(os.environ.get('DISCOURSE_SHOWCASE_TOPIC_ID', '3')),
+    'DISCOURSE_TIMEOUT': int(os.environ.get('DISCOURSE_TIMEOUT', '10')),
+    'DISCOURSE_LOOKUP_TIMEOUT': float(os.environ.get('DISCOURSE_LOOKUP_TIMEOUT', '3')),
+    'DISCOURSE_OWNER_CACHE_TTL': int(os.environ.get('DISCOURSE_OWNER_CACHE_TTL', '300')),
+    'DISCOURSE_BREAKER_THRESHOLD': int(os.environ.get('DISCOURSE_BREAKER_THRESHOLD', '5')),
+    'DISCOURSE_BREAKER_COOLDOWN': int(os.environ.get('DISCOURSE_BREAKER_COOLDOWN', '60')),
+    'DISCOURSE_ANNOUNCE_LEASE': int(os.environ.get('DISCOURSE_ANNOUNCE_LEASE', '300')),
+    'DISCOURSE_ANNOUNCE_MAX_ATTEMPTS': int(os.environ.get('DISCOURSE_ANNOUNCE_MAX_ATTEMPTS', '8')),
+    # "external" leaves rendering previews and sending queued Discord and
+    # Discourse messages to the workers (the apps *-worker commands that
+    # cloudbuild.yaml deploys, or the scheduled events in
+    # zappa_settings.json); see workers.py.  "inline", for local development
+    # without them, renders previews in the web request that first needs
+    # them, and sends messages from a background thread in the web process.
+    'QUEUE_WORKERS': os.environ.get('QUEUE_WORKERS', 'external'),
+    'PREVIEW_RENDER_WORKERS': int(os.environ.get('PREVIEW_RENDER_WORKERS', '2')),
+    'PREVIEW_RENDER_LEASE': int(os.environ.get('PREVIEW_RENDER_LEASE', '300')),
+    'PREVIEW_RENDER_MAX_ATTEMPTS': int(os.environ.get('PREVIEW_RENDER_MAX_ATTEMPTS', '5')),
+    'PREVIEW_RETRY_AFTER': int(os.environ.get('PREVIEW_RETRY_AFTER', '30')),
+    # Lambda (zappa) can't run a process pool, so validate in-process there.
+    'PBW_VALIDATION_WORKERS': int(os.environ.get('PBW_VALIDATION_WORKERS', '0' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else '2')),
+    'PBW_VALIDATION_TIMEOUT': int(os.environ.get('PBW_VALIDATION_TIMEOUT', '10')),
+    'PBW_VALIDATION_CPU_LIMIT': int(os.environ.get('PBW_VALIDATION_CPU_LIMIT', '10')),
+    'PBW_VALIDATION_MEMORY_LIMIT': int(os.environ.get('PBW_VALIDATION_MEMORY_LIMIT', str(512 * 1024 * 1024))),
 }
@@ -1,10 +1,20 @@
-from flask import Blueprint, render_template, make_response, url_for
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import re
+from math import ceil
+
+from botocore.exceptions import ClientError
+from flask import Blueprint, Response, render_template, make_response, url_for, abort, stream_with_context
 from flask_caching import Cache
 from urllib.parse import urljoin
 from itertools import product
-from copy import deepcopy
+from markupsafe import escape
 
 from .models import db, App, Collection, Category, Developer
+from .s3 import upload_sitemap, download_sitemap, download_sitemap_manifest
 from .settings import config
 
 parent_app = None
@@ -15,40 +25,39 @@ languages = { 'x-default': '', 'en': 'en_US', 'de': 'de_DE', 'es': 'es_ES', 'fr'
 app_types = ['watchapp', 'watchface']
 apps_per_page = 100
 
-def process_to_urls(paths):
-    urls = []
-
-    for path in paths:
-        loc = path['loc']
-        path['langs'] = []
-        for language in languages:
-            path['langs'].append({ 'href': urljoin(config['APPSTORE_ROOT'], f"{languages[language]}/{loc}"), 'code': language })
-        for lang in path['langs']:
-            localized_path = deepcopy(path)
-            localized_path['loc'] = lang['href']
-            urls.append(localized_path)
-
-    return urls
+stored_sitemap_filename = re.compile(r'^sitemap-(base|apps)-[0-9a-f]+\.xml\.gz$')
 
+# How the manifest writes times: UTC, like App.updated_at.
+manifest_time_format = '%Y-%m-%dT%H:%M:%S.%f'
 
-@cache.cached(timeout=3600)
-@api.route('/sitemap.xml')
-def index():
-    sitemaps = []
+def _sitemap_url_fields(path):
+    fields = ''
+    if path.get('lastmod'):
+        fields += f"\n        <lastmod>{path['lastmod'].strftime('%Y-%m-%d')}</lastmod>"
+    if path.get('priority'):
+        fields += f"\n        <priority>{path['priority']}</priority>"
+    if path.get('changefreq'):
+        fields += f"\n        <changefreq>{escape(path['changefreq'])}</changefreq>"
+    return fields
 
-    sitemaps.append(url_for('sitemap.base_routes', _external=True))
-
-    for index in range(int(db.session.query(App.id).filter(App.visible == True).distinct().count() / apps_per_page)):
-        sitemaps.append(url_for('sitemap.app_routes', page=index, _external=True))
-
-    resp = make_response(render_template('sitemap_index.xml', sitemaps=sitemaps))
-    resp.mimetype = 'application/xml'
-    return resp
+def sitemap_xml(paths):
+    """
+    Yield a <urlset> for `paths` a piece at a time.  Each path is listed once
+    per language; all of those copies share one block of alternate links,
+    built once for the path.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:xhtml="http://www.w3.org/1999/xhtml">'
+    for path in paths:
+        hrefs = [(code, escape(urljoin(config['APPSTORE_ROOT'], f"{languages[code]}/{path['loc']}"))) for code in languages]
+        tail = _sitemap_url_fields(path) + ''.join(
+            f'\n        <xhtml:link rel="alternate" hreflang="{code}" href="{href}"/>' for code, href in hrefs
+        ) + '\n    </url>'
+        for _, href in hrefs:
+            yield f"\n    <url>\n        <loc>{href}</loc>{tail}"
+    yield '\n</urlset>'
 
 
-@cache.cached(timeout=3600)
-@api.route('/sitemap-base.xml')
-def base_routes():
+def base_paths():
     paths = []
 
     for app_type in app_types:
@@ -67,25 +76,178 @@ def base_routes():
     for (category_slug,) in db.session.query(Category.slug).filter(Category.is_visible == True).distinct():
         paths.append({ 'loc': f"category/{category_slug}", 'priority': 0.9 })
 
-    resp = make_response(render_template('sitemap_view.xml', urls=process_to_urls(paths)))
+    return paths
+
+
+def app_paths(rows):
+    for app_id, recent_hearts, last_modified in rows:
+        yield { 'loc': f"application/{app_id}", 'priority': min(1.0, recent_hearts or 0), 'lastmod': last_modified }
+        yield { 'loc': f"application/{app_id}/changelog", 'lastmod': last_modified }
+
+
+def visible_apps():
+    return db.session.query(App.id, App.recent_hearts, App.updated_at).filter(App.visible == True).order_by(App.id)
+
+
+def stream_sitemap(paths):
+    return Response(stream_with_context(sitemap_xml(paths)), mimetype='application/xml')
+
+
+@cache.memoize(timeout=300)
+def current_sitemap_manifest():
+    return download_sitemap_manifest()
+
+
+@api.route('/sitemap.xml')
+@cache.cached(timeout=3600)
+def index():
+    sitemaps = []
+
+    manifest = current_sitemap_manifest()
+    if manifest is not None:
+        # Built by `flask apps build-sitemaps`.
+        for entry in [manifest['base']] + manifest['apps']:
+            sitemaps.append(url_for('sitemap.stored_sitemap', filename=entry['filename'], _external=True))
+    else:
+        sitemaps.append(url_for('sitemap.base_routes', _external=True))
+
+        for index in range(ceil(db.session.query(App.id).filter(App.visible == True).count() / apps_per_page)):
+            sitemaps.append(url_for('sitemap.app_routes', page=index, _external=True))
+
+    resp = make_response(render_template('sitemap_index.xml', sitemaps=sitemaps))
     resp.mimetype = 'application/xml'
     return resp
 
-@cache.cached(timeout=3600)
+
+@api.route('/sitemaps/<filename>')
+def stored_sitemap(filename):
+    if not stored_sitemap_filename.match(filename):
+        abort(404)
+
+    buf = io.BytesIO()
+    try:
+        download_sitemap(filename, buf)
+    except ClientError:
+        abort(404)
+    resp = make_response(buf.getvalue())
+    resp.mimetype = 'application/gzip'
+    resp.headers.set('Cache-Control', 'public, max-age=31536000, immutable')
+    return resp
+
+
+# These two are only used until build-sitemaps has been run.  They stream,
+# so they aren't cached: a cached response would be an exhausted generator.
+@api.route('/sitemap-base.xml')
+def base_routes():
+    return stream_sitemap(base_paths())
+
 @api.route('/sitemap-apps-<page>.xml')
 def app_routes(page):
-    paths = []
     page_number = int(page)
+    rows = visible_apps().limit(apps_per_page).offset(page_number * apps_per_page)
+    return stream_sitemap(app_paths(rows.yield_per(apps_per_page)))
 
-    for app_id, recent_hearts, last_modified in db.session.query(App.id, App.recent_hearts, App.updated_at).filter(App.visible == True).distinct().limit(apps_per_page).offset(page_number * apps_per_page):
-        if not recent_hearts:
-            recent_hearts = 0
-        paths.append({ 'loc': f"application/{app_id}", 'priority': min(1.0, recent_hearts), 'lastmod': last_modified })
-        paths.append({ 'loc': f"application/{app_id}/changelog", 'lastmod': last_modified })
 
-    resp = make_response(render_template('sitemap_view.xml', urls=process_to_urls(paths)))
-    resp.mimetype = 'application/xml'
-    return resp
+def _render_sitemap(paths):
+    buf = io.BytesIO()
+    size = 0
+    # No timestamp in the header, so that the same sitemap always compresses
+    # to the same bytes, and so to the same name.
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        for chunk in sitemap_xml(paths):
+            chunk = chunk.encode('utf-8')
+            f.write(chunk)
+            size += len(chunk)
+    return buf.getvalue(), size
+
+def _store_sitemap(kind, data):
+    filename = f"sitemap-{kind}-{hashlib.sha1(data).hexdigest()[:16]}.xml.gz"
+    upload_sitemap(filename, data, 'application/gzip')
+    return filename
+
+def _ids_digest(app_ids):
+    return hashlib.sha1(','.join(app_ids).encode('utf-8')).hexdigest()
+
+def _store_app_sitemap(rows):
+    data, size = _render_sitemap(app_paths(rows))
+    if size > config['SITEMAP_MAX_BYTES'] and len(rows) > 1:
+        # Over the protocol's uncompressed size limit; halve it and try again.
+        half = len(rows) // 2
+        return _store_app_sitemap(rows[:half]) + _store_app_sitemap(rows[half:])
+    filename = _store_sitemap('apps', data)
+    lastmod = max((row.updated_at for row in rows if row.updated_at), default=None)
+    print(f"Wrote {filename}: {len(rows)} apps, {size} bytes uncompressed, {len(data)} compressed")
+    return [{
+        'filename': filename,
+        'first_id': rows[0].id,
+        'count': len(rows),
+        'ids_digest': _ids_digest(row.id for row in rows),
+        'lastmod': lastmod.strftime(manifest_time_format) if lastmod else None,
+    }]
+
+def _store_app_sitemaps(rows):
+    # Every app has two paths, each listed once per language.
+    apps_per_file = config['SITEMAP_MAX_URLS'] // (2 * len(languages))
+    entries = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == apps_per_file:
+            entries.extend(_store_app_sitemap(chunk))
+            chunk = []
+    if chunk:
+        entries.extend(_store_app_sitemap(chunk))
+    return entries
+
+def build_sitemaps(full=False):
+    """
+    Write the sitemaps to S3_SITEMAP_PATH, along with a manifest describing
+    which range of app ids went into each file.  Unless `full`, only the
+    ranges that have changed since the last build are rewritten: those with
+    an app updated since then, or whose set of visible apps has changed
+    (which needn't touch updated_at: apps are hidden and shown without it).
+    """
+    started = datetime.datetime.utcnow()
+    manifest = None if full else download_sitemap_manifest()
+
+    base_filename = _store_sitemap('base', _render_sitemap(base_paths())[0])
+
+    if manifest is None:
+        entries = _store_app_sitemaps(visible_apps().yield_per(1000))
+        rewritten = len(entries)
+    else:
+        since = datetime.datetime.strptime(manifest['built_at'], manifest_time_format)
+        old_entries = manifest['apps']
+        entries = []
+        rewritten = 0
+        for i, entry in enumerate(old_entries):
+            # Each file owns everything from its first id up to the next
+            # file's, so apps that appear between files are picked up too.
+            query = visible_apps()
+            if i > 0:
+                query = query.filter(App.id >= entry['first_id'])
+            if i + 1 < len(old_entries):
+                query = query.filter(App.id < old_entries[i + 1]['first_id'])
+
+            app_ids = [app_id for (app_id,) in query.with_entities(App.id)]
+            if query.filter(App.updated_at > since).count() == 0 and _ids_digest(app_ids) == entry.get('ids_digest'):
+                entries.append(entry)
+                continue
+            new_entries = _store_app_sitemaps(query.yield_per(1000))
+            entries.extend(new_entries)
+            rewritten += len(new_entries)
+        if not old_entries:
+            entries = _store_app_sitemaps(visible_apps().yield_per(1000))
+            rewritten = len(entries)
+
+    manifest = {
+        'built_at': started.strftime(manifest_time_format),
+        'base': {'filename': base_filename},
+        'apps': entries,
+    }
+    upload_sitemap('manifest.json', json.dumps(manifest).encode('utf-8'), 'application/json')
+    return manifest, rewritten
+
 
 def init_app(app):
     global parent_app
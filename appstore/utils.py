@@ -1,13 +1,12 @@
 import os
 import random
 import time
-import imghdr
+import struct
 
+from collections import namedtuple
 from typing import Dict, Optional
 from uuid import getnode
 
-from PIL import Image
-
 import requests
 from flask import request, abort, url_for
 
@@ -54,30 +53,17 @@ plat_dimensions = {
     'gabbro': (260, 260),
 }
 
+image_dimensions = {
+    "banner": (720, 320),
+    "screenshot_chalk": (180, 180),
+    "screenshot_emery": (200, 228),
+    "screenshot_gabbro": (260, 260),
+    "large_icon": (144, 144),
+    "small_icon": (48, 48),
+}
+
 def get_max_image_dimensions(resource_type):
-    max_w = 144
-    max_h = 168
-
-    if resource_type == "banner":
-        max_w = 720
-        max_h = 320
-    elif resource_type == "screenshot_chalk":
-        max_w = 180
-        max_h = 180
-    elif resource_type == "screenshot_emery":
-        max_w = 200
-        max_h = 228
-    elif resource_type == "screenshot_gabbro":
-        max_w = 260
-        max_h = 260
-    elif resource_type == "large_icon":
-        max_w = 144
-        max_h = 144
-    elif resource_type == "small_icon":
-        max_w = 48
-        max_h = 48
-
-    return max_w, max_h
+    return image_dimensions.get(resource_type, (144, 168))
 
 parent_app = None
 
@@ -439,26 +425,26 @@ def validate_new_app_fields(request):
     if "large_icon" not in request.files:
         raise newAppValidationException("Missing file: large_icon", "large_icon.missing")
 
-    imgtype, img_valid = is_valid_image_file(request.files["large_icon"])
-    if not img_valid:
-        raise newAppValidationException("Illegal image type: " + str(imgtype), "large_icon.illegalvalue")
+    image = probe_image(request.files["large_icon"])
+    if not is_permitted_image(image):
+        raise newAppValidationException("Illegal image type: " + str(image.format), "large_icon.illegalvalue")
 
     # Check file types and file sizes of optional images
     if "banner" in request.files:
-        imgtype, img_valid = is_valid_image_file(request.files["banner"])
-        if not img_valid:
-            raise newAppValidationException("Illegal image type: " + str(imgtype), "banner.illegalvalue")
+        image = probe_image(request.files["banner"])
+        if not is_permitted_image(image):
+            raise newAppValidationException("Illegal image type: " + str(image.format), "banner.illegalvalue")
 
-        if not is_valid_image_size(request.files["banner"], "banner"):
+        if not has_image_dimensions(image, "banner"):
             max_w, max_h = get_max_image_dimensions("banner")
             raise newAppValidationException(f"Banner has incorrect dimensions. Should be {max_w}x{max_h}", "banner.illegaldimensions")
 
     if "small_icon" in request.files:
-        imgtype, img_valid = is_valid_image_file(request.files["small_icon"])
-        if not img_valid:
-            raise newAppValidationException("Illegal image type: " + str(imgtype), "small_icon.illegalvalue")
+        image = probe_image(request.files["small_icon"])
+        if not is_permitted_image(image):
+            raise newAppValidationException("Illegal image type: " + str(image.format), "small_icon.illegalvalue")
 
-        if not is_valid_image_size(request.files["small_icon"], "small_icon"):
+        if not has_image_dimensions(image, "small_icon"):
             max_w, max_h = get_max_image_dimensions("small_icon")
             raise newAppValidationException(f"Small icon has incorrect dimensions. Should be {max_w}x{max_h}", "small_icon.illegaldimensions")
     
@@ -471,15 +457,15 @@ def validate_new_app_fields(request):
     for platform in valid_platforms:
         for x in range(1, 6):
              if f"screenshot-{platform}-{x}" in request.files:
-                imgtype = imghdr.what(request.files[f"screenshot-{platform}-{x}"])
-                if imgtype in permitted_image_types:
-                    if is_valid_image_size(request.files[f"screenshot-{platform}-{x}"], f"screenshot_{platform}"):
+                image = probe_image(request.files[f"screenshot-{platform}-{x}"])
+                if is_permitted_image(image):
+                    if has_image_dimensions(image, f"screenshot_{platform}"):
                         at_least_one_screenshot = True
                     else:
                         max_w, max_h = get_max_image_dimensions(f"screenshot_{platform}")
                         raise newAppValidationException(f"A screenshot has the incorrect dimensions for platform {platform}. Should be {max_w}x{max_h}.", "screenshots.illegaldimensions")
                 else:
-                    raise newAppValidationException("Illegal image type: " + str(imgtype), "screenshots.illegalvalue")
+                    raise newAppValidationException("Illegal image type: " + str(image.format), "screenshots.illegalvalue")
 
     if not at_least_one_screenshot:
         raise newAppValidationException("No screenshots provided", "screenshots.noneprovided")
@@ -511,9 +497,108 @@ def clone_asset_collection_without_images(appObject, platform):
 
     return clone_asset_collection
 
-def is_valid_image_file(file):
-    imgtype = imghdr.what(file)
-    return (imgtype, imgtype in permitted_image_types)
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height', 'frames', 'bytes'])
+
+class _TruncatedImage(Exception):
+    pass
+
+def _read_exactly(file, n):
+    data = file.read(n)
+    if len(data) != n:
+        raise _TruncatedImage()
+    return data
+
+def _skip_gif_sub_blocks(file):
+    while True:
+        length = _read_exactly(file, 1)[0]
+        if length == 0:
+            return
+        _read_exactly(file, length)
+
+def _probe_png(file):
+    # IHDR is always the first chunk; an APNG's acTL must come before IDAT.
+    _, chunk_type, width, height = struct.unpack('>I4sII', _read_exactly(file, 16))
+    if chunk_type != b'IHDR':
+        raise _TruncatedImage()
+    _read_exactly(file, 9)  # rest of IHDR and its CRC
+    while True:
+        length, chunk_type = struct.unpack('>I4s', _read_exactly(file, 8))
+        if chunk_type == b'acTL':
+            frames, = struct.unpack('>I', _read_exactly(file, 4))
+            return width, height, frames
+        if chunk_type == b'IDAT' or chunk_type == b'IEND':
+            return width, height, 1
+        _read_exactly(file, length + 4)
+
+def _probe_jpeg(file):
+    while True:
+        marker = _read_exactly(file, 2)
+        while marker[1] == 0xFF:  # fill bytes
+            marker = marker[1:] + _read_exactly(file, 1)
+        if marker[0] != 0xFF:
+            raise _TruncatedImage()
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length, = struct.unpack('>H', _read_exactly(file, 2))
+        if code in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            _, height, width = struct.unpack('>BHH', _read_exactly(file, 5))
+            return width, height, 1
+        _read_exactly(file, length - 2)
+
+def _probe_gif(file):
+    # Counting frames means walking every block, but nothing gets decoded.
+    width, height, flags = struct.unpack('<HHBxx', _read_exactly(file, 7))
+    if flags & 0x80:
+        _read_exactly(file, 3 << ((flags & 0x07) + 1))
+    frames = 0
+    while True:
+        block = _read_exactly(file, 1)
+        if block == b';':
+            return width, height, frames
+        if block == b'!':
+            _read_exactly(file, 1)
+            _skip_gif_sub_blocks(file)
+        elif block == b',':
+            frames += 1
+            flags = _read_exactly(file, 9)[8]
+            if flags & 0x80:
+                _read_exactly(file, 3 << ((flags & 0x07) + 1))
+            _read_exactly(file, 1)
+            _skip_gif_sub_blocks(file)
+        else:
+            raise _TruncatedImage()
+
+def probe_image(file):
+    """
+    Work out the format, dimensions and frame count of an uploaded image by
+    reading only as far into it as that takes, starting from where the file
+    is now (the start, for a fresh upload), then rewind it so it can be
+    uploaded.  The format is None if it isn't a PNG, JPEG or GIF we can read.
+    """
+    image = ImageInfo(None, None, None, 0, 0)
+    try:
+        magic = file.read(2)
+        if magic == b'\x89P' and file.read(6) == b'NG\r\n\x1a\n':
+            image = ImageInfo('png', *_probe_png(file), 0)
+        elif magic == b'\xff\xd8':
+            image = ImageInfo('jpeg', *_probe_jpeg(file), 0)
+        elif magic == b'GI' and file.read(4) in (b'F87a', b'F89a'):
+            image = ImageInfo('gif', *_probe_gif(file), 0)
+    except (_TruncatedImage, struct.error):
+        pass
+
+    # Finding the end costs no reads; then the one seek back to the start.
+    file.seek(0, os.SEEK_END)
+    image = image._replace(bytes=file.tell())
+    file.seek(0)
+    return image
+
+def is_permitted_image(image):
+    return image.format in permitted_image_types
+
+def has_image_dimensions(image, resource_type):
+    return (image.width, image.height) == get_max_image_dimensions(resource_type)
 
 def get_app_description(app):
     for p in valid_platforms:
@@ -533,20 +618,6 @@ def user_is_wizard():
     me = result.json()
     return me['is_wizard']
 
-def get_image_size(file):
-    im = Image.open(file)
-    return im.size
-
-def is_valid_image_size(file, image_type):
-    
-    max_w, max_h = get_max_image_dimensions(image_type)
-    image_w, image_h = get_image_size(file)
-
-    if (image_w != max_w) or (image_h != max_h):
-        return False
-    else:
-        return True
-
 def who_am_i():
     result = demand_authed_request('GET', f"{config['REBBLE_AUTH_URL']}/api/v1/me")
     me = result.json()
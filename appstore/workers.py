@@ -0,0 +1,95 @@
+import threading
+import time
+
+from flask import current_app, g, has_request_context
+
+from .settings import config
+
+# The queues, and where they're drained:
+#
+#  * with QUEUE_WORKERS=external (the default), by the workers.  On Cloud
+#    Run, cloudbuild.yaml deploys a worker pool for each of
+#        flask apps preview-worker
+#        flask apps discord-worker
+#        flask apps discourse-worker
+#    from the web service's image.  On Lambda it's drain_queues below,
+#    which zappa_settings.json runs once a minute.  Lambda can't run a
+#    process pool, so previews are rendered in the function itself.
+#  * with QUEUE_WORKERS=inline, for local development without the workers,
+#    previews are rendered by the request that wants them, and the Discord
+#    and Discourse queues are drained by a thread in the web process,
+#    started at the end of any request that added to them.  That thread
+#    needs CPU after the response has gone, so this isn't for production.
+
+# Leave the scheduled function time to finish the batch it's on before
+# zappa's timeout_seconds.
+DRAIN_BUDGET = 240
+
+def drain_queues(event, context):
+    # Imported here, since the app imports the queues, which import this.
+    from . import app
+    from .discord_queue import run_discord_worker
+    from .discourse import run_announcement_worker
+    from .preview_queue import run_preview_worker
+
+    deadline = time.time() + DRAIN_BUDGET
+    with app.app_context():
+        rendered, failed = run_preview_worker(0, 5, 0, True, deadline=deadline)
+        sent, deferred = run_discord_worker(50, 5, True, deadline=deadline)
+        posted, unposted = run_announcement_worker(10, 0, True, deadline=deadline)
+        print(f"Drained queues: {rendered} previews rendered, {failed} failed; "
+              f"{sent} Discord messages sent, {deferred} deferred; "
+              f"{posted} Discourse announcements posted, {unposted} failed")
+
+# How long an inline drain that left messages backing off waits before
+# trying them again.
+INLINE_RETRY_INTERVAL = 60
+
+_drain_wanted = threading.Event()
+_draining = threading.Lock()
+
+def request_drain():
+    # Called whenever something is queued; the drain starts once the request
+    # is over, and so has committed (or not) whatever it queued.
+    if config['QUEUE_WORKERS'] == 'inline' and has_request_context():
+        g.drain_queues = True
+
+def _drain_inline(app):
+    from .discord_queue import discord_backlog, run_discord_worker
+    from .discourse import announcement_backlog, run_announcement_worker
+    from .models import db
+
+    # Whoever has the lock goes round again for anything queued while it was
+    # busy, so nothing is left waiting for the next request.
+    retry = False
+    while _drain_wanted.is_set() and _draining.acquire(blocking=False):
+        try:
+            _drain_wanted.clear()
+            with app.app_context():
+                try:
+                    run_discord_worker(50, 5, True)
+                    run_announcement_worker(10, 0, True)
+                    retry = discord_backlog() + announcement_backlog() > 0
+                except Exception as e:
+                    print(f"Failed to drain the queues: {repr(e)}")
+                    retry = True
+                finally:
+                    db.session.remove()
+        finally:
+            _draining.release()
+
+    if retry:
+        # Something is backing off, or Discord is making us wait; come back
+        # for it rather than wait for someone to queue something else.
+        _drain_wanted.set()
+        timer = threading.Timer(INLINE_RETRY_INTERVAL, _drain_inline, args=(app,))
+        timer.daemon = True
+        timer.start()
+
+def _teardown_request(exception):
+    if g.pop('drain_queues', False):
+        _drain_wanted.set()
+        threading.Thread(target=_drain_inline, args=(current_app._get_current_object(),), daemon=True).start()
+
+def init_app(app):
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,11 @@
+# Picked up automatically by gunicorn from the working directory.
+
+def post_worker_init(worker):
+    # Workers live long enough that it's worth loading the preview art before
+    # the first request rather than during it.
+    from appstore.image import prewarm
+    prewarm()
+    # ...and to start the PBW validation processes before this worker has
+    # any threads to fork from.
+    from appstore import pbw_validator
+    pbw_validator.prewarm()
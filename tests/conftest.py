@@ -0,0 +1,5 @@
+import os
+
+# appstore reads these at import time.  Nothing here talks to the database.
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/appstore_test')
+os.environ.setdefault('ALGOLIA_DISABLE', 'True')
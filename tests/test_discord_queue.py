@@ -0,0 +1,170 @@
+import datetime
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from appstore import discord_queue
+from appstore.models import DiscordMessage
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubWebhook:
+    """
+    A local stand-in for Discord's webhook endpoint.  Each path answers with
+    the responses queued for it, in order, then 204s.
+    """
+
+    def __init__(self):
+        self.received = []
+        self.responses = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                queued = stub.responses.get(self.path)
+                status, headers, reply = queued.pop(0) if queued else (204, {}, None)
+                if status < 300:
+                    stub.received.append((self.path, body))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if reply is not None:
+                    self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeSession:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, message):
+        self.deleted.append(message)
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    stub = StubWebhook()
+    monkeypatch.setitem(discord_queue.config, 'DISCORD_HOOK_URL', stub.url + '/main')
+    monkeypatch.setitem(discord_queue.config, 'DISCORD_ADMIN_HOOK_URL', stub.url + '/admin')
+    monkeypatch.setitem(discord_queue.config, 'DISCORD_GENERATED_HOOK_URL', None)
+    monkeypatch.setitem(discord_queue.config, 'DISCORD_WEBHOOK_TIMEOUT', 5)
+    monkeypatch.setitem(discord_queue.config, 'DISCORD_WEBHOOK_MAX_ATTEMPTS', 3)
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """
+    The messages table, as a list: claiming and deleting work on it the way
+    the real queries do.
+    """
+    messages = []
+    session = FakeSession()
+    monkeypatch.setattr(discord_queue, 'db', types.SimpleNamespace(session=session))
+
+    def claim(hooks, limit):
+        now = datetime.datetime.utcnow()
+        claimed = [m for m in messages
+                   if m not in session.deleted and m.hook in hooks and m.available_at <= now and m.claimed_at is None
+                   and m.attempts < discord_queue.config['DISCORD_WEBHOOK_MAX_ATTEMPTS']][:limit]
+        for message in claimed:
+            message.claimed_at = now
+        return claimed
+    monkeypatch.setattr(discord_queue, 'claim_discord_messages', claim)
+
+    def add(hook, payload, coalescable=False):
+        now = datetime.datetime.utcnow()
+        message = DiscordMessage(id=len(messages) + 1, hook=hook, payload=payload, coalescable=coalescable,
+                                 created_at=now, available_at=now, claimed_at=None, attempts=0)
+        messages.append(message)
+        return message
+
+    return types.SimpleNamespace(add=add, messages=messages, session=session)
+
+
+def _embed(title):
+    return {'embeds': [{'title': title}]}
+
+
+def test_coalesces_only_messages_that_differ_in_embeds(webhook, queue):
+    for i in range(12):
+        queue.add('DISCORD_ADMIN_HOOK_URL', _embed(f"audit {i}"), coalescable=True)
+    queue.add('DISCORD_ADMIN_HOOK_URL', dict(_embed('as someone else'), username='Wizard'), coalescable=True)
+    queue.add('DISCORD_ADMIN_HOOK_URL', _embed('not coalescable'))
+
+    assert discord_queue.run_discord_worker(50, 0.1, True) == (14, 0)
+
+    sent = [body for path, body in webhook.received]
+    assert [len(body['embeds']) for body in sent] == [10, 2, 1, 1]
+    assert [body.get('username') for body in sent] == [None, None, 'Wizard', None]
+    assert [e['title'] for body in sent[:2] for e in body['embeds']] == [f"audit {i}" for i in range(12)]
+    assert len(queue.session.deleted) == 14
+
+
+def test_429_holds_back_only_its_own_hook(webhook, queue):
+    # The body's retry_after is in milliseconds on older API versions; the
+    # header is what counts.
+    webhook.responses['/main'] = [(429, {'Retry-After': '0.3', 'Content-Type': 'application/json'},
+                                   {'retry_after': 300, 'global': False})]
+    limited = queue.add('DISCORD_HOOK_URL', _embed('new app'))
+    queue.add('DISCORD_ADMIN_HOOK_URL', _embed('audit'))
+
+    start = time.time()
+    sent, deferred = discord_queue.run_discord_worker(50, 0.05, True)
+    elapsed = time.time() - start
+
+    assert (sent, deferred) == (2, 1)
+    assert [path for path, _ in webhook.received] == ['/admin', '/main']
+    assert 0.3 <= elapsed < 5
+    # Being rate limited isn't the message's fault.
+    assert limited.attempts == 0
+
+
+def test_5xx_backs_off(webhook, queue):
+    webhook.responses['/main'] = [(502, {}, None)]
+    message = queue.add('DISCORD_HOOK_URL', _embed('new app'))
+
+    assert discord_queue.run_discord_worker(50, 0.05, True) == (0, 1)
+
+    assert message.attempts == 1
+    assert message.last_error.startswith('502')
+    assert message.claimed_at is None
+    assert message.available_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+    assert message not in queue.session.deleted
+
+
+def test_4xx_parks_the_message(webhook, queue):
+    webhook.responses['/main'] = [(400, {'Content-Type': 'application/json'}, {'message': 'Invalid Form Body'})]
+    message = queue.add('DISCORD_HOOK_URL', _embed('bad'))
+
+    assert discord_queue.run_discord_worker(50, 0.05, True) == (0, 1)
+
+    # Never retried, but kept for someone to look at.
+    assert message.attempts == discord_queue.config['DISCORD_WEBHOOK_MAX_ATTEMPTS']
+    assert 'Invalid Form Body' in message.last_error
+    assert message not in queue.session.deleted
+    assert webhook.received == []